@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import sys
 import warnings
 ##
 # django-mongolier
@@ -12,8 +13,12 @@ __contributors__ = [
     'Jeremy Bowers',
 ]
 
+default_app_config = 'mongolier.apps.MongolierConfig'
+
 try:
     from mongolier.db import Connection
     from mongolier.utils.convert import ConvertDecimal
+    if sys.version_info >= (3, 5):
+        from mongolier.asyncdb import AsyncConnection
 except ImportError as e:
     warnings.warn(str(e))
@@ -4,7 +4,10 @@ api.py
 A lightweight implementation of pymongo and django-tastypie
 
 """
+import functools
 import json
+import threading
+from collections import OrderedDict
 
 try:
     from django.db.models.constants import LOOKUP_SEP
@@ -16,6 +19,28 @@ from tastypie.bundle import Bundle
 from bson.objectid import ObjectId
 from pymongo.common import BaseObject
 from mongolier.db import Connection
+from mongolier.indexes import collections_for, merge_indexes, sync_indexes
+from mongolier.sharding import ShardedConnection
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+def _function(method):
+    return getattr(method, '__func__', method)
+
+
+def _project(document, projection):
+    """
+    Trim a whole ``document`` down to the top-level fields of ``projection``.
+    """
+    if document is None:
+        return None
+    fields = set(key.split('.', 1)[0] for key in projection)
+    fields.add('_id')
+    return dict((key, value) for key, value in document.items() if key in fields)
 
 
 class MongoStorageObject(dict):
@@ -32,6 +57,153 @@ class MongoStorageObject(dict):
         self[name] = value
 
 
+class MongoCursorList(object):
+    """
+    A lazy list of the documents matching a query, for tastypie's paginator.
+
+    Slicing it returns another ``MongoCursorList`` with the slice turned into
+    a server-side ``skip``/``limit``, and :meth:`count <count>` is run on the
+    server, so only the documents of the requested page are ever fetched.
+
+    ::
+
+        documents = MongoCursorList(collection, {'section': 'sports'}, sort=[('date', -1)])
+        documents.count()   # count on the server
+        documents[40:60]    # skip(40).limit(20), not fetched yet
+        documents[3]        # fetches a single document
+
+    ``projection`` limits the fields fetched, as in ``find``.
+    """
+    def __init__(self, collection, spec=None, sort=None, skip=0, limit=0, projection=None):
+        self.collection = collection
+        self.spec = spec
+        self.projection = projection
+        self.sort = sort
+        self.skip = skip
+        self.limit = limit
+        self._count = None
+        self._results = None
+
+    def _cursor(self, skip=None, limit=None):
+        if self.projection is not None:
+            cursor = self.collection.find(self.spec, self.projection)
+        else:
+            cursor = self.collection.find(self.spec)
+        if self.sort:
+            cursor = cursor.sort(self.sort)
+        skip = self.skip if skip is None else skip
+        limit = self.limit if limit is None else limit
+        if skip:
+            cursor = cursor.skip(skip)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    def count(self):
+        """
+        The number of documents in the list, counted by the server.
+        """
+        if self._results is not None:
+            return len(self._results)
+        if self._count is None:
+            self._count = self._cursor().count(with_limit_and_skip=True)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        if self._results is None:
+            self._results = list(self._cursor())
+        return iter(self._results)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.start, index.stop, index.step
+            if step not in (None, 1) or (start or 0) < 0 or (stop or 0) < 0:
+                # Steps and negative bounds: fall back on a real list
+                return list(self)[index]
+
+            start = start or 0
+            limit = 0
+            if stop is not None:
+                limit = stop - start
+                if limit <= 0:
+                    return []
+            if self.limit:
+                remaining = self.limit - start
+                if remaining <= 0:
+                    return []
+                limit = min(limit, remaining) if limit else remaining
+
+            return MongoCursorList(self.collection, self.spec, self.sort,
+                                   skip=self.skip + start, limit=limit,
+                                   projection=self.projection)
+
+        if self._results is not None:
+            return self._results[index]
+        if index < 0:
+            index += self.count()
+        if index < 0 or (self.limit and index >= self.limit):
+            raise IndexError('MongoCursorList index out of range')
+
+        for document in self._cursor(skip=self.skip + index, limit=1):
+            return document
+        raise IndexError('MongoCursorList index out of range')
+
+
+class FilterPlanCache(object):
+    """
+    A bounded, least recently used cache of compiled filter plans, keyed by
+    the shape of a query string (its sorted parameter names).
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, shape):
+        with self._lock:
+            plan = self._plans.pop(shape, None)
+            if plan is None:
+                self.misses += 1
+                return None
+            self._plans[shape] = plan
+            self.hits += 1
+            return plan
+
+    def set(self, shape, plan):
+        with self._lock:
+            self._plans.pop(shape, None)
+            self._plans[shape] = plan
+            while len(self._plans) > self.max_size:
+                self._plans.popitem(last=False)
+        return plan
+
+    def __len__(self):
+        return len(self._plans)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._plans)}
+
+
+def _loads_dict(value):
+    """
+    Decode ``value`` if it is a JSON object, return ``None`` otherwise.
+    """
+    try:
+        value_dict = json.loads(value)
+    except ValueError:
+        return None
+    # Because the python json module is not as strict as JSON standards
+    # We must check to make sure that the value loaded is a dict
+    if not isinstance(value_dict, dict):
+        return None
+    return value_dict
+
+
 class MongoDeclarativeMetaclass(DeclarativeMetaclass):
     """
     A Metaclass to set the ``object_class`` for
@@ -63,7 +235,9 @@ class MongoResource(Resource):
                             'limit',
                             'offset',
                             'key',
-                            'sort']
+                            'sort',
+                            'fields',
+                            'after']
 
     query_terms = ['all',
                    'exists',
@@ -84,31 +258,121 @@ class MongoResource(Resource):
     class Meta:
         connection = None
 
+    def __init__(self, api_name=None):
+        super(MongoResource, self).__init__(api_name=api_name)
+
+        #: The filter plans compiled by :meth:`build_filters <build_filters>`,
+        #: at most ``Meta.filter_plan_cache_size`` of them
+        self.filter_plans = FilterPlanCache(
+            getattr(self._meta, 'filter_plan_cache_size', 1000))
+
+        # Leave the fields left out by a ``fields=`` parameter out of the
+        # response, instead of dehydrating them from a partial document.
+        # Fields only used in lists or details are always dehydrated.
+        for name, field in self.fields.items():
+            if getattr(field, 'use_in', None) == 'all':
+                field.use_in = functools.partial(self._use_field, name)
+
+    def _use_field(self, name, bundle):
+        requested = self.get_requested_fields(bundle.request)
+        return requested is None or name in requested
+
+    def get_requested_fields(self, request):
+        """
+        The names of the fields asked for with the ``fields`` parameter
+        (``?fields=title,date``), or ``None`` for every field.
+        """
+        value = getattr(request, 'GET', {}).get('fields')
+        if not value:
+            return None
+        requested = set(name.strip() for name in value.split(','))
+        requested.add('resource_uri')
+        return requested
+
+    def get_projection(self, request=None):
+        """
+        Return the Mongo projection that fetches the fields this resource
+        exposes (narrowed down by the ``fields`` parameter of ``request``),
+        or ``None`` to fetch whole documents.
+
+        Whole documents are fetched whenever a field has no ``attribute`` or
+        a ``dehydrate_<field>`` method, or the resource overrides
+        ``dehydrate``, as those may read anything from the document. They
+        are also fetched for anything but GET requests, since updates save
+        the document read back whole.
+        """
+        if request is None or getattr(request, 'method', None) not in ('GET', 'HEAD'):
+            return None
+        if _function(type(self).dehydrate) is not _function(Resource.dehydrate):
+            return None
+
+        # ``Meta.fields`` and ``Meta.excludes`` are not looked at: a plain
+        # tastypie Resource dehydrates every declared field regardless
+        requested = self.get_requested_fields(request)
+
+        projection = {}
+        for name, field in self.fields.items():
+            if name == 'resource_uri':
+                continue
+            if requested is not None and name not in requested \
+                    and getattr(field, 'use_in', None) != 'list' \
+                    and getattr(field, 'use_in', None) != 'detail':
+                continue
+            attribute = getattr(field, 'attribute', None)
+            if not isinstance(attribute, basestring) \
+                    or hasattr(self, 'dehydrate_%s' % name):
+                return None
+            projection[attribute.replace(LOOKUP_SEP, '.')] = 1
+
+        return projection or None
+
     def do_query(self):
         if isinstance(self._meta.connection, BaseObject):
             return(self._meta.connection)
-        if isinstance(self._meta.connection, Connection):
+        if isinstance(self._meta.connection, (Connection, ShardedConnection)):
             return(self._meta.connection.api)
 
-    def apply_filters(self, request, applicable_filters):
+    def do_read_query(self):
         """
-        Final method that applies the filters built in ``build_filters``
-        and adds sorting if it's available
+        The collection to send find and count traffic to. With
+        ``read_from_secondary = True`` in the resource's ``Meta``, reads go
+        to the connection's ``read_api``.
         """
-        sorting = self.get_sorting(request)
-        if not sorting:
-            mongo_list_cursor = self.do_query()\
-                                    .find(applicable_filters)
-        else:
-            mongo_list_cursor = self.do_query()\
-                                    .find(applicable_filters)\
-                                    .sort(sorting)
+        if getattr(self._meta, 'read_from_secondary', False) \
+            and isinstance(self._meta.connection, (Connection, ShardedConnection)):
+            return(self._meta.connection.read_api)
+        return(self.do_query())
 
-        results = []
-        for mongo_obj in mongo_list_cursor:
-            results.append(mongo_obj)
+    def get_indexes(self):
+        """
+        The :class:`Index <mongolier.indexes.Index>` objects declared in the
+        resource's ``Meta.indexes``.
+        """
+        return(merge_indexes(getattr(self._meta, 'indexes', None) or []))
 
-        return(results)
+    def sync_indexes(self, **kwargs):
+        """
+        Build the declared indexes missing from the resource's collection
+        (every cluster's, for a ``ShardedConnection``). Takes the arguments
+        of :func:`sync_indexes <mongolier.indexes.sync_indexes>` and returns
+        its actions, per collection.
+        """
+        indexes = self.get_indexes()
+        return([(collection, sync_indexes(collection, indexes, **kwargs))
+                for collection in collections_for(self._meta.connection)])
+
+    def apply_filters(self, request, applicable_filters):
+        """
+        Final method that applies the filters built in ``build_filters``
+        and adds sorting if it's available.
+
+        Returns a lazy :class:`MongoCursorList <MongoCursorList>`: the
+        paginator's ``offset`` and ``limit`` become a server-side skip and
+        limit, and ``total_count`` a server-side count.
+        """
+        return(MongoCursorList(self.do_read_query(), applicable_filters,
+                               sort=self.get_sorting(request),
+                               projection=self.get_projection(request)))
 
     def get_sorting(self, request):
         """
@@ -232,28 +496,25 @@ class MongoResource(Resource):
             return(qs_filters)
 
         # Otherwise, construct a query from the parameters passed.
-        # First, remove reserved filter keywords
-        for filter_type in self.invalid_filter_types:
-            if filter_type in filters:
-                filters.pop(filter_type)
+        # Query strings of the same shape (the same parameter names) are
+        # compiled once into a plan of (parameter, field name, filter type),
+        # which only needs the values plugged in.
+        shape = tuple(sorted(filters.keys()))
+        plan = self.filter_plans.get(shape)
+        if plan is None:
+            plan = self.filter_plans.set(shape, self.compile_filters(shape))
 
         # Create a blank dictionary to store a filter dictionary
         qs_filters = {}
-        # Iterate over the filters passed by the client
-        for filter_expr, value in filters.items():
-            # Sets the default filter type.  If no other modifiers are passed
-            # this will produce a standard dictionary to filter on
-            filter_type = 'exact'
+        for filter_expr, field_name, filter_type in plan:
+            value = filters[filter_expr]
+
+            # Check first to see if a value can be decoded as json. Only
+            # objects are used, so don't try anything else.
+            value_dict = None
+            if isinstance(value, basestring) and value.lstrip().startswith('{'):
+                value_dict = _loads_dict(value)
 
-            # Check first to see if a value can be decoded as json
-            try:
-                value_dict = json.loads(value)
-                # Because the python json module is not as strict as JSON standards
-                # We must check to make sure that the value loaded is a dict
-                if not isinstance(value_dict, dict):
-                    value_dict = None
-            except ValueError:
-                value_dict = None
             # If a value is decoded, it passes that dict into a special method
             if value_dict:
                 # Get the value and filter_bits from the method.
@@ -262,18 +523,9 @@ class MongoResource(Resource):
                 # Because the field_name and the filter_expr are backward,
                 # we need to set the field name = to filter expr
                 field_name = filter_expr
-            else:
-                # Split filters that use the lookup separator (__ by default)
-                filter_bits = filter_expr.split(LOOKUP_SEP)
-
-                # field_name is the first item in the list
-                field_name = filter_bits.pop(0)
-
-            # Checks to make sure the modifier is in self.query_terms
-            # (Makes sure it's a valid modifier)
-            # If it's valid, it changes the filter_type to the query_term
-            if len(filter_bits) and filter_bits[-1] in self.query_terms:
-                filter_type = filter_bits.pop()
+                filter_type = 'exact'
+                if len(filter_bits) and filter_bits[-1] in self.query_terms:
+                    filter_type = filter_bits.pop()
 
             # Convert the filters passed in to valid python/mongo
             query = self.filter_query_to_mongo(value, field_name,
@@ -283,6 +535,35 @@ class MongoResource(Resource):
             qs_filters.update(query)
         return(qs_filters)
 
+    def compile_filters(self, filter_exprs):
+        """
+        Compile the parameter names of a query string into a filter plan: a
+        tuple of ``(parameter, field name, filter type)``, leaving out the
+        reserved parameters.
+        """
+        plan = []
+        for filter_expr in filter_exprs:
+            if filter_expr in self.invalid_filter_types:
+                continue
+
+            # Split filters that use the lookup separator (__ by default)
+            filter_bits = filter_expr.split(LOOKUP_SEP)
+
+            # field_name is the first item in the list
+            field_name = filter_bits.pop(0)
+
+            # Checks to make sure the modifier is in self.query_terms
+            # (Makes sure it's a valid modifier)
+            # If it's valid, it changes the filter_type to the query_term.
+            # Sets the default filter type otherwise.  If no other modifiers
+            # are passed this will produce a standard dictionary to filter on
+            filter_type = 'exact'
+            if len(filter_bits) and filter_bits[-1] in self.query_terms:
+                filter_type = filter_bits.pop()
+
+            plan.append((filter_expr, field_name, filter_type))
+        return(tuple(plan))
+
     def build_bundle(self, obj=None, data=None, request=None):
         """
         Given either an object, a data dictionary or both, builds a ``Bundle``
@@ -355,7 +636,33 @@ class MongoResource(Resource):
         """
         A method required to get a single object
         """
-        return(self.do_query().find_one(ObjectId(kwargs['pk'])))
+        projection = self.get_projection(getattr(bundle, 'request', None))
+        if projection is None:
+            return(self.do_read_query().find_one(ObjectId(kwargs['pk'])))
+        if self._caches_documents():
+            # Only a plain lookup by ``_id`` goes through the document cache:
+            # fetch the whole document and project it here
+            return(_project(self.do_read_query().find_one(ObjectId(kwargs['pk'])),
+                            projection))
+        return(self.do_read_query().find_one(ObjectId(kwargs['pk']), projection))
+
+    def cached_obj_get(self, bundle, **kwargs):
+        """
+        Projected objects bypass ``Meta.cache``, which is keyed on the
+        ``pk`` alone: a partial document cached by a GET would be read back
+        and saved by a later update.
+        """
+        if self.get_projection(getattr(bundle, 'request', None)) is not None:
+            return(self.obj_get(bundle, **kwargs))
+        return(super(MongoResource, self).cached_obj_get(bundle, **kwargs))
+
+    def _caches_documents(self):
+        connection = self._meta.connection
+        if isinstance(connection, Connection):
+            return connection.document_cache is not None
+        if isinstance(connection, ShardedConnection):
+            return any(shard.document_cache is not None for shard in connection.connections)
+        return False
 
     def obj_create(self, bundle, **kwargs):
         """
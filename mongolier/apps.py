@@ -0,0 +1,79 @@
+"""
+apps.py
+
+Django application config for mongolier.
+
+Add ``'mongolier'`` to ``INSTALLED_APPS`` and declare the connections to
+prepare at startup:
+
+::
+
+    MONGO_CONN = Connection(db='my_db', collection='my_collection')
+
+    # Setting names, dotted paths or Connection objects
+    MONGOLIER_PREWARM_CONNECTIONS = ['MONGO_CONN', 'myapp.connections.archive']
+
+    # Sockets to open for each connection (default 1)
+    MONGOLIER_PREWARM_SOCKETS = 4
+
+    # Seconds between health check pings, None to disable (default)
+    MONGOLIER_HEALTH_CHECK_INTERVAL = 10
+"""
+import logging
+
+from django.apps import AppConfig
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from mongolier.db import BaseConnection
+from mongolier import monitor
+
+logger = logging.getLogger(__name__)
+
+
+def get_prewarm_connections():
+    """
+    Resolve ``MONGOLIER_PREWARM_CONNECTIONS`` into a dictionary of name to
+    connection.
+    """
+    connections = {}
+    for declared in getattr(settings, 'MONGOLIER_PREWARM_CONNECTIONS', ()):
+        if isinstance(declared, BaseConnection):
+            name = '%s.%s' % (declared.db, declared.collection)
+            connection = declared
+        elif '.' in declared:
+            name = declared
+            connection = import_string(declared)
+        else:
+            name = declared
+            connection = getattr(settings, declared)
+        connections[name] = connection
+    return connections
+
+
+class MongolierConfig(AppConfig):
+    name = 'mongolier'
+    verbose_name = 'Mongolier'
+
+    #: The health monitor started by :meth:`ready <ready>`, if any
+    health_monitor = None
+
+    def ready(self):
+        connections = get_prewarm_connections()
+        if not connections:
+            return
+
+        min_sockets = getattr(settings, 'MONGOLIER_PREWARM_SOCKETS', 1)
+        for name, connection in connections.items():
+            try:
+                monitor.warm(connection, min_sockets=min_sockets)
+            except Exception as error:
+                # A database that is down at startup must not stop the site
+                # from starting; requests will retry on their own.
+                logger.warning('Could not pre-warm MongoDB connection %s: %s', name, error)
+
+        interval = getattr(settings, 'MONGOLIER_HEALTH_CHECK_INTERVAL', None)
+        if interval:
+            MongolierConfig.health_monitor = monitor.HealthMonitor(connections,
+                                                                   interval=interval)
+            MongolierConfig.health_monitor.start()
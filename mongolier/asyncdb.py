@@ -0,0 +1,333 @@
+"""
+asyncdb.py
+
+An asyncio flavour of :class:`Connection <mongolier.db.Connection>`.
+
+Every blocking pymongo call is run in a thread pool, through the same pooled
+client, authentication and :class:`RetryPolicy <mongolier.retry.RetryPolicy>`
+as a regular Connection, so many queries can be in flight at once on a single
+event loop.
+
+Requires Python 3.5 or later.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo.collection import Collection
+from pymongo.cursor import Cursor
+try:
+    from pymongo.command_cursor import CommandCursor
+except ImportError:
+    CommandCursor = Cursor
+
+from mongolier.collection import CursorProxy
+from mongolier.db import Connection
+
+_CURSOR_TYPES = (Cursor, CommandCursor, CursorProxy)
+
+# The cursor methods that only set an option and return the cursor
+_CHAINED_METHODS = frozenset(['add_option', 'remove_option', 'batch_size', 'limit',
+                              'skip', 'sort', 'hint', 'max_time_ms', 'max_await_time_ms',
+                              'max_scan', 'max', 'min', 'comment', 'where', 'collation',
+                              'allow_disk_use', 'return_key', 'show_record_id'])
+
+# The Connection methods that do no I/O
+_SYNC_METHODS = frozenset(['invalidate', 'add_write_listener', 'notify_write'])
+
+
+class AsyncCursor(object):
+    """
+    Wraps a pymongo cursor for use with ``async for``.
+
+    ::
+
+        async for document in connection.api.find({'published': True}):
+            ...
+
+        documents = await connection.api.find().sort('date', -1).to_list(20)
+
+    Awaiting the cursor itself returns every document as a list. Documents
+    are fetched from the executor ``batch_size`` at a time.
+
+    The cursor is built by calling ``factory`` in the executor, on first use,
+    when none is given. Chained cursor methods (sort, limit, skip...) return
+    the AsyncCursor, the others (count, distinct, explain...) awaitables.
+    """
+    def __init__(self, cursor, connection, batch_size=100, factory=None):
+        self._cursor = cursor
+        self._factory = factory
+        self._chained = []
+        self._connection = connection
+        self._batch_size = batch_size
+        self._buffer = []
+        self._exhausted = False
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        if name in _CHAINED_METHODS:
+            def chain(*args, **kwargs):
+                if self._cursor is None:
+                    self._chained.append((name, args, kwargs))
+                else:
+                    getattr(self._cursor, name)(*args, **kwargs)
+                return self
+            return chain
+
+        if self._cursor is not None:
+            attribute = getattr(self._cursor, name)
+            if not callable(attribute):
+                return attribute
+        elif not callable(getattr(Cursor, name, None)):
+            raise AttributeError('%s is only known once the cursor is fetched' % name)
+
+        async def wrapper(*args, **kwargs):
+            return await self._connection.run(self._call, name, args, kwargs)
+
+        return wrapper
+
+    def _get_cursor(self):
+        # Only ever called in the executor
+        if self._cursor is None:
+            cursor = self._factory()
+            for name, args, kwargs in self._chained:
+                getattr(cursor, name)(*args, **kwargs)
+            self._cursor = cursor
+        return self._cursor
+
+    def _call(self, name, args, kwargs):
+        return getattr(self._get_cursor(), name)(*args, **kwargs)
+
+    def _fetch(self):
+        batch = []
+        for document in self._get_cursor():
+            batch.append(document)
+            if len(batch) >= self._batch_size:
+                break
+        return batch
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._buffer:
+            if self._exhausted:
+                raise StopAsyncIteration
+            self._buffer = await self._connection.run(self._fetch)
+            if len(self._buffer) < self._batch_size:
+                self._exhausted = True
+            if not self._buffer:
+                raise StopAsyncIteration
+            self._buffer.reverse()
+        return self._buffer.pop()
+
+    async def to_list(self, length=None):
+        """
+        Return up to ``length`` documents as a list, or every remaining
+        document if ``length`` is ``None``.
+        """
+        documents = []
+        async for document in self:
+            documents.append(document)
+            if length is not None and len(documents) >= length:
+                break
+        return documents
+
+    def __await__(self):
+        return self.to_list().__await__()
+
+
+class AsyncCollection(object):
+    """
+    Collection access whose methods return awaitables.
+
+    The :class:`CollectionProxy <mongolier.collection.CollectionProxy>`
+    behind it is only looked up, with ``resolve()``, in the executor: the
+    first lookup connects and authenticates, which must not block the event
+    loop. ``find`` returns an :class:`AsyncCursor <AsyncCursor>` straight
+    away, and attribute or item access to another name a sub-collection.
+    Other collection attributes, such as ``database``, raise AttributeError:
+    read them through :meth:`run <AsyncConnection.run>`.
+    """
+    def __init__(self, resolve, connection, name):
+        self._resolve = resolve
+        self._connection = connection
+        self.name = name
+
+    @property
+    def full_name(self):
+        return '%s.%s' % (self._connection.sync.db, self.name)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        attribute = getattr(Collection, name, None)
+
+        # Sub-collections, e.g. ``connection.api.files``
+        if attribute is None:
+            return self[name]
+
+        if not callable(attribute):
+            raise AttributeError('%s needs the collection: read it in run()' % name)
+
+        connection = self._connection
+        resolve = self._resolve
+
+        def call(*args, **kwargs):
+            return getattr(resolve(), name)(*args, **kwargs)
+
+        async def wrapper(*args, **kwargs):
+            result = await connection.run(call, *args, **kwargs)
+            if isinstance(result, _CURSOR_TYPES):
+                return AsyncCursor(result, connection)
+            return result
+
+        return wrapper
+
+    def __getitem__(self, name):
+        resolve = self._resolve
+        return AsyncCollection(lambda: resolve()[name], self._connection,
+                               '%s.%s' % (self.name, name))
+
+    def find(self, *args, **kwargs):
+        resolve = self._resolve
+        return AsyncCursor(None, self._connection,
+                           factory=lambda: resolve().find(*args, **kwargs))
+
+    def __repr__(self):
+        return 'AsyncCollection(%r)' % self.full_name
+
+
+class AsyncGridFS(object):
+    """
+    GridFS access whose methods return awaitables. The GridFS object is
+    looked up with ``resolve()`` in the executor, like the collection of an
+    :class:`AsyncCollection <AsyncCollection>`.
+    """
+    def __init__(self, resolve, connection):
+        self._resolve = resolve
+        self._connection = connection
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        connection = self._connection
+        resolve = self._resolve
+
+        def call(*args, **kwargs):
+            return getattr(resolve(), name)(*args, **kwargs)
+
+        async def wrapper(*args, **kwargs):
+            return await connection.run(call, *args, **kwargs)
+
+        return wrapper
+
+
+class AsyncReadRouter(object):
+    """
+    Collection access reading from secondaries, like a Connection's ``read``.
+    """
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        sync = self._connection.sync
+        return AsyncCollection(lambda: sync.read[name], self._connection, name)
+
+
+class AsyncConnection(object):
+    """
+    The asyncio counterpart of :class:`Connection <mongolier.db.Connection>`.
+    It takes the same arguments, plus ``executor`` (defaults to a thread pool
+    of ``max_workers`` threads).
+
+    ::
+
+        my_connection = AsyncConnection(db='my_db', collection='my_collection')
+
+        async def my_view(request):
+            document = await my_connection.api.find_one({'slug': 'palm'})
+            total = await my_connection.other_collection.count()
+            async for document in my_connection['another'].find():
+                ...
+
+    Collection access (``api``, ``read_api``, ``read``, attribute and item
+    access), ``fs`` and ``bucket`` behave as they do on a Connection,
+    including the api/gridfs mode check, which is made when the first
+    operation is awaited. The other Connection methods that
+    do I/O, such as ``bulk``, raise AttributeError: call them on ``sync``
+    through :meth:`run <run>`.
+    """
+    def __init__(self, executor=None, max_workers=20, **kwargs):
+        self.__dict__['sync'] = Connection(**kwargs)
+        self.__dict__['executor'] = executor or ThreadPoolExecutor(max_workers=max_workers)
+
+    def run(self, func, *args, **kwargs):
+        """
+        Run ``func(*args, **kwargs)`` in the executor and return a future.
+        """
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor,
+                                    functools.partial(func, *args, **kwargs))
+
+    # The collections and buckets are looked up in the executor, as the first
+    # lookup connects (and may sleep between retries)
+
+    @property
+    def api(self):
+        sync = self.sync
+        return AsyncCollection(lambda: sync.api, self, sync.collection)
+
+    @property
+    def read_api(self):
+        sync = self.sync
+        return AsyncCollection(lambda: sync.read_api, self, sync.collection)
+
+    @property
+    def read(self):
+        return AsyncReadRouter(self)
+
+    @property
+    def fs(self):
+        sync = self.sync
+        return AsyncGridFS(lambda: sync.fs, self)
+
+    def bucket(self, name):
+        sync = self.sync
+        return AsyncGridFS(lambda: sync.bucket(name), self)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        # Attributes of the underlying Connection (host, retry_policy...)
+        # are shared, anything else is a collection name
+        try:
+            attribute = object.__getattribute__(self.sync, name)
+        except AttributeError:
+            return self[name]
+
+        if callable(attribute) and name not in _SYNC_METHODS:
+            # bulk(), storage(), get_database()... would block the event loop
+            raise AttributeError('%s() blocks: call it on the .sync Connection, '
+                                 'through run()' % name)
+        return attribute
+
+    def __getitem__(self, item):
+        sync = self.sync
+        return AsyncCollection(lambda: sync[item], self, item)
+
+    def close(self, wait=True):
+        """
+        Shut down the executor.  Pooled clients stay open for other connections.
+        """
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,289 @@
+"""
+bulk.py
+
+Buffered bulk writes: collect inserts, updates, upserts and removes and send
+them to MongoDB in batches instead of one round-trip per document.
+
+::
+
+    with my_connection.bulk(batch_size=500, ordered=False) as bulk:
+        for document in documents:
+            bulk.insert(document)
+        bulk.update({'_id': 12}, {'$set': {'seen': True}})
+        bulk.upsert({'slug': 'palm'}, {'$inc': {'views': 1}})
+        bulk.remove({'expired': True})
+
+    bulk.results
+    # [{'batch': 0, 'operations': 500, 'inserted': 500, ...}, ...]
+"""
+import logging
+import time
+
+from pymongo.errors import BulkWriteError
+
+try:
+    from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+except ImportError:
+    # pymongo < 3.0 only has the bulk builder API
+    InsertOne = None
+
+try:
+    from bson import BSON
+    _encode = BSON.encode
+except ImportError:
+    from bson import encode as _encode
+
+from mongolier.exceptions import IncorrectParameters
+
+logger = logging.getLogger(__name__)
+
+
+def _is_update(document):
+    return bool(document) and all(key.startswith('$') for key in document)
+
+
+class BulkWriter(object):
+    """
+    Queues write operations for a collection and runs them as bulk writes.
+
+    A batch is flushed as soon as it holds ``batch_size`` operations, when
+    the documents queued weigh ``max_bytes`` (as BSON), or when the next
+    operation is queued ``flush_interval`` seconds after the batch started.
+    There is no timer: a batch that stops growing is only flushed by time
+    when :meth:`flush_if_due <flush_if_due>` is called. Whatever is left is
+    flushed by :meth:`flush <flush>`, or on leaving the ``with`` block
+    without an exception. When the block raises, the queued operations are
+    discarded (and logged), not written.
+
+    In ``ordered`` mode, operations run in order and the first error stops
+    the batch and is raised. In unordered mode, the server runs every
+    operation it can; errors are recorded in :attr:`results
+    <results>` and only raised if ``raise_on_error`` is set.
+    """
+    def __init__(self,
+                collection,
+                ordered=True,
+                batch_size=1000,
+                max_bytes=None,
+                flush_interval=None,
+                raise_on_error=False,
+                on_flush=None):
+        #: The collection the operations are written to
+        self.collection = collection
+
+        self.ordered = ordered
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.raise_on_error = raise_on_error
+
+        #: Called with ``(operations, result)`` after each batch is written
+        self.on_flush = on_flush
+
+        #: The result of every batch written so far
+        self.results = []
+
+        self._operations = []
+        self._bytes = 0
+        self._started = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        elif self._operations:
+            logger.warning('Discarding %d queued operations on %s after %s: %s',
+                           len(self._operations), self.collection.name,
+                           exc_type.__name__, exc_value)
+            self._operations = []
+            self._bytes = 0
+            self._started = None
+
+    def __len__(self):
+        return len(self._operations)
+
+    def insert(self, document):
+        """
+        Queue an insert.
+        """
+        self._add(('insert', document), document)
+
+    def update(self, spec, document, upsert=False, multi=False):
+        """
+        Queue an update. ``document`` is either a set of update operators or
+        a replacement document.
+        """
+        if multi and not _is_update(document):
+            raise IncorrectParameters('multi updates need update operators, not a document')
+        self._add(('update', spec, document, upsert, multi), document)
+
+    def upsert(self, spec, document, multi=False):
+        """
+        Queue an update that inserts the document if nothing matches ``spec``.
+        """
+        self.update(spec, document, upsert=True, multi=multi)
+
+    def remove(self, spec, multi=True):
+        """
+        Queue the removal of every document matching ``spec`` (only the first
+        one if ``multi`` is false).
+        """
+        self._add(('remove', spec, multi), spec)
+
+    delete = remove
+
+    def _add(self, operation, document):
+        if not self._operations:
+            self._started = time.time()
+
+        self._operations.append(operation)
+        if self.max_bytes is not None:
+            self._bytes += len(_encode(document))
+
+        if len(self._operations) >= self.batch_size \
+            or (self.max_bytes is not None and self._bytes >= self.max_bytes) \
+            or self.due():
+            self.flush()
+
+    def due(self):
+        """
+        Whether the queued operations are older than ``flush_interval``.
+        """
+        return self._started is not None and self.flush_interval is not None \
+            and time.time() - self._started >= self.flush_interval
+
+    def flush_if_due(self):
+        """
+        Flush if the queued operations are older than ``flush_interval``, e.g.
+        from a periodic task. Returns the result, or ``None``.
+        """
+        if self.due():
+            return self.flush()
+        return None
+
+    def flush(self):
+        """
+        Write the queued operations as one bulk write, and return its result,
+        or ``None`` if nothing was queued.
+        """
+        operations = self._operations
+        if not operations:
+            return None
+
+        self._operations = []
+        self._bytes = 0
+        self._started = None
+
+        result = {
+            'batch': len(self.results),
+            'operations': len(operations),
+            'inserted': 0,
+            'matched': 0,
+            'modified': 0,
+            'upserted': 0,
+            'removed': 0,
+            'upserted_ids': {},
+            'write_errors': [],
+            'write_concern_errors': [],
+        }
+        self.results.append(result)
+
+        error = None
+        try:
+            if InsertOne is not None:
+                self._bulk_write(operations, result)
+            else:
+                self._bulk_op(operations, result)
+        except BulkWriteError as bulk_error:
+            self._read_details(bulk_error.details, result)
+            error = bulk_error
+
+        if self.on_flush is not None:
+            self.on_flush(operations, result)
+
+        if error is not None and (self.ordered or self.raise_on_error):
+            raise error
+
+        return result
+
+    def _bulk_write(self, operations, result):
+        requests = []
+        for operation in operations:
+            if operation[0] == 'insert':
+                requests.append(InsertOne(operation[1]))
+            elif operation[0] == 'update':
+                _, spec, document, upsert, multi = operation
+                if multi:
+                    requests.append(UpdateMany(spec, document, upsert=upsert))
+                elif _is_update(document):
+                    requests.append(UpdateOne(spec, document, upsert=upsert))
+                else:
+                    requests.append(ReplaceOne(spec, document, upsert=upsert))
+            else:
+                _, spec, multi = operation
+                requests.append(DeleteMany(spec) if multi else DeleteOne(spec))
+
+        written = self.collection.bulk_write(requests, ordered=self.ordered)
+        if written.acknowledged:
+            result.update({
+                'inserted': written.inserted_count,
+                'matched': written.matched_count,
+                'modified': written.modified_count,
+                'upserted': written.upserted_count,
+                'removed': written.deleted_count,
+                'upserted_ids': written.upserted_ids,
+            })
+
+    def _bulk_op(self, operations, result):
+        if self.ordered:
+            bulk = self.collection.initialize_ordered_bulk_op()
+        else:
+            bulk = self.collection.initialize_unordered_bulk_op()
+
+        for operation in operations:
+            if operation[0] == 'insert':
+                bulk.insert(operation[1])
+            elif operation[0] == 'update':
+                _, spec, document, upsert, multi = operation
+                found = bulk.find(spec)
+                if upsert:
+                    found = found.upsert()
+                if multi:
+                    found.update(document)
+                elif _is_update(document):
+                    found.update_one(document)
+                else:
+                    found.replace_one(document)
+            else:
+                _, spec, multi = operation
+                if multi:
+                    bulk.find(spec).remove()
+                else:
+                    bulk.find(spec).remove_one()
+
+        self._read_details(bulk.execute(), result)
+
+    @staticmethod
+    def _read_details(details, result):
+        if not details:
+            return
+        result.update({
+            'inserted': details.get('nInserted', 0),
+            'matched': details.get('nMatched', 0),
+            'modified': details.get('nModified', 0) or 0,
+            'upserted': details.get('nUpserted', 0),
+            'removed': details.get('nRemoved', 0),
+            'upserted_ids': dict((upserted['index'], upserted['_id'])
+                                 for upserted in details.get('upserted', [])),
+            'write_errors': details.get('writeErrors', []),
+            'write_concern_errors': details.get('writeConcernErrors', []),
+        })
+
+    @property
+    def errors(self):
+        """
+        Every write error reported so far, across batches.
+        """
+        return [error for result in self.results for error in result['write_errors']]
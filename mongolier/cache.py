@@ -0,0 +1,167 @@
+"""
+cache.py
+
+Caching of query results.
+
+:class:`CachedCollection <CachedCollection>` stores the results of
+``find_one``, ``find`` and ``count`` in a Django cache backend for ``ttl``
+seconds:
+
+::
+
+    articles = my_connection.cached(ttl=60, collection='articles')
+    articles.find_one({'slug': 'palm'})
+    articles.find({'section': 'sports'}, sort=[('date', -1)], limit=20)
+
+Entries are keyed by a stable hash of the collection and the query, and by
+version numbers kept for the database and per collection. Every write made
+through the same connection bumps the collection's version, so entries cached
+before the write are never read again.
+"""
+import hashlib
+import json
+import time
+
+from bson import json_util
+
+try:
+    from django.core.cache import caches
+
+    def get_cache(alias):
+        return caches[alias]
+except ImportError:
+    # Django < 1.7
+    from django.core.cache import get_cache
+
+
+def _digest(value):
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+def _query_hash(operation, spec, projection, sort, skip, limit):
+    return _digest(json.dumps([operation, spec, projection, sort, skip, limit],
+                              sort_keys=True, default=json_util.default))
+
+
+class QueryCache(object):
+    """
+    The collection versions of one connection in one Django cache. Listens to
+    the connection's writes to bump them.
+    """
+    def __init__(self, connection, cache='default'):
+        self.connection = connection
+        self.cache = cache if hasattr(cache, 'incr') else get_cache(cache)
+        self._prefix = 'mongolier:%s' % _digest('%s:%s:%s' % (connection.host,
+                                                              connection.port,
+                                                              connection.db))
+        connection.add_write_listener(self.invalidate)
+
+    def version_key(self, collection):
+        if collection is None:
+            # The version of the whole database
+            return '%s:version' % self._prefix
+        return '%s:version:%s' % (self._prefix, _digest(collection))
+
+    def version(self, collection):
+        """
+        Return the current version of ``collection`` (of the database if
+        ``None``).
+        """
+        key = self.version_key(collection)
+        version = self.cache.get(key)
+        if version is None:
+            # Start from the clock, never from 1: if the version was evicted,
+            # entries stored under the old numbers must stay unreachable.
+            self.cache.add(key, int(time.time() * 1000), None)
+            version = self.cache.get(key)
+        return version
+
+    def invalidate(self, collection, ids=None):
+        """
+        Make every cached result for ``collection`` (every collection if
+        ``None``) stale.
+        """
+        key = self.version_key(collection)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            # Nothing cached for this collection yet
+            self.cache.add(key, int(time.time() * 1000), None)
+
+    def key(self, collection, operation, spec, projection=None, sort=None,
+            skip=0, limit=0):
+        """
+        The cache key of a query, at the current versions of the database
+        and the collection.
+        """
+        database_key = self.version_key(None)
+        collection_key = self.version_key(collection)
+        versions = self.cache.get_many([database_key, collection_key])
+        return '%s:query:%s:%s.%s:%s' % (self._prefix,
+                                         _digest(collection),
+                                         versions.get(database_key) or self.version(None),
+                                         versions.get(collection_key) or self.version(collection),
+                                         _query_hash(operation, spec, projection,
+                                                     sort, skip, limit))
+
+
+class CachedCollection(object):
+    """
+    A collection whose reads are cached for ``ttl`` seconds. Reads that
+    cannot be cached and writes go straight to the collection.
+
+    ``find`` returns a list rather than a cursor, as that is what gets
+    cached.
+    """
+    def __init__(self, connection, collection, query_cache, ttl=60):
+        self._connection = connection
+        self._name = collection
+        self._query_cache = query_cache
+        self.ttl = ttl
+
+    @property
+    def _collection(self):
+        return self._connection._connect(collection=self._name)
+
+    def _cached(self, operation, fetch, spec, projection=None, sort=None,
+                skip=0, limit=0):
+        key = self._query_cache.key(self._name, operation, spec, projection,
+                                    sort, skip, limit)
+        cache = self._query_cache.cache
+
+        # Results are wrapped, so that a cached ``None`` is told from a miss
+        cached = cache.get(key)
+        if cached is not None:
+            return cached[0]
+
+        result = fetch()
+        cache.set(key, (result,), self.ttl)
+        return result
+
+    def find_one(self, spec_or_id=None, projection=None, sort=None, skip=0):
+        def fetch():
+            return self._collection.find_one(spec_or_id, projection,
+                                             sort=sort, skip=skip)
+        return self._cached('find_one', fetch, spec_or_id, projection, sort, skip)
+
+    def find(self, spec=None, projection=None, sort=None, skip=0, limit=0):
+        def fetch():
+            cursor = self._collection.find(spec, projection, skip=skip, limit=limit)
+            if sort:
+                cursor = cursor.sort(sort)
+            return list(cursor)
+        return self._cached('find', fetch, spec, projection, sort, skip, limit)
+
+    def count(self, spec=None):
+        def fetch():
+            return self._collection.find(spec).count()
+        return self._cached('count', fetch, spec)
+
+    def invalidate(self):
+        """
+        Make every cached result for this collection stale.
+        """
+        self._query_cache.invalidate(self._name)
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
@@ -0,0 +1,390 @@
+"""
+collection.py
+
+Thin wrappers around pymongo collections and cursors, which apply a
+:class:`Connection <mongolier.db.Connection>`'s retry policy and
+instrumentation to the operations run through them, and tell the connection
+about the writes made through them.
+"""
+import time
+from functools import wraps
+
+from pymongo.collection import Collection
+from pymongo.cursor import Cursor
+from pymongo.errors import AutoReconnect
+from pymongo.read_preferences import ReadPreference
+
+from mongolier import identity
+
+#: Operations whose first argument is a query
+QUERY_OPERATIONS = frozenset([
+    'find',
+    'find_one',
+    'count',
+    'count_documents',
+    'distinct',
+    'update',
+    'update_one',
+    'update_many',
+    'replace_one',
+    'remove',
+    'delete_one',
+    'delete_many',
+    'find_and_modify',
+    'find_one_and_update',
+    'find_one_and_replace',
+    'find_one_and_delete',
+])
+
+#: Operations that change documents, and that caches must hear about
+WRITE_OPERATIONS = frozenset([
+    'insert',
+    'insert_one',
+    'insert_many',
+    'save',
+    'update',
+    'update_one',
+    'update_many',
+    'replace_one',
+    'remove',
+    'delete_one',
+    'delete_many',
+    'find_and_modify',
+    'find_one_and_update',
+    'find_one_and_replace',
+    'find_one_and_delete',
+    'bulk_write',
+    'drop',
+    'rename',
+])
+
+
+def get_query(operation, args, kwargs):
+    """
+    Pick the query out of the arguments of ``operation``, if it takes one.
+    """
+    if operation not in QUERY_OPERATIONS:
+        return None
+    if args:
+        return args[0]
+    for name in ('spec', 'filter', 'query', 'spec_or_id'):
+        if name in kwargs:
+            return kwargs[name]
+    return None
+
+
+def get_ids(operation, args, kwargs):
+    """
+    Return the ``_id`` of every document a write touches, or ``None`` if
+    that cannot be told from its arguments (an update by another field, a
+    bulk write, a drop...).
+    """
+    if operation in ('insert', 'insert_one', 'insert_many', 'save'):
+        documents = args[0] if args else kwargs.get('doc_or_docs',
+                                                    kwargs.get('documents',
+                                                    kwargs.get('document',
+                                                    kwargs.get('to_save'))))
+        if isinstance(documents, dict):
+            documents = [documents]
+        ids = [document.get('_id') for document in documents or []]
+        if not ids or None in ids:
+            return None
+        return ids
+
+    query = get_query(operation, args, kwargs)
+    if query is None:
+        return None
+    if not isinstance(query, dict):
+        # A bare _id, e.g. ``remove(ObjectId(...))``
+        return [query]
+    if '_id' not in query:
+        return None
+
+    _id = query['_id']
+    if not isinstance(_id, dict):
+        return [_id]
+    if list(_id.keys()) == ['$in']:
+        return list(_id['$in'])
+    return None
+
+
+def get_document_id(args, kwargs):
+    """
+    Return the ``_id`` a ``find_one`` looks up, if it is a plain lookup by
+    ``_id`` (no projection, sort, skip or other option), or ``None``.
+    """
+    if len(args) != 1 or any(value for value in kwargs.values()):
+        return None
+
+    spec = args[0]
+    if isinstance(spec, dict):
+        if list(spec.keys()) != ['_id']:
+            return None
+        spec = spec['_id']
+    if spec is None or isinstance(spec, (dict, list)):
+        return None
+
+    try:
+        hash(spec)
+    except TypeError:
+        return None
+    return spec
+
+
+class CollectionProxy(object):
+    """
+    Behaves like the pymongo collection it wraps.
+
+    Operations that the connection's :class:`RetryPolicy
+    <mongolier.retry.RetryPolicy>` considers safe are retried, and cursors
+    returned by ``find`` are wrapped in a :class:`CursorProxy <CursorProxy>`.
+    If the connection has :class:`Instrumentation
+    <mongolier.instrumentation.Instrumentation>`, every operation is timed.
+    Writes are reported to the connection's :meth:`notify_write
+    <mongolier.db.BaseConnection.notify_write>`. If the connection has a
+    :class:`DocumentCache <mongolier.documents.DocumentCache>`, ``find_one``
+    lookups by ``_id`` on the primary go through it, and while an
+    :mod:`identity map <mongolier.identity>` is active, reads are memoized
+    in it. Everything else is passed straight through to pymongo.
+    """
+    def __init__(self, collection, connection):
+        self.__dict__['_collection'] = collection
+        self.__dict__['_connection'] = connection
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+
+        if isinstance(attribute, Collection):
+            attribute = CollectionProxy(attribute, self._connection)
+        elif callable(attribute):
+            attribute = self._wrap(name, attribute)
+        else:
+            return attribute
+
+        # Cache the wrapper, so that the next lookup is a plain attribute read
+        self.__dict__[name] = attribute
+        return attribute
+
+    def __setattr__(self, name, value):
+        setattr(self._collection, name, value)
+
+    def __getitem__(self, name):
+        return CollectionProxy(self._collection[name], self._connection)
+
+    def __eq__(self, other):
+        if isinstance(other, CollectionProxy):
+            other = other._collection
+        return self._collection == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._collection.full_name)
+
+    def __repr__(self):
+        return 'CollectionProxy(%r)' % self._collection
+
+    def _wrap(self, name, method):
+        connection = self._connection
+        collection = self._collection
+        policy = connection.retry_policy
+        instrumentation = connection.instrumentation
+        retry = policy.should_retry(name)
+        write = name in WRITE_OPERATIONS
+        document_cache = None
+        if name == 'find_one' and self._reads_primary():
+            document_cache = connection.document_cache
+
+        memoize = name in identity.IDENTITY_OPERATIONS
+
+        if not retry and not write and not memoize and instrumentation is None \
+                and document_cache is None:
+            return method
+
+        def on_retry(error):
+            if isinstance(error, AutoReconnect):
+                connection.invalidate()
+
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            identity_map = identity.get_identity_map() if memoize else None
+            if identity_map is not None:
+                key = identity_map.key(collection.full_name, name, args, kwargs,
+                                       self._reads_primary())
+                if key is None:
+                    identity_map = None
+                else:
+                    result = identity_map.get(collection.name, key)
+                    if result is not identity.MISSING:
+                        return result
+
+            _id = None
+            if document_cache is not None:
+                _id = get_document_id(args, kwargs)
+                if _id is not None:
+                    document = document_cache.get(collection.full_name, _id)
+                    if document is not None:
+                        return document
+                    generation = document_cache.generation(collection.full_name)
+
+            started = time.time()
+            try:
+                if retry:
+                    result = policy.call(name, method, args, kwargs, on_retry=on_retry)
+                else:
+                    result = method(*args, **kwargs)
+            except Exception:
+                if instrumentation is not None:
+                    instrumentation.record(collection.name, name,
+                                           time.time() - started,
+                                           query=get_query(name, args, kwargs),
+                                           error=True)
+                # A failed write may still have changed some documents
+                if write:
+                    connection.notify_write(collection.name, get_ids(name, args, kwargs))
+                raise
+
+            if isinstance(result, Cursor):
+                # The query runs when the first batch is fetched, the cursor
+                # records it then.
+                return CursorProxy(result, connection, collection,
+                                   get_query(name, args, kwargs))
+
+            if instrumentation is not None:
+                query = get_query(name, args, kwargs)
+                instrumentation.record(collection.name, name,
+                                       time.time() - started,
+                                       query=query,
+                                       explain=self._explainer(name, query))
+
+            if write:
+                connection.notify_write(collection.name, get_ids(name, args, kwargs))
+            else:
+                if _id is not None and result is not None:
+                    document_cache.set(collection.full_name, _id, result, generation)
+                if identity_map is not None:
+                    identity_map.set(collection.name, key, result)
+            return result
+
+        return wrapper
+
+    def _reads_primary(self):
+        # Documents read from a secondary may predate the writes that
+        # invalidated them, so they are never cached
+        read_preference = getattr(self._collection, 'read_preference', None)
+        return read_preference is None or read_preference == ReadPreference.PRIMARY
+
+    def _explainer(self, operation, query):
+        if operation not in ('find_one', 'count', 'count_documents'):
+            return None
+        collection = self._collection
+        return lambda: collection.find(query).explain()
+
+
+class CursorProxy(object):
+    """
+    Behaves like the pymongo cursor it wraps.
+
+    Cursors are lazy, so the query only runs when the first batch is
+    fetched. If that fetch fails, the cursor is rewound and fetched again,
+    if the connection's retry policy retries ``find``.  Once a document has
+    been handed out, errors are raised as-is, as retrying would repeat
+    documents.
+
+    The first fetch is what gets recorded as the ``find`` operation by the
+    connection's instrumentation.
+    """
+    def __init__(self, cursor, connection, collection=None, query=None):
+        self._cursor = cursor
+        self._connection = connection
+        self._collection = collection
+        self._query = query
+        self._started = False
+
+    def __getattr__(self, name):
+        attribute = getattr(self._cursor, name)
+
+        if not callable(attribute):
+            return attribute
+
+        policy = self._connection.retry_policy
+
+        @wraps(attribute)
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            if policy.should_retry(name):
+                result = policy.call(name, attribute, args, kwargs)
+            else:
+                result = attribute(*args, **kwargs)
+            # Chained cursor methods (sort, limit, skip...) return the cursor
+            if result is self._cursor:
+                return self
+            if isinstance(result, Cursor):
+                return CursorProxy(result, self._connection, self._collection, self._query)
+            if name == 'count':
+                self._record('count', started)
+            return result
+
+        return wrapper
+
+    def __getitem__(self, index):
+        result = self._cursor[index]
+        if result is self._cursor:
+            return self
+        return result
+
+    def __iter__(self):
+        return self
+
+    def _first(self):
+        try:
+            return next(self._cursor)
+        except AutoReconnect:
+            self._cursor.rewind()
+            raise
+
+    def _record(self, operation, started, error=False):
+        instrumentation = self._connection.instrumentation
+        if instrumentation is None or self._collection is None:
+            return
+
+        cursor = self._cursor
+        instrumentation.record(self._collection.name, operation,
+                               time.time() - started,
+                               query=self._query,
+                               error=error,
+                               explain=lambda: cursor.clone().explain())
+
+    def next(self):
+        if self._started:
+            return next(self._cursor)
+
+        policy = self._connection.retry_policy
+        started = time.time()
+        try:
+            if policy.should_retry('find'):
+                document = policy.call('find', self._first)
+            else:
+                document = self._first()
+        except StopIteration:
+            self._started = True
+            self._record('find', started)
+            raise
+        except Exception:
+            self._record('find', started, error=True)
+            raise
+
+        self._started = True
+        self._record('find', started)
+        return document
+
+    __next__ = next
+
+    def rewind(self):
+        self._cursor.rewind()
+        self._started = False
+        return self
+
+    def __repr__(self):
+        return 'CursorProxy(%r)' % self._cursor
@@ -0,0 +1,212 @@
+"""
+counters.py
+
+Coalesced ``$inc`` updates for hot counters such as view counts and votes.
+
+Increments are summed in memory per document and field, and written
+periodically as a single unordered bulk of ``$inc`` updates, instead of one
+update per event.
+
+::
+
+    counters = my_connection.increments(flush_interval=2)
+    counters.incr('articles', article_id, 'views')
+    counters.incr('articles', article_id, 'votes.up', 2)
+
+    # In tests, or before shutting down
+    counters.flush()
+"""
+import atexit
+import logging
+import threading
+import weakref
+
+from pymongo.errors import BulkWriteError
+
+from mongolier.pool import check_fork, register_after_fork
+
+logger = logging.getLogger(__name__)
+
+
+def _stop_at_exit(reference):
+    aggregator = reference()
+    if aggregator is not None:
+        aggregator.stop()
+
+
+class IncrementAggregator(object):
+    """
+    Sums pending increments per ``(collection, _id, field)`` and flushes them
+    every ``flush_interval`` seconds from a daemon thread (``None`` to only
+    flush explicitly). With ``upsert``, missing documents are created.
+
+    If a flush fails, the increments that were certainly not written (those
+    the server rejected, and those of the collections not reached yet) are
+    put back and retried with the next flush. When it is unknown whether an
+    update was applied, such as after a network error, it is not retried,
+    since ``$inc`` is not idempotent, and is counted in ``failed_updates``.
+    """
+    def __init__(self, connection, flush_interval=1.0, upsert=True):
+        self.connection = connection
+        self.flush_interval = flush_interval
+        self.upsert = upsert
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._stats = {
+            'increments': 0,
+            'flushed_increments': 0,
+            'flushed_updates': 0,
+            'failed_flushes': 0,
+            'failed_updates': 0,
+        }
+        self._stop = threading.Event()
+        self._thread = None
+
+        register_after_fork(self)
+        atexit.register(_stop_at_exit, weakref.ref(self))
+
+    def _after_fork(self):
+        """
+        Increments pending in the parent are the parent's to write: start
+        over empty, and restart the flushing thread if it was running.
+        """
+        was_running = self._thread is not None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._stop = threading.Event()
+        self._thread = None
+        if was_running:
+            self._start()
+
+    def _start(self):
+        # Set by stop(): increments made after it start the thread again
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='mongolier-increments')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as error:
+                logger.error('Flushing increments failed: %s', error)
+
+    def incr(self, collection, _id, field, amount=1):
+        """
+        Add ``amount`` to ``field`` of document ``_id`` in ``collection``.
+        """
+        check_fork()
+        with self._lock:
+            fields = self._pending.setdefault((collection, _id), {})
+            fields[field] = fields.get(field, 0) + amount
+            self._stats['increments'] += 1
+
+        if self._thread is None and self.flush_interval is not None:
+            with self._lock:
+                if self._thread is None:
+                    self._start()
+
+    def pending(self, collection, _id, field):
+        """
+        The amount not yet written for ``field`` of document ``_id``.
+        """
+        with self._lock:
+            return self._pending.get((collection, _id), {}).get(field, 0)
+
+    def flush(self):
+        """
+        Write every pending increment, one ``$inc`` update per document.
+        Returns the number of updates written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+
+            by_collection = {}
+            for (collection, _id), fields in pending.items():
+                by_collection.setdefault(collection, []).append((_id, fields))
+
+            written = 0
+            remaining = list(by_collection.items())
+            while remaining:
+                collection, documents = remaining.pop(0)
+                try:
+                    with self.connection.bulk(collection=collection, ordered=False,
+                                              batch_size=float('inf'),
+                                              raise_on_error=True) as bulk:
+                        for _id, fields in documents:
+                            bulk.update({'_id': _id}, {'$inc': fields}, upsert=self.upsert)
+                except BulkWriteError as error:
+                    # The server applied every update but those it reported
+                    # an error for: only these are put back
+                    failed = set(write_error['index']
+                                 for write_error in error.details.get('writeErrors', []))
+                    self._restore(collection, [document for index, document
+                                               in enumerate(documents) if index in failed])
+                    written += self._flushed([document for index, document
+                                              in enumerate(documents) if index not in failed])
+                    self._abort(remaining)
+                    raise
+                except Exception:
+                    # Some of the updates may have been applied before the
+                    # error (a lost reply, a timeout): $inc is not idempotent,
+                    # so rather than risk counting them twice, none is put back
+                    with self._lock:
+                        self._stats['failed_updates'] += len(documents)
+                    self._abort(remaining)
+                    raise
+
+                written += self._flushed(documents)
+
+            return written
+
+    def _flushed(self, documents):
+        with self._lock:
+            self._stats['flushed_updates'] += len(documents)
+            self._stats['flushed_increments'] += sum(len(fields) for _, fields in documents)
+        return len(documents)
+
+    def _abort(self, remaining):
+        """
+        Put back the collections the failed flush did not get to.
+        """
+        for collection, documents in remaining:
+            self._restore(collection, documents)
+        with self._lock:
+            self._stats['failed_flushes'] += 1
+
+    def _restore(self, collection, documents):
+        with self._lock:
+            for _id, fields in documents:
+                pending = self._pending.setdefault((collection, _id), {})
+                for field, amount in fields.items():
+                    pending[field] = pending.get(field, 0) + amount
+
+    def stop(self, flush=True):
+        """
+        Stop the flushing thread, and write what is pending unless ``flush``
+        is false. Called automatically when the process exits.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if flush:
+            try:
+                self.flush()
+            except Exception as error:
+                logger.error('Flushing increments at shutdown failed: %s', error)
+
+    def stats(self):
+        """
+        Return the pending documents and the increment and update counters.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending_documents'] = len(self._pending)
+        return stats
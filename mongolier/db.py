@@ -3,14 +3,34 @@ db.py
 
 A class for connecting to a MongoDB instance
 """
-import time
 import pymongo
+from pymongo import ReadPreference
 from pymongo.errors import (AutoReconnect,
                             ConnectionFailure,
                             OperationFailure)
-from mongolier.exceptions import InvalidMode, DoesNotExist
+try:
+    from pymongo.read_preferences import SecondaryPreferred
+except ImportError:
+    # pymongo < 3.0 sets read preferences as collection attributes
+    SecondaryPreferred = None
+from mongolier import bulk as bulk_module, identity
+from mongolier.collection import CollectionProxy
+from mongolier.counters import IncrementAggregator
+from mongolier.exceptions import InvalidMode, DoesNotExist, IncorrectParameters
+from mongolier.pool import current_pid, pool as default_pool
+from mongolier.retry import RetryPolicy
+from mongolier.storage import DedupStorage
+from mongolier.writebehind import WriteBehindQueue
 from gridfs import GridFS
 
+# SecondaryPreferred takes max_staleness since pymongo 3.4
+_MAX_STALENESS = pymongo.version_tuple[:2] >= (3, 4)
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
 
 class BaseConnection(object):
     """
@@ -25,6 +45,12 @@ class BaseConnection(object):
                 password=None,
                 max_retries=2,
                 override=False,
+                pool=None,
+                retry_policy=None,
+                read_max_staleness=None,
+                read_tag_sets=None,
+                instrumentation=None,
+                document_cache=None,
                 **options):
         """
         Instantiate the Mongo class
@@ -55,15 +81,69 @@ class BaseConnection(object):
         #: is dropped.
         self.max_retries = max_retries
 
+        #: The :class:`RetryPolicy <mongolier.retry.RetryPolicy>` applied to
+        #: connecting and to the operations run on this connection's collections
+        self.retry_policy = retry_policy or RetryPolicy(max_retries=max_retries)
+
+        #: An optional :class:`Instrumentation <mongolier.instrumentation.Instrumentation>`
+        #: that times the operations run on this connection's collections
+        self.instrumentation = instrumentation
+
+        #: An optional :class:`DocumentCache <mongolier.documents.DocumentCache>`
+        #: for ``find_one`` lookups by ``_id``, which writes through this
+        #: connection invalidate
+        self.document_cache = document_cache
+
         #: Additional options to pass into the pymongo connection
         self.options = options
 
+        #: The maximum replication lag, in seconds, of the secondaries that
+        #: ``read_api`` may read from. Requires pymongo 3.4 or later.
+        if read_max_staleness is not None and not _MAX_STALENESS:
+            raise IncorrectParameters('read_max_staleness requires pymongo 3.4 or later, '
+                                      'this is pymongo %s.' % pymongo.version)
+        self.read_max_staleness = read_max_staleness
+
+        #: The tag sets used to pick the secondaries ``read_api`` reads from,
+        #: e.g. ``[{'dc': 'east'}, {}]``
+        self.read_tag_sets = read_tag_sets
+
         #: Determines whether to permanently override default collection object
         #: on generic connections
         self.override = override
 
-        # To prevent incidental recursion
-        self._mode = None
+        #: The :class:`ClientPool <mongolier.pool.ClientPool>` that hands out
+        #: pymongo clients. Defaults to the process-wide registry.
+        self.pool = pool or default_pool
+
+        # The collections used through the collection API, and the GridFS
+        # buckets used, which must not be mixed up
+        self._api_collections = set()
+        self._buckets = set()
+
+        # The pooled client this connection last checked out, and the
+        # database, collection and GridFS handles built on top of it
+        self._entry = None
+        self._handles = {}
+
+        # The write-behind queue and increment aggregator, created on first use
+        self._write_behind = None
+        self._increments = None
+
+        # Callables told about every write made through this connection, and
+        # the query caches, by Django cache alias
+        self._write_listeners = []
+        self._query_caches = {}
+        if document_cache is not None:
+            self.add_write_listener(self._invalidate_documents)
+
+    def _invalidate_documents(self, collection, ids):
+        if collection is None:
+            self.document_cache.invalidate_database(self.db)
+            return
+        # The document cache is keyed on full names: caches shared by
+        # connections to several databases keep them apart
+        self.document_cache.invalidate('%s.%s' % (self.db, collection), ids)
 
     def __getattribute__(self, attribute):
         """
@@ -118,97 +198,220 @@ class BaseConnection(object):
         A method to handle generic connections created via __getattribute__ and
         __getitem__.
         """
-        if not self._mode:
-            self._mode = 'api'
         if self.override:
             self.collection = collection
 
         return(self._connect(collection=collection))
 
-    def _connect_to_db(self, retries=0):
+    def _handle(self, key, factory):
         """
-        Connect to the database, but do not initialize a connection.
+        Return the cached handle stored under ``key``, building it with
+        ``factory(database)`` on first use.
 
-        Depending on which public method is used, it initiates either a standard
-            mongo connection or a gridfs connection
+        Handles are kept for as long as the pooled client they were built
+        from is alive. Once that client is discarded (after a connection error
+        or failover), or was inherited from a parent process, every handle is
+        rebuilt on a fresh client.
         """
-        retries = retries
+        # Other threads may invalidate() at any time: work on a local
+        # reference, and publish a rebuilt dict in a single assignment
+        handles = self._handles
+        entry = self._entry
+        if 'database' not in handles or entry is None or not entry.alive \
+                or entry.pid != current_pid():
+            self.invalidate()
+            handles = {'database': self._connect_to_db()}
+            self._handles = handles
+        else:
+            entry.touch()
 
         try:
-            # Establish a Connection
-            connection = pymongo.Connection(self.host, self.port, **self.options)
+            return handles[key]
+        except KeyError:
+            handle = handles[key] = factory(handles['database'])
+            return handle
 
-            # Establish a database
-            database = connection[self.db]
+    def get_database(self):
+        """
+        Return the (cached) pymongo database this connection uses, connecting
+        and authenticating first if needed.
+        """
+        return self._handle('database', None)
 
-            # If user passed username and password args, give that to authenticate
-            if self.username and self.password:
-                database.authenticate(self.username, self.password)
+    def invalidate(self, discard=False):
+        """
+        Forget every cached database, collection and GridFS handle, so the
+        next access builds them again.
 
-        # Handle the following exceptions, if retries is less than what is
-        # passed into this method, attempt to connect again.  Otherwise,
-        # raise the proper exception.
-        except AutoReconnect as error_message:
-            time.sleep(2)
-            retries += 1
+        If ``discard`` is true, the pooled client is also closed and dropped
+        from the pool, which invalidates the handles of every other
+        connection sharing it.
+        """
+        entry = self._entry
+        self._entry = None
+        self._handles = {}
+        if discard and entry is not None:
+            self.pool.discard(entry)
+
+    def _connect_to_db(self):
+        """
+        Connect to the database, but do not initialize a connection.
 
-            if retries <= self.max_retries:
-                self._connect_to_db(retries=retries)
-            else:
-                raise ConnectionFailure('Max number of retries (%s) reached. Error: %s'\
-                                         % (self.max_retries, error_message))
+        Depending on which public method is used, it initiates either a standard
+            mongo connection or a gridfs connection
+        """
+        # Handle the following exceptions with the retry policy: if it allows
+        # another attempt, drop the failed client and connect again.
+        # Otherwise, raise the proper exception.
+        try:
+            return self.retry_policy.call('connect', self._checkout,
+                                          retry_on=(AutoReconnect, OperationFailure),
+                                          on_retry=self._on_connect_retry)
+        except AutoReconnect as error_message:
+            raise ConnectionFailure('Max number of retries (%s) reached. Error: %s'\
+                                     % (self.retry_policy.max_retries, error_message))
 
         except OperationFailure as error_message:
-            time.sleep(2)
-            retries += 1
+            raise OperationFailure('Max number of retries (%s) reached. Error: %s'\
+                                     % (self.retry_policy.max_retries, error_message))
+
+    def _checkout(self):
+        """
+        Check a client out of the pool and return the configured database.
+        """
+        # Check a client out of the pool, creating it on first use
+        entry = self.pool.get(self.host, self.port,
+                              username=self.username,
+                              password=self.password,
+                              **self.options)
+
+        # Establish a database
+        database = entry.client[self.db]
+
+        # If user passed username and password args, authenticate once
+        # per pooled client
+        if self.username and self.password:
+            self.pool.authenticate(entry, database, self.username, self.password)
 
-            if retries <= self.max_retries:
-                self._connect_to_db(retries=retries)
-            else:
-                raise OperationFailure('Max number of retries (%s) reached. Error: %s'\
-                                         % (self.max_retries, error_message))
+        self._entry = entry
 
         return database
 
-    def _check_mode(self, mode):
+    def _on_connect_retry(self, error):
+        if isinstance(error, AutoReconnect):
+            self.invalidate(discard=True)
+
+    def add_write_listener(self, listener):
+        """
+        Call ``listener(collection, ids)`` after every write made through
+        this connection. ``ids`` lists the ``_id`` of every document written,
+        or is ``None`` if any document of the collection may have changed.
+        ``collection`` is ``None`` if every collection may have changed.
+        """
+        self._write_listeners.append(listener)
+
+    def remove_write_listener(self, listener):
+        self._write_listeners.remove(listener)
+
+    def notify_write(self, collection, ids=None):
+        """
+        Tell the write listeners (caches, mostly) that documents of
+        ``collection`` (every collection if ``None``) changed. Writes made
+        through this connection's collections call this on their own; call it
+        for writes made elsewhere.
+        """
+        identity.invalidate(collection)
+        for listener in self._write_listeners:
+            listener(collection, ids)
+
+    def _check_mode(self, mode, collection):
         """
         Check mode is a failsafe designed to prevent bad operations from happening.
 
         Because pymongo (and MongoDB) can be finnicky when using a standard query
         to access a gridfs collection and visa versa, we put in a check that once
-        a connection is made, it can only be that type of connection.
+        a collection is used as a GridFS bucket (``mode`` 'gridfs'), neither it
+        nor its ``.files`` and ``.chunks`` collections can be used through the
+        collection API (``mode`` 'api'), and the other way around. Other
+        collections of the same connection can still be used either way.
         """
-        if not self._mode:
-            raise DoesNotExist("The mode does not exist, most likely because this\
-                                was subclassed improperly.")
-        if mode is not self._mode:
-            raise InvalidMode(".The mode set does not match the mode requested. \n\
-                                This connection object already used `%s`" % mode)
+        if mode == 'api':
+            bucket = collection
+            for suffix in ('.files', '.chunks'):
+                if collection.endswith(suffix):
+                    bucket = collection[:-len(suffix)]
+            if collection in self._buckets or bucket in self._buckets:
+                raise InvalidMode("`%s` is already used as a GridFS bucket by this\
+                                   connection object." % bucket)
+            self._api_collections.add(collection)
+
+        elif mode == 'gridfs':
+            names = set([collection, collection + '.files', collection + '.chunks'])
+            if names & self._api_collections:
+                raise InvalidMode("`%s` is already used through the collection API\
+                                   by this connection object." % collection)
+            self._buckets.add(collection)
+
+        else:
+            raise DoesNotExist("The mode `%s` does not exist, most likely because\
+                                this was subclassed improperly." % mode)
 
     def _connect(self, collection=None):
         """
         Connect to the mongo instance
         """
-        self._check_mode('api')
+        if not collection:
+            collection = self.collection
+
+        self._check_mode('api', collection)
 
-        database = self._connect_to_db()
+        return self._handle(('collection', collection),
+                            lambda database: CollectionProxy(database[collection], self))
 
+    def _read_preference_collection(self, collection):
+        """
+        Return ``collection`` set to read from secondaries, with the
+        configured staleness and tag sets, falling back to the primary when
+        no secondary is available.
+        """
+        if SecondaryPreferred is not None:
+            options = {}
+            if self.read_tag_sets is not None:
+                options['tag_sets'] = self.read_tag_sets
+            if self.read_max_staleness is not None:
+                options['max_staleness'] = self.read_max_staleness
+            return collection.with_options(read_preference=SecondaryPreferred(**options))
+
+        collection.read_preference = ReadPreference.SECONDARY_PREFERRED
+        if self.read_tag_sets is not None:
+            collection.tag_sets = self.read_tag_sets
+        return collection
+
+    def _read_connect(self, collection=None):
+        """
+        Connect to the mongo instance, for reads from secondaries
+        """
         if not collection:
             collection = self.collection
 
-        collection = database[collection]
+        self._check_mode('api', collection)
 
-        return collection
+        return self._handle(('read', collection),
+                            lambda database: CollectionProxy(
+                                self._read_preference_collection(database[collection]),
+                                self))
 
-    def _gridfs(self):
+    def _gridfs(self, collection=None):
         """
         A module to connect to GridFS and chunk large files for saving into mongo
         """
-        self._check_mode('gridfs')
+        if not collection:
+            collection = self.collection
 
-        database = self._connect_to_db()
+        self._check_mode('gridfs', collection)
 
-        grid = GridFS(database, collection=self.collection)
+        grid = self._handle(('gridfs', collection),
+                            lambda database: GridFS(database, collection=collection))
 
         return grid
 
@@ -245,12 +448,153 @@ class Connection(BaseConnection):
 
     @property
     def api(self):
-        if not self._mode:
-            self._mode = 'api'
         return(self._connect())
 
+    @property
+    def read_api(self):
+        """
+        The collection, routed to secondaries for reads.  ``api`` keeps the
+        client's read preference (the primary, by default), and every write
+        goes to the primary whichever one is used.
+        """
+        return(self._read_connect())
+
+    @property
+    def read(self):
+        """
+        Attribute and item access to any collection, routed to secondaries
+        for reads.
+
+        ::
+
+            my_connection_obj.read.my_collection.find()
+            my_connection_obj.read['my_collection'].find()
+        """
+        return(ReadRouter(self))
+
     @property
     def fs(self):
-        if not self._mode:
-            self._mode = 'gridfs'
         return(self._gridfs())
+
+    def bucket(self, name):
+        """
+        Return the GridFS bucket ``name``, on the same client as the
+        connection's collections.
+
+        ::
+
+            my_connection.bucket('thumbnails').put(data, filename='palm.png')
+        """
+        return(self._gridfs(collection=name))
+
+    def bulk(self, collection=None, **kwargs):
+        """
+        Return a :class:`BulkWriter <mongolier.bulk.BulkWriter>` that batches
+        writes to ``collection`` (the connection's collection by default).
+
+        ::
+
+            with my_connection.bulk(batch_size=500) as bulk:
+                for document in documents:
+                    bulk.insert(document)
+        """
+        collection = self._connect(collection=collection)
+
+        if bulk_module.InsertOne is None:
+            # The bulk builder of pymongo < 3.0 writes behind the collection
+            # proxy's back, so report the writes here
+            on_flush = kwargs.pop('on_flush', None)
+
+            def notify(operations, result):
+                self.notify_write(collection.name)
+                if on_flush is not None:
+                    on_flush(operations, result)
+
+            kwargs['on_flush'] = notify
+
+        return(bulk_module.BulkWriter(collection, **kwargs))
+
+    def storage(self, bucket=None, **kwargs):
+        """
+        Return a :class:`DedupStorage <mongolier.storage.DedupStorage>` that
+        stores each distinct file once in the GridFS ``bucket`` (the
+        connection's collection by default), uploading chunks in parallel.
+
+        ::
+
+            file_id = my_connection.storage(bucket='media').put(upload, filename='palm.jpg')
+        """
+        return(DedupStorage(self, bucket=bucket, **kwargs))
+
+    def write_behind(self, **kwargs):
+        """
+        Return this connection's :class:`WriteBehindQueue
+        <mongolier.writebehind.WriteBehindQueue>`, creating it with
+        ``kwargs`` on the first call.
+
+        ::
+
+            my_connection.write_behind(when_full='drop').insert('page_views', view)
+        """
+        if self._write_behind is None:
+            self._write_behind = WriteBehindQueue(self, **kwargs)
+        return(self._write_behind)
+
+    def increments(self, **kwargs):
+        """
+        Return this connection's :class:`IncrementAggregator
+        <mongolier.counters.IncrementAggregator>`, creating it with
+        ``kwargs`` on the first call.
+
+        ::
+
+            my_connection.increments().incr('articles', article_id, 'views')
+        """
+        if self._increments is None:
+            self._increments = IncrementAggregator(self, **kwargs)
+        return(self._increments)
+
+    def cached(self, ttl=60, collection=None, cache='default'):
+        """
+        Return a :class:`CachedCollection <mongolier.cache.CachedCollection>`
+        that keeps the results of ``find_one``, ``find`` and ``count`` in the
+        Django cache named ``cache`` for ``ttl`` seconds. Writes made through
+        this connection invalidate them.
+
+        ::
+
+            my_connection.cached(ttl=300).find_one({'slug': 'palm'})
+        """
+        # Imported here, so that Connection works without Django configured
+        from mongolier.cache import CachedCollection, QueryCache
+
+        collection = collection or self.collection
+        self._check_mode('api', collection)
+
+        key = cache if isinstance(cache, basestring) else id(cache)
+        query_cache = self._query_caches.get(key)
+        if query_cache is None:
+            query_cache = self._query_caches[key] = QueryCache(self, cache)
+
+        return(CachedCollection(self, collection, query_cache, ttl=ttl))
+
+
+class ReadRouter(object):
+    """
+    Generic collection access, like that of a
+    :class:`Connection <Connection>`, but reading from secondaries.
+    """
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getattr__(self, collection):
+        if collection.startswith('__'):
+            raise AttributeError(collection)
+        return(self[collection])
+
+    def __getitem__(self, collection):
+        connection = self._connection
+        if connection.override:
+            connection.collection = collection
+
+        return(connection._read_connect(collection=collection))
@@ -0,0 +1,188 @@
+"""
+documents.py
+
+An in-process cache of documents by ``_id``, for the handful of documents
+that are fetched over and over by detail pages and API lookups.
+
+::
+
+    cache = DocumentCache(max_entries=5000, max_bytes=50 * 1024 * 1024, ttl=300)
+    my_connection = Connection(collection='articles', document_cache=cache)
+
+    my_connection.api.find_one(article_id)           # from the database
+    my_connection.api.find_one({'_id': article_id})  # from the cache
+
+    cache.stats()
+    # {'hits': 1, 'misses': 1, 'entries': 1, 'bytes': 1274, ...}
+
+Only ``find_one`` lookups by a plain ``_id`` (no projection, sort or skip) on
+collections read from the primary are cached. Writes made through the same
+connection drop the documents they touch; writes made elsewhere are only
+seen once the entry's ``ttl`` expires.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from bson import BSON
+    _encode = BSON.encode
+
+    def _decode(data):
+        return BSON(data).decode()
+except ImportError:
+    from bson import decode as _decode, encode as _encode
+
+
+class DocumentCache(object):
+    """
+    A thread-safe LRU cache of documents, keyed by ``(collection, _id)``,
+    where ``collection`` is the full ``database.collection`` name.
+
+    Documents are kept encoded as BSON, so that every hit hands out a fresh
+    copy and the memory they take can be counted. The least recently used
+    documents are evicted once the cache holds ``max_entries`` documents or
+    ``max_bytes`` bytes of BSON; entries older than ``ttl`` seconds are never
+    returned (``None`` to keep them until evicted).
+    """
+    def __init__(self, max_entries=1000, max_bytes=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        # (collection, _id) -> (stored at, BSON)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # Bumped by clear(), per database by invalidate_database(), and per
+        # collection by invalidate()
+        self._epoch = 0
+        self._database_generations = {}
+        self._generations = {}
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, collection, _id):
+        """
+        Return a copy of the cached document, or ``None`` on a miss.
+        """
+        key = (collection, _id)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and self.ttl is not None \
+                    and time.time() - entry[0] > self.ttl:
+                self._bytes -= len(entry[1])
+                entry = None
+
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+
+            # Move it to the most recently used end
+            self._entries[key] = entry
+            self._stats['hits'] += 1
+
+        return _decode(entry[1])
+
+    def generation(self, collection):
+        """
+        A value that changes with every invalidation of ``collection``. Read
+        it before fetching a document and pass it to :meth:`set <set>`, so
+        that a document a concurrent write made stale is not cached. Writes
+        to other collections leave it alone.
+        """
+        database = collection.partition('.')[0]
+        return (self._epoch,
+                self._database_generations.get(database, 0),
+                self._generations.get(collection, 0))
+
+    def set(self, collection, _id, document, generation=None):
+        """
+        Cache ``document`` as the document ``_id`` of ``collection``, unless
+        the cache was invalidated since ``generation``.
+        """
+        data = _encode(document)
+        if self.max_bytes is not None and len(data) > self.max_bytes:
+            return
+
+        key = (collection, _id)
+        with self._lock:
+            if generation is not None and generation != self.generation(collection):
+                return
+
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous[1])
+
+            self._entries[key] = (time.time(), data)
+            self._bytes += len(data)
+
+            while len(self._entries) > self.max_entries \
+                    or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, collection, ids=None):
+        """
+        Drop the documents ``ids`` of ``collection``, or every document of
+        ``collection`` if ``ids`` is ``None``. Fits :meth:`add_write_listener
+        <mongolier.db.BaseConnection.add_write_listener>`.
+        """
+        with self._lock:
+            self._generations[collection] = self._generations.get(collection, 0) + 1
+            if ids is None:
+                keys = [key for key in self._entries if key[0] == collection]
+            else:
+                keys = [(collection, _id) for _id in ids]
+            self._drop(keys)
+
+    def invalidate_database(self, database):
+        """
+        Drop the documents of every collection of ``database``.
+        """
+        prefix = database + '.'
+        with self._lock:
+            self._database_generations[database] = \
+                self._database_generations.get(database, 0) + 1
+            self._drop([key for key in self._entries if key[0].startswith(prefix)])
+
+    def _drop(self, keys):
+        for key in keys:
+            try:
+                entry = self._entries.pop(key, None)
+            except TypeError:
+                # An unhashable _id can't have been cached
+                continue
+            if entry is not None:
+                self._bytes -= len(entry[1])
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        """
+        Drop every document.
+        """
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Return the hit, miss, eviction and invalidation counters, and the
+        number of documents and bytes cached.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = float(stats['hits']) / lookups if lookups else None
+        return stats
@@ -0,0 +1,229 @@
+"""
+filecache.py
+
+A local disk cache of GridFS files, for the files that are read over and over.
+
+::
+
+    file_cache = GridFSFileCache('/var/cache/my_app/gridfs', max_bytes=2 * 1024 ** 3)
+
+    grid_file = my_connection.fs.get(file_id)
+    with file_cache.open(grid_file) as local_file:
+        ...
+    data = file_cache.mmap(grid_file)
+
+Files are keyed by a hash of their ``_id`` and md5, so a file replaced under the same
+``_id`` is fetched again. Each file is downloaded once, to a temporary file
+renamed into place, so that readers never see a partial file. The least
+recently used files are deleted once the cache holds more than ``max_bytes``.
+
+:class:`GridFSFileView <mongolier.views.GridFSFileView>` serves from it with
+``file_cache = GridFSFileCache(...)``.
+"""
+import calendar
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from mongolier.exceptions import IncorrectParameters
+
+_TEMPORARY_PREFIX = '.download-'
+
+
+class GridFSFileCache(object):
+    """
+    A size-bounded, least recently used cache of GridFS files in
+    ``directory``.
+
+    The recency and size of the files are tracked per process. Several
+    processes can share a directory: each one reuses the files the others
+    downloaded, but only counts the ones it knows of towards ``max_bytes``.
+    """
+    def __init__(self, directory, max_bytes=1024 ** 3):
+        if max_bytes <= 0:
+            raise IncorrectParameters('max_bytes must be positive')
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        # key -> size, least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._scan()
+
+    def _scan(self):
+        """
+        Pick up the files already in the directory, oldest access first.
+        """
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(_TEMPORARY_PREFIX):
+                # Left over by a download that was interrupted
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            found.append((stat.st_atime, name, stat.st_size))
+
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._bytes += size
+        self._evict()
+
+    @staticmethod
+    def key(grid_file):
+        """
+        The name of the local copy of ``grid_file``.
+        """
+        version = getattr(grid_file, 'md5', None)
+        if version is None:
+            # md5 may be disabled in pymongo 3.7+
+            version = '%s-%s' % (grid_file.length,
+                                 calendar.timegm(grid_file.upload_date.utctimetuple()))
+        # _ids may be any string, e.g. '../../etc/passwd': never use them
+        # in a path as they are
+        return hashlib.sha1(repr((grid_file._id, version)).encode('utf-8')).hexdigest()
+
+    def path(self, grid_file, download=True):
+        """
+        Return the path of the local copy of ``grid_file``, downloading it
+        first if needed, or ``None`` if it is too large to be cached. Without
+        ``download``, a file that is not cached yet gives ``None`` too.
+        """
+        if grid_file.length > self.max_bytes:
+            return None
+
+        key = self.key(grid_file)
+        path = os.path.join(self.directory, key)
+
+        with self._lock:
+            if key in self._entries:
+                if os.path.exists(path):
+                    self._entries[key] = self._entries.pop(key)
+                    self._stats['hits'] += 1
+                    return path
+                # Evicted by another process
+                self._bytes -= self._entries.pop(key)
+
+        if os.path.exists(path):
+            # Downloaded by another process
+            with self._lock:
+                self._stats['hits'] += 1
+                self._add(key, os.path.getsize(path))
+            return path
+
+        if not download:
+            return None
+
+        with self._lock:
+            self._stats['misses'] += 1
+        self._download(grid_file, path)
+        with self._lock:
+            self._add(key, grid_file.length)
+        return path
+
+    def _download(self, grid_file, path):
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, prefix=_TEMPORARY_PREFIX)
+        try:
+            with os.fdopen(descriptor, 'wb') as local_file:
+                grid_file.seek(0)
+                while True:
+                    data = grid_file.read(grid_file.chunk_size)
+                    if not data:
+                        break
+                    local_file.write(data)
+            os.rename(temporary, path)
+        except Exception:
+            os.unlink(temporary)
+            raise
+        finally:
+            grid_file.seek(0)
+
+    def _add(self, key, size):
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)
+        self._entries[key] = size
+        self._bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self._stats['evictions'] += 1
+            try:
+                # Readers that already opened it keep reading it
+                os.unlink(os.path.join(self.directory, key))
+            except OSError:
+                pass
+
+    def open(self, grid_file, download=True):
+        """
+        Return the local copy of ``grid_file`` opened for reading, or
+        ``None`` if it is too large to be cached (or not cached yet, without
+        ``download``).
+        """
+        path = self.path(grid_file, download)
+        if path is None:
+            return None
+        try:
+            return open(path, 'rb')
+        except IOError:
+            # Evicted between path() and open(): download it again
+            with self._lock:
+                self._bytes -= self._entries.pop(self.key(grid_file), 0)
+            path = self.path(grid_file, download)
+            if path is None:
+                return None
+            return open(path, 'rb')
+
+    def mmap(self, grid_file):
+        """
+        Return the content of ``grid_file`` as a read-only memory map of its
+        local copy, or ``None`` if it is too large to be cached or empty.
+        """
+        local_file = self.open(grid_file)
+        if local_file is None:
+            return None
+        with local_file:
+            if not grid_file.length:
+                return None
+            return mmap.mmap(local_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def clear(self):
+        """
+        Delete every file this process knows of.
+        """
+        with self._lock:
+            for key in self._entries:
+                try:
+                    os.unlink(os.path.join(self.directory, key))
+                except OSError:
+                    pass
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['files'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        return stats
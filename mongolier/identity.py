@@ -0,0 +1,152 @@
+"""
+identity.py
+
+A per-context identity map of read results: per thread, and per asyncio task
+on Python 3.7 and later. While one is active, running the same ``find_one``,
+``count`` or ``distinct`` twice on a collection only goes to the database
+once; writes made through mongolier clear the collection's results.
+
+Django projects activate it for each request with :class:`IdentityMapMiddleware
+<mongolier.middleware.IdentityMapMiddleware>`. Elsewhere (tasks, scripts):
+
+::
+
+    with identity_map():
+        article = my_connection.api.find_one({'slug': 'palm'})
+        ...
+        article = my_connection.api.find_one({'slug': 'palm'})  # no round-trip
+
+Every lookup hands out a deep copy, so that changing a document fetched once
+does not change what the next lookup returns.
+"""
+import copy
+import json
+import threading
+from contextlib import contextmanager
+
+from bson import json_util
+
+#: The read operations whose results are memoized
+IDENTITY_OPERATIONS = frozenset(['find_one', 'count', 'count_documents', 'distinct'])
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # Python < 3.7
+    ContextVar = None
+
+if ContextVar is not None:
+    # Kept apart per thread, and per asyncio task
+    _current = ContextVar('mongolier_identity_map', default=None)
+
+    def _get():
+        return _current.get()
+
+    def _set(identity_map):
+        _current.set(identity_map)
+else:
+    _state = threading.local()
+
+    def _get():
+        return getattr(_state, 'identity_map', None)
+
+    def _set(identity_map):
+        _state.identity_map = identity_map
+
+#: Returned by :meth:`IdentityMap.get` when nothing is stored
+MISSING = object()
+
+
+class IdentityMap(object):
+    """
+    Read results, by collection and by query.
+    """
+    def __init__(self):
+        # collection name -> {(full name, operation, arguments): result}
+        self._results = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(full_name, operation, args, kwargs, primary=True):
+        """
+        The key of a read, or ``None`` if its arguments can't be serialized.
+        """
+        try:
+            arguments = json.dumps([args, kwargs], sort_keys=True,
+                                   default=json_util.default)
+        except (TypeError, ValueError):
+            return None
+        return (full_name, operation, arguments, primary)
+
+    def get(self, name, key):
+        """
+        Return a copy of the result stored under ``key`` for the collection
+        ``name``, or :data:`MISSING`.
+        """
+        result = self._results.get(name, {}).get(key, MISSING)
+        if result is MISSING:
+            self.misses += 1
+            return result
+        self.hits += 1
+        return copy.deepcopy(result)
+
+    def set(self, name, key, result):
+        self._results.setdefault(name, {})[key] = copy.deepcopy(result)
+
+    def invalidate(self, name=None):
+        """
+        Forget the results read from the collection ``name``, or every result.
+        """
+        if name is None:
+            self._results.clear()
+        else:
+            self._results.pop(name, None)
+
+    def __len__(self):
+        return sum(len(results) for results in self._results.values())
+
+
+def get_identity_map():
+    """
+    Return the identity map active in this context, or ``None``.
+    """
+    return _get()
+
+
+def activate():
+    """
+    Start a new identity map for this context, and return it.
+    """
+    current = IdentityMap()
+    _set(current)
+    return current
+
+
+def deactivate():
+    """
+    Drop this context's identity map.
+    """
+    _set(None)
+
+
+@contextmanager
+def identity_map():
+    """
+    Memoize reads in this context for the duration of the ``with`` block.
+    """
+    previous = get_identity_map()
+    try:
+        yield activate()
+    finally:
+        _set(previous)
+
+
+def invalidate(name=None):
+    """
+    Forget the results read from the collection ``name`` (every result if
+    ``None``) in this context's identity map, if one is active.
+    """
+    current = get_identity_map()
+    if current is not None:
+        current.invalidate(name)
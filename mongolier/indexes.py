@@ -0,0 +1,226 @@
+"""
+indexes.py
+
+Declarative indexes for :class:`MongoResource <mongolier.api.MongoResource>`.
+
+A resource lists the indexes its filters and sorts need in ``Meta.indexes``,
+and ``manage.py mongolier_syncindexes`` builds the ones that are missing.
+
+::
+
+    from mongolier.indexes import Index, TEXT
+
+    class ArticleResource(MongoResource):
+        class Meta:
+            connection = my_connection
+            indexes = [
+                'slug',                                         # {slug: 1}
+                ('site_id', '-date'),                           # compound
+                Index('created', expire_after_seconds=86400),   # TTL
+                Index([('title', TEXT), ('body', TEXT)]),       # text
+                Index('-date', partial={'published': True}),    # partial
+            ]
+
+Declared indexes are matched with the live ones by name, pymongo's generated
+name unless ``name`` is given. A live index of the same name but with other
+keys or options is only dropped and built again with ``drop``, which also
+drops the live indexes that no resource declares.
+"""
+from pymongo import ASCENDING, DESCENDING
+from pymongo.common import BaseObject
+
+from mongolier.db import Connection
+from mongolier.exceptions import IncorrectParameters
+from mongolier.sharding import ShardedConnection
+
+TEXT = 'text'
+
+# The options compared with the live index, as they are named there
+_COMPARED_OPTIONS = ('unique', 'sparse', 'expireAfterSeconds', 'partialFilterExpression')
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+def _normalize_key(key):
+    if isinstance(key, basestring):
+        if key.startswith('-'):
+            return (key[1:], DESCENDING)
+        return (key, ASCENDING)
+    if isinstance(key, (list, tuple)) and len(key) == 2:
+        return (key[0], key[1])
+    raise IncorrectParameters('Invalid index key: %r' % (key,))
+
+
+def normalize_keys(keys):
+    """
+    Turn ``'-date'``, ``('site_id', '-date')`` or ``[('title', 'text')]`` into
+    a list of ``(key, direction)``.
+    """
+    if isinstance(keys, basestring):
+        keys = [keys]
+    keys = [_normalize_key(key) for key in keys]
+    if not keys:
+        raise IncorrectParameters('An index needs at least one key.')
+    return keys
+
+
+class Index(object):
+    """
+    An index on ``keys`` (see :func:`normalize_keys <normalize_keys>`).
+
+    ``expire_after_seconds`` makes it a TTL index and ``partial`` a partial
+    index on the documents matching that query. Other keyword arguments,
+    such as ``weights`` or ``default_language``, go to ``create_index`` as
+    they are.
+    """
+    def __init__(self, keys, name=None, unique=False, sparse=False,
+                 expire_after_seconds=None, partial=None, **options):
+        self.keys = normalize_keys(keys)
+        self.name = name or '_'.join('%s_%s' % key for key in self.keys)
+
+        self.options = dict(options)
+        if unique:
+            self.options['unique'] = True
+        if sparse:
+            self.options['sparse'] = True
+        if expire_after_seconds is not None:
+            self.options['expireAfterSeconds'] = expire_after_seconds
+        if partial is not None:
+            self.options['partialFilterExpression'] = partial
+
+    @classmethod
+    def coerce(cls, spec):
+        """
+        The Index declared by an entry of ``Meta.indexes``: an Index, a dict
+        of its arguments, or its keys.
+        """
+        if isinstance(spec, cls):
+            return spec
+        if isinstance(spec, dict):
+            return cls(**spec)
+        return cls(spec)
+
+    @property
+    def text_keys(self):
+        return sorted(key for key, direction in self.keys if direction == TEXT)
+
+    def differs(self, info):
+        """
+        Whether the live index described by ``info`` (an entry of
+        ``index_information()``) has other keys or options.
+        """
+        text_keys = self.text_keys
+        if text_keys:
+            # Text keys are stored as _fts/_ftsx, the fields are the weights
+            if sorted(info.get('weights', {})) != text_keys:
+                return True
+        elif [tuple(key) for key in info['key']] != self.keys:
+            return True
+
+        for option in _COMPARED_OPTIONS:
+            declared, live = self.options.get(option), info.get(option)
+            if option in ('unique', 'sparse'):
+                declared, live = bool(declared), bool(live)
+            if declared != live:
+                return True
+        return False
+
+    def create(self, collection, background=False):
+        options = dict(self.options)
+        if background:
+            options['background'] = True
+        return collection.create_index(self.keys, name=self.name, **options)
+
+    def __eq__(self, other):
+        return isinstance(other, Index) and \
+            (self.name, self.keys, self.options) == (other.name, other.keys, other.options)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Index(%r, name=%r)' % (self.keys, self.name)
+
+
+def merge_indexes(specs):
+    """
+    The Index of each entry of ``specs``, without repeats. Raises
+    ``IncorrectParameters`` if two different indexes have the same name.
+    """
+    indexes = []
+    by_name = {}
+    for spec in specs:
+        index = Index.coerce(spec)
+        if index.name in by_name:
+            if by_name[index.name] != index:
+                raise IncorrectParameters('Conflicting declarations of index %s.' % index.name)
+            continue
+        by_name[index.name] = index
+        indexes.append(index)
+    return indexes
+
+
+def collections_for(connection):
+    """
+    The pymongo collections behind a resource's connection: one per cluster
+    for a :class:`ShardedConnection <mongolier.sharding.ShardedConnection>`.
+    """
+    if isinstance(connection, BaseObject):
+        return [connection]
+    if isinstance(connection, Connection):
+        return [connection.get_database()[connection.collection]]
+    if isinstance(connection, ShardedConnection):
+        return [shard.get_database()[connection.collection]
+                for shard in connection.connections]
+    raise IncorrectParameters('Cannot index the collection of %r.' % (connection,))
+
+
+def diff_indexes(collection, indexes):
+    """
+    Compare ``indexes`` with the live indexes of ``collection``. Returns
+    ``(missing, changed, extra)``: the declared indexes that do not exist,
+    the declared indexes that differ from the live index of the same name,
+    and the names of the live indexes that are not declared (``_id_`` aside).
+    """
+    indexes = merge_indexes(indexes)
+    live = collection.index_information()
+
+    missing = [index for index in indexes if index.name not in live]
+    changed = [index for index in indexes
+               if index.name in live and index.differs(live[index.name])]
+    declared = set(index.name for index in indexes)
+    extra = sorted(name for name in live if name != '_id_' and name not in declared)
+    return missing, changed, extra
+
+
+def sync_indexes(collection, indexes, drop=False, background=False, dry_run=False):
+    """
+    Build the ``indexes`` missing from ``collection``, in the background if
+    ``background`` is true. With ``drop``, the live indexes that differ from
+    their declaration are built again and the undeclared ones dropped.
+
+    Returns the actions taken, or that would be taken with ``dry_run``, as a
+    list of ``(action, name)``: ``'drop'``, ``'create'``, or ``'conflict'``
+    for an index that differs but was left alone.
+    """
+    missing, changed, extra = diff_indexes(collection, indexes)
+
+    actions = []
+    dropped = []
+    if drop:
+        dropped = extra + [index.name for index in changed]
+        missing = changed + missing
+    else:
+        actions.extend(('conflict', index.name) for index in changed)
+    actions.extend(('drop', name) for name in dropped)
+    actions.extend(('create', index.name) for index in missing)
+
+    if not dry_run:
+        for name in dropped:
+            collection.drop_index(name)
+        for index in missing:
+            index.create(collection, background=background)
+    return actions
@@ -0,0 +1,187 @@
+"""
+instrumentation.py
+
+Per-collection, per-operation counters and latency histograms, and a log of
+slow queries, for the operations run through a
+:class:`Connection <mongolier.db.Connection>`.
+
+::
+
+    from mongolier.instrumentation import Instrumentation
+
+    instrumentation = Instrumentation(slow_threshold=0.05, explain_threshold=0.5)
+    my_connection = Connection(db='my_db', instrumentation=instrumentation)
+
+    instrumentation.stats()['articles']['find']
+    # {'count': 1204, 'errors': 0, 'total': 3.21, 'min': 0.0004, 'max': 0.31,
+    #  'buckets': [(0.001, 880), (0.005, 1101), ...]}
+
+    instrumentation.slow_queries()
+    # [{'collection': 'articles', 'operation': 'find', 'duration': 0.31,
+    #   'shape': '{"tags": {"$in": "?"}}', 'timestamp': ..., 'explain': {...}}]
+"""
+import bisect
+import json
+import threading
+import time
+from collections import deque
+
+#: Upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def normalize(query):
+    """
+    Replace every value in ``query`` with ``'?'``, keeping the field names and
+    operators, so that queries that only differ by their values share a shape.
+    """
+    if isinstance(query, dict):
+        return dict((key, normalize(value)) for key, value in query.items())
+    if isinstance(query, (list, tuple)) and query \
+        and all(isinstance(item, dict) for item in query):
+        # $and, $or and $nor clauses
+        return [normalize(item) for item in query]
+    return '?'
+
+
+def query_shape(query):
+    """
+    Return the normalized shape of ``query`` as a stable string.
+    """
+    if query is None:
+        return None
+    return json.dumps(normalize(query), sort_keys=True)
+
+
+class Histogram(object):
+    """
+    A latency histogram with fixed bucket boundaries.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, duration, error=False):
+        self.counts[bisect.bisect_left(self.buckets, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if error:
+            self.errors += 1
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+
+    def snapshot(self):
+        """
+        Return the histogram as a dictionary. ``buckets`` holds cumulative
+        ``(upper bound, count)`` pairs, the last bound being ``inf``.
+        """
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            running += count
+            cumulative.append((bound, running))
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+            'buckets': cumulative,
+        }
+
+
+class Instrumentation(object):
+    """
+    Collects timings for a connection's operations.
+
+    Operations that take at least ``slow_threshold`` seconds are added to a
+    log of the last ``slow_log_size`` slow queries. If ``explain_threshold``
+    is set, the ``explain()`` output of queries slower than that is captured
+    too (this runs the query a second time).
+    """
+    def __init__(self,
+                slow_threshold=0.1,
+                slow_log_size=100,
+                explain_threshold=None,
+                buckets=DEFAULT_BUCKETS):
+        #: Seconds after which an operation is logged as slow
+        self.slow_threshold = slow_threshold
+
+        #: Seconds after which a slow query's ``explain()`` is captured,
+        #: ``None`` to never capture it
+        self.explain_threshold = explain_threshold
+
+        self.buckets = buckets
+
+        self._histograms = {}
+        self._slow = deque(maxlen=slow_log_size)
+        self._lock = threading.Lock()
+
+    def record(self, collection, operation, duration, query=None, error=False,
+               explain=None):
+        """
+        Record one operation. ``explain`` is a callable returning the
+        query's ``explain()`` output; it is only called for queries above
+        ``explain_threshold``.
+        """
+        key = (collection, operation)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(duration, error=error)
+
+        if self.slow_threshold is None or duration < self.slow_threshold:
+            return
+
+        entry = {
+            'collection': collection,
+            'operation': operation,
+            'duration': duration,
+            'shape': query_shape(query),
+            'timestamp': time.time(),
+            'error': error,
+            'explain': None,
+        }
+        if explain is not None and not error \
+            and self.explain_threshold is not None \
+            and duration >= self.explain_threshold:
+            try:
+                entry['explain'] = explain()
+            except Exception as explain_error:
+                entry['explain'] = {'error': str(explain_error)}
+
+        with self._lock:
+            self._slow.append(entry)
+
+    def stats(self):
+        """
+        Return the histograms, as ``{collection: {operation: histogram}}``.
+        """
+        stats = {}
+        with self._lock:
+            for (collection, operation), histogram in self._histograms.items():
+                stats.setdefault(collection, {})[operation] = histogram.snapshot()
+        return stats
+
+    def slow_queries(self):
+        """
+        Return the slow query log, oldest first.
+        """
+        with self._lock:
+            return list(self._slow)
+
+    def reset(self):
+        """
+        Clear the histograms and the slow query log.
+        """
+        with self._lock:
+            self._histograms = {}
+            self._slow.clear()
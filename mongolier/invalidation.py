@@ -0,0 +1,358 @@
+"""
+invalidation.py
+
+Cache invalidation for writes that do not go through mongolier.
+
+Writes made through a connection are reported to its caches as they
+happen (see :meth:`notify_write <mongolier.db.BaseConnection.notify_write>`).
+Writes made by other services or other processes are not.
+:class:`InvalidationWorker <InvalidationWorker>` follows the database's
+change stream, or its oplog on servers without change streams, and reports
+every change it sees to the same listeners:
+
+::
+
+    cache = DocumentCache(max_entries=5000)
+    my_connection = Connection(db='my_db', document_cache=cache)
+
+    worker = InvalidationWorker(my_connection,
+                                collections=['articles', 'authors'],
+                                token_store=FileTokenStore('/var/run/my_app/resume-token'))
+    worker.start()
+
+Both need a replica set (a single node one will do). Where the worker stopped
+is saved in its token store, so after a restart it resumes from there instead
+of missing the changes made in between.
+"""
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from bson import json_util
+from pymongo.database import Database
+from pymongo.errors import PyMongoError
+
+try:
+    from pymongo import CursorType
+    _TAILABLE_AWAIT = {'cursor_type': CursorType.TAILABLE_AWAIT}
+except ImportError:
+    # pymongo < 3.0
+    _TAILABLE_AWAIT = {'tailable': True, 'await_data': True}
+
+from mongolier.pool import register_after_fork
+
+logger = logging.getLogger(__name__)
+
+#: Change stream events that change one document
+DOCUMENT_EVENTS = frozenset(['insert', 'update', 'replace', 'delete'])
+
+
+class FileTokenStore(object):
+    """
+    Keeps the resume token in a file, rewritten atomically.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as token_file:
+                return json_util.loads(token_file.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, token):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, path = tempfile.mkstemp(dir=directory, prefix='.mongolier-token-')
+        try:
+            with os.fdopen(descriptor, 'w') as token_file:
+                token_file.write(json_util.dumps(token))
+            os.rename(path, self.path)
+        except Exception:
+            os.unlink(path)
+            raise
+
+
+class CollectionTokenStore(object):
+    """
+    Keeps the resume token in a MongoDB collection, in the document ``name``.
+    Give each worker its own ``name``.
+    """
+    def __init__(self, collection, name='invalidation'):
+        self.collection = collection
+        self.name = name
+
+    def load(self):
+        document = self.collection.find_one({'_id': self.name})
+        return document['token'] if document else None
+
+    def save(self, token):
+        self.collection.update({'_id': self.name},
+                               {'$set': {'token': token, 'saved': time.time()}},
+                               upsert=True)
+
+
+class InvalidationWorker(object):
+    """
+    Follows the changes made to ``collections`` (every collection of the
+    connection's database if ``None``) in a daemon thread, and calls each of
+    ``listeners`` with ``(collection, ids)`` for each of them, like
+    :meth:`add_write_listener <mongolier.db.BaseConnection.add_write_listener>`
+    listeners. When the whole database is dropped, ``collection`` is
+    ``None``. ``listeners`` defaults to the connection's own
+    :meth:`notify_write <mongolier.db.BaseConnection.notify_write>`; add the
+    ``notify_write`` of other connections to invalidate their caches too.
+
+    Change streams are used when the server and pymongo support them
+    (MongoDB 4.0, pymongo 3.7), unless ``use_oplog`` is set. Otherwise, the
+    worker tails ``local.oplog.rs``.
+
+    The position reached is saved to ``token_store`` at most every
+    ``save_interval`` seconds, and when the worker stops. Without a store,
+    the worker starts from the present every time.
+    """
+    def __init__(self,
+                connection,
+                collections=None,
+                token_store=None,
+                listeners=None,
+                use_oplog=False,
+                save_interval=1.0,
+                retry_interval=1.0,
+                max_await_time=1.0):
+        self.connection = connection
+        self.collections = list(collections) if collections is not None else None
+        self.token_store = token_store
+        self.listeners = listeners if listeners is not None else [connection.notify_write]
+        self.use_oplog = use_oplog
+        self.save_interval = save_interval
+        self.retry_interval = retry_interval
+        self.max_await_time = max_await_time
+
+        self._token = token_store.load() if token_store is not None else None
+        self._saved_token = self._token
+        self._last_save = time.time()
+        self._stats = {
+            'changes': 0,
+            'errors': 0,
+            'last_error': None,
+            'source': None,
+        }
+        self._stop = threading.Event()
+        self._thread = None
+
+        register_after_fork(self)
+
+    def _after_fork(self):
+        """
+        Threads do not survive a fork: restart the worker in the child if it
+        was running in the parent.
+        """
+        was_running = self._thread is not None
+        self._stop = threading.Event()
+        self._thread = None
+        if was_running:
+            self.start()
+
+    @property
+    def token(self):
+        """
+        Where the worker is: the last change stream resume token, or
+        ``{'ts': <oplog timestamp>}``.
+        """
+        return self._token
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Start following changes in a daemon thread.
+        """
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='mongolier-invalidation')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the background thread, and save the position reached.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+        self.save()
+
+    def save(self):
+        """
+        Save the position reached to the token store.
+        """
+        token = self._token
+        if self.token_store is None or token == self._saved_token:
+            return
+        self.token_store.save(token)
+        self._saved_token = token
+        self._last_save = time.time()
+
+    def stats(self):
+        return dict(self._stats)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.follow()
+            except Exception as error:
+                logger.error('Following changes failed: %s', error)
+                self._stats['errors'] += 1
+                self._stats['last_error'] = str(error)
+                self.connection.invalidate()
+                self._stop.wait(self.retry_interval)
+
+    def follow(self):
+        """
+        Follow changes until the worker is stopped, in the current thread.
+        """
+        database = self.connection.get_database()
+        if not self.use_oplog and self._supports_change_streams(database):
+            self._stats['source'] = 'change_stream'
+            self._follow_change_stream(database)
+        else:
+            self._stats['source'] = 'oplog'
+            self._follow_oplog(database)
+
+    @staticmethod
+    def _supports_change_streams(database):
+        # Checked on the class: databases return a collection for any
+        # attribute they don't have
+        if not hasattr(Database, 'watch'):
+            return False
+        try:
+            return database.client.server_info()['versionArray'] >= [4, 0]
+        except (KeyError, PyMongoError):
+            return False
+
+    def publish(self, collection, ids=None):
+        """
+        Tell every listener that documents ``ids`` of ``collection`` (any
+        document if ``None``) changed. A ``None`` collection stands for every
+        collection of the database.
+        """
+        if self.collections is not None and collection is not None \
+                and collection not in self.collections:
+            return
+        self._stats['changes'] += 1
+        for listener in self.listeners:
+            try:
+                listener(collection, ids)
+            except Exception as error:
+                logger.error('Invalidation listener %r failed: %s', listener, error)
+
+    def _advance(self, token):
+        self._token = token
+        if time.time() - self._last_save >= self.save_interval:
+            self.save()
+
+    # Change streams (database.watch needs MongoDB 4.0 and pymongo 3.7)
+
+    def _follow_change_stream(self, database):
+        pipeline = []
+        if self.collections is not None:
+            pipeline.append({'$match': {'ns.coll': {'$in': self.collections}}})
+
+        options = {'max_await_time_ms': int(self.max_await_time * 1000)}
+        if self._token is None:
+            pass
+        elif 'ts' in self._token:
+            # Saved while following the oplog
+            options['start_at_operation_time'] = self._token['ts']
+        else:
+            options['resume_after'] = self._token
+
+        with database.watch(pipeline, **options) as stream:
+            while stream.alive and not self._stop.is_set():
+                change = stream.try_next()
+                if change is None:
+                    continue
+                self._on_change(change)
+                if change['operationType'] == 'invalidate':
+                    # The stream can't be resumed past this: start over from
+                    # the present, and forget the saved token, which would
+                    # replay the invalidate after a restart
+                    self._token = None
+                    self.save()
+                    return
+                self._advance(change['_id'])
+
+    def _on_change(self, change):
+        operation = change['operationType']
+        if operation in DOCUMENT_EVENTS:
+            self.publish(change['ns']['coll'], [change['documentKey']['_id']])
+        elif operation in ('drop', 'rename'):
+            self.publish(change['ns']['coll'])
+        elif operation in ('dropDatabase', 'invalidate'):
+            self.publish(None)
+
+    # The oplog
+
+    def _follow_oplog(self, database):
+        client = database.client if hasattr(Database, 'client') else database.connection
+        oplog = client.local['oplog.rs']
+        prefix = '%s.' % database.name
+
+        if self._token is not None and 'ts' in self._token:
+            timestamp = self._token['ts']
+        else:
+            # Start from the present
+            last = list(oplog.find().sort('$natural', -1).limit(1))
+            if not last:
+                raise PyMongoError('The oplog is empty, is this a replica set?')
+            timestamp = last[0]['ts']
+
+        if self.collections is not None:
+            namespaces = {'$in': [prefix + collection for collection in self.collections]
+                                 + [prefix + '$cmd']}
+        else:
+            namespaces = {'$regex': '^' + re.escape(database.name) + r'\.'}
+
+        while not self._stop.is_set():
+            cursor = oplog.find({'ts': {'$gt': timestamp}, 'ns': namespaces},
+                                oplog_replay=True, **_TAILABLE_AWAIT)
+            while cursor.alive and not self._stop.is_set():
+                # Returns once no new entry came within the server's await time
+                for entry in cursor:
+                    self._on_oplog_entry(entry, prefix)
+                    timestamp = entry['ts']
+                    self._advance({'ts': timestamp})
+                    if self._stop.is_set():
+                        break
+            # The cursor died (e.g. the oplog rolled over), query again
+            self._stop.wait(self.max_await_time)
+
+    def _on_oplog_entry(self, entry, prefix):
+        operation = entry['op']
+        collection = entry['ns'][len(prefix):]
+
+        if operation in ('i', 'd'):
+            self.publish(collection, [entry['o']['_id']])
+        elif operation == 'u':
+            self.publish(collection, [entry['o2']['_id']])
+        elif operation == 'c':
+            command = entry['o']
+            if 'drop' in command:
+                self.publish(command['drop'])
+            elif 'renameCollection' in command:
+                self.publish(command['renameCollection'][len(prefix):])
+            elif 'dropDatabase' in command:
+                self.publish(None)
+            elif 'applyOps' in command:
+                # Transactions are logged as a single applyOps entry
+                for applied in command['applyOps']:
+                    if applied['ns'].startswith(prefix):
+                        self._on_oplog_entry(applied, prefix)
@@ -0,0 +1,109 @@
+"""
+mongolier_syncindexes.py
+
+Build the indexes declared in the ``Meta.indexes`` of every MongoResource.
+
+Resources are found among the subclasses of MongoResource, once the project's
+URLconf has imported them. Resources sharing a collection are synced together,
+so that ``--drop`` only drops the indexes none of them declares.
+"""
+from importlib import import_module
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mongolier.api import MongoResource
+from mongolier.exceptions import IncorrectParameters
+from mongolier.indexes import collections_for, sync_indexes
+
+
+def resource_classes(base=MongoResource):
+    """
+    Every subclass of ``base``, once.
+    """
+    seen = set()
+    pending = list(base.__subclasses__())
+    while pending:
+        cls = pending.pop(0)
+        if cls in seen:
+            continue
+        seen.add(cls)
+        yield cls
+        pending.extend(cls.__subclasses__())
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+    make_option('-n', '--dry-run',
+        dest='dry_run',
+        default=False,
+        action='store_true',
+        help='Only print the indexes that would be created or dropped'),
+    make_option('--drop',
+        dest='drop',
+        default=False,
+        action='store_true',
+        help='Drop the indexes that are not declared, and rebuild the ones that changed'),
+    make_option('-b', '--background',
+        dest='background',
+        default=False,
+        action='store_true',
+        help='Build the indexes in the background'),
+    )
+    help = "Create the indexes declared in the Meta.indexes of MongoResources."
+    args = "[resource_name ...]"
+
+    def handle(self, *args, **options):
+        import_module(settings.ROOT_URLCONF)
+
+        # collection repr -> (collection, [resource names], [indexes])
+        targets = {}
+        order = []
+        for cls in resource_classes():
+            resource = cls()
+            name = resource._meta.resource_name
+            connection = getattr(resource._meta, 'connection', None)
+            indexes = resource.get_indexes()
+            if not indexes or connection is None:
+                continue
+            try:
+                collections = collections_for(connection)
+            except IncorrectParameters as error:
+                raise CommandError('%s: %s' % (name, error))
+
+            for collection in collections:
+                key = repr(collection)
+                if key not in targets:
+                    targets[key] = (collection, [], [])
+                    order.append(key)
+                targets[key][1].append(name)
+                targets[key][2].extend(indexes)
+
+        # Resource names only pick the collections to sync: the indexes of
+        # every resource on a collection are kept, so --drop leaves them be
+        if args:
+            order = [key for key in order if set(targets[key][1]) & set(args)]
+
+        done = {'create': 'created', 'drop': 'dropped'}
+        for key in order:
+            collection, names, indexes = targets[key]
+            try:
+                actions = sync_indexes(collection, indexes,
+                                       drop=options['drop'],
+                                       background=options['background'],
+                                       dry_run=options['dry_run'])
+            except IncorrectParameters as error:
+                raise CommandError('%s: %s' % (', '.join(names), error))
+
+            label = '%s (%s)' % (collection.full_name, ', '.join(names))
+            if not actions:
+                self.stdout.write('%s: up to date\n' % label)
+            for action, index_name in actions:
+                if action == 'conflict':
+                    self.stdout.write('%s: %s differs from its declaration, '
+                                      'run with --drop to rebuild it\n' % (label, index_name))
+                elif options['dry_run']:
+                    self.stdout.write('%s: would %s %s\n' % (label, action, index_name))
+                else:
+                    self.stdout.write('%s: %s %s\n' % (label, done[action], index_name))
@@ -0,0 +1,47 @@
+"""
+middleware.py
+
+Django middleware.
+
+:class:`IdentityMapMiddleware <IdentityMapMiddleware>` memoizes the reads of
+each request (see :mod:`mongolier.identity`), so that the views, resources
+and template tags of a request that run the same ``find_one`` only go to the
+database once:
+
+::
+
+    MIDDLEWARE = [
+        'mongolier.middleware.IdentityMapMiddleware',
+        ...
+    ]
+
+It works in ``MIDDLEWARE_CLASSES`` as well.
+"""
+from mongolier import identity
+
+
+class IdentityMapMiddleware(object):
+    """
+    Activates an identity map for the duration of each request.
+    """
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        identity.activate()
+        try:
+            return self.get_response(request)
+        finally:
+            identity.deactivate()
+
+    # Old-style middleware
+
+    def process_request(self, request):
+        identity.activate()
+
+    def process_response(self, request, response):
+        identity.deactivate()
+        return response
+
+    def process_exception(self, request, exception):
+        identity.deactivate()
@@ -0,0 +1,216 @@
+"""
+monitor.py
+
+Pre-warming and background health checks for
+:class:`Connection <mongolier.db.Connection>` objects.
+"""
+import logging
+import threading
+import time
+
+import pymongo
+
+from mongolier.pool import _CLIENT_CLASS, check_fork, register_after_fork
+
+logger = logging.getLogger(__name__)
+
+# pymongo 3 clients monitor their servers and fail over on their own, older
+# clients keep using a dead node until they are replaced
+_MONITORS_TOPOLOGY = pymongo.version_tuple[0] >= 3
+
+
+def warm(connection, min_sockets=1):
+    """
+    Create the connection's pooled client, authenticate and open at least
+    ``min_sockets`` sockets by running that many concurrent pings.
+
+    Returns the number of pings that succeeded.
+    """
+    database = connection.get_database()
+    succeeded = []
+
+    def ping():
+        try:
+            database.command('ping')
+        except Exception as error:
+            logger.warning('Warming ping to %s:%s/%s failed: %s', connection.host,
+                           connection.port, connection.db, error)
+        else:
+            succeeded.append(1)
+
+    threads = [threading.Thread(target=ping) for _ in range(max(min_sockets, 1))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return len(succeeded)
+
+
+class HealthMonitor(object):
+    """
+    Pings a set of connections from a daemon thread every ``interval``
+    seconds.
+
+    Pings go through a small client of the monitor's own, which gives up
+    after ``timeout`` seconds, so a hung server never stalls the monitor.
+    ``on_failure(name, connection, error)`` is called when a ping fails, if
+    given.
+
+    After ``failure_threshold`` failures in a row, the connection's pooled
+    client is discarded if ``discard`` is true, so that the next request
+    builds a fresh one instead of running into the dead node. This closes
+    the client under every connection sharing it. ``discard`` defaults to
+    true only before pymongo 3, whose clients fail over by themselves.
+
+    ::
+
+        monitor = HealthMonitor({'default': my_connection}, interval=10)
+        monitor.start()
+        monitor.status()
+        # {'default': {'healthy': True, 'latency': 0.0007, 'failures': 0, ...}}
+    """
+    def __init__(self, connections, interval=10, on_failure=None,
+                 failure_threshold=3, timeout=5.0, discard=None):
+        #: A dictionary of name to connection
+        self.connections = dict(connections)
+
+        #: Seconds between two rounds of pings
+        self.interval = interval
+
+        self.on_failure = on_failure
+
+        #: The number of failed pings in a row before the client is discarded
+        self.failure_threshold = failure_threshold
+
+        #: Seconds before a ping gives up
+        self.timeout = timeout
+
+        #: Whether to discard the pooled client of a failing connection
+        self.discard = not _MONITORS_TOPOLOGY if discard is None else discard
+
+        # name -> the client pings go through
+        self._probes = {}
+
+        self._status = dict((name, {
+            'healthy': None,
+            'last_check': None,
+            'latency': None,
+            'failures': 0,
+            'consecutive_failures': 0,
+            'last_error': None,
+        }) for name in self.connections)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        register_after_fork(self)
+
+    def _after_fork(self):
+        """
+        Threads do not survive a fork: restart the monitor in the child if it
+        was running in the parent.
+        """
+        was_running = self._thread is not None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # Clients do not survive a fork either
+        self._probes = {}
+        if was_running:
+            self.start()
+
+    def check(self):
+        """
+        Ping every connection once, and return the resulting status.
+        """
+        for name, connection in self.connections.items():
+            started = time.time()
+            try:
+                self._probe(name, connection).admin.command('ping')
+            except Exception as error:
+                self._close_probe(name)
+                failures = self._record(name, False, started, error)
+                if self.discard and failures == self.failure_threshold:
+                    connection.invalidate(discard=True)
+                if self.on_failure is not None:
+                    self.on_failure(name, connection, error)
+            else:
+                self._record(name, True, started)
+
+        return self.status()
+
+    def _probe(self, name, connection):
+        probe = self._probes.get(name)
+        if probe is None:
+            timeout_ms = int(self.timeout * 1000)
+            options = dict(connection.options)
+            options.update(connectTimeoutMS=timeout_ms, socketTimeoutMS=timeout_ms)
+            if _MONITORS_TOPOLOGY:
+                options.update(serverSelectionTimeoutMS=timeout_ms, maxPoolSize=1)
+            probe = self._probes[name] = _CLIENT_CLASS(connection.host, connection.port,
+                                                       **options)
+        return probe
+
+    def _close_probe(self, name):
+        probe = self._probes.pop(name, None)
+        if probe is not None:
+            probe.close()
+
+    def _record(self, name, healthy, started, error=None):
+        """
+        Record the result of a ping, and return the number of failures in a
+        row.
+        """
+        now = time.time()
+        with self._lock:
+            status = self._status[name]
+            status['healthy'] = healthy
+            status['last_check'] = now
+            if healthy:
+                status['latency'] = now - started
+                status['consecutive_failures'] = 0
+            else:
+                status['failures'] += 1
+                status['consecutive_failures'] += 1
+                status['last_error'] = str(error)
+            return status['consecutive_failures']
+
+    def status(self):
+        """
+        Return the health of each connection, keyed by name.
+        """
+        check_fork()
+        with self._lock:
+            return dict((name, dict(status)) for name, status in self._status.items())
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Start pinging in a daemon thread.
+        """
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='mongolier-health-monitor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the background thread.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+        for name in list(self._probes):
+            self._close_probe(name)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.check()
+            self._stop.wait(self.interval)
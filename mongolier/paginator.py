@@ -0,0 +1,167 @@
+"""
+paginator.py
+
+Keyset pagination for :class:`MongoResource <mongolier.api.MongoResource>`.
+
+Offset pagination makes MongoDB walk and throw away every document before the
+page, so deep pages get slower and slower. :class:`KeysetPaginator
+<KeysetPaginator>` instead remembers where the previous page ended, in an
+opaque ``after`` token, and asks for the documents sorted after it. With an
+index on the sort keys, every page costs the same index seek.
+
+::
+
+    class ArticleResource(MongoResource):
+        class Meta:
+            connection = my_connection
+            paginator_class = KeysetPaginator
+
+    GET /api/v1/articles/?sort=-date&limit=20
+    GET /api/v1/articles/?sort=-date&limit=20&after=eyJrIjogWy...
+
+Pages are sorted by the ``sort`` parameter plus ``_id``, which breaks ties so
+that no document is skipped or repeated. The sort keys should be present in
+every document.
+"""
+import base64
+import json
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+from bson import json_util
+from bson.errors import BSONError
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
+
+from mongolier.api import MongoCursorList
+
+
+def _value(document, key):
+    for part in key.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(part)
+    return document
+
+
+def encode_token(keys, values):
+    """
+    The opaque token of the position ``values`` of the sort ``keys``.
+    """
+    data = json.dumps({'k': keys, 'v': values}, default=json_util.default)
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_token(token, keys):
+    """
+    The position held by ``token``. Raises ``BadRequest`` if the token is
+    damaged, or was made for another sort.
+    """
+    try:
+        data = base64.urlsafe_b64decode(str(token) + '=' * (-len(token) % 4))
+        # object_hook raises bson errors (InvalidId...) for tampered values
+        data = json.loads(data.decode('utf-8'), object_hook=json_util.object_hook)
+        token_keys, values = list(data['k']), list(data['v'])
+    except (TypeError, ValueError, KeyError, AttributeError, UnicodeError, BSONError):
+        raise BadRequest("Invalid 'after' token.")
+    if token_keys != list(keys) or len(values) != len(keys):
+        raise BadRequest("The 'after' token was made for another sort.")
+    return values
+
+
+def keyset_condition(sort, values):
+    """
+    The query matching the documents sorted after ``values`` by ``sort``
+    (a list of ``(key, direction)``): for ``[(a, 1), (_id, 1)]``,
+    ``{'$or': [{a: {'$gt': va}}, {a: va, _id: {'$gt': vid}}]}``.
+    """
+    alternatives = []
+    for index, (key, direction) in enumerate(sort):
+        alternative = dict((sort[previous][0], values[previous]) for previous in range(index))
+        alternative[key] = {'$gt' if direction > 0 else '$lt': values[index]}
+        alternatives.append(alternative)
+    return alternatives[0] if len(alternatives) == 1 else {'$or': alternatives}
+
+
+class KeysetPaginator(Paginator):
+    """
+    A tastypie paginator that pages a :class:`MongoCursorList
+    <mongolier.api.MongoCursorList>` on its sort keys plus ``_id``.
+
+    ``meta`` holds the ``limit``, the ``after`` token the page was asked
+    for, the ``next_token`` of the next page and the ``next`` URL asking
+    for it (both ``None`` on the last page). There is no ``offset``,
+    ``previous`` or ``total_count``: counting would cost as much as the
+    offsets this avoids.
+    """
+    def get_sort(self):
+        sort = list(self.objects.sort or [])
+        if '_id' not in [key for key, _ in sort]:
+            # Ties are broken in the direction of the last key
+            sort.append(('_id', sort[-1][1] if sort else 1))
+        return sort
+
+    def get_after(self):
+        return self.request_data.get('after')
+
+    def _next_uri(self, limit, token):
+        if self.resource_uri is None:
+            return None
+
+        if hasattr(self.request_data, 'urlencode'):
+            params = self.request_data.copy()
+        else:
+            params = dict(self.request_data)
+        for key in ('offset', 'after', 'limit'):
+            params.pop(key, None)
+        params['limit'] = limit
+        params['after'] = token
+
+        encoded = params.urlencode() if hasattr(params, 'urlencode') else urlencode(params)
+        return '%s?%s' % (self.resource_uri, encoded)
+
+    def page(self):
+        objects = self.objects
+        if not isinstance(objects, MongoCursorList):
+            raise BadRequest('Keyset pagination needs a MongoResource list.')
+
+        limit = self.get_limit()
+        sort = self.get_sort()
+        keys = [key for key, _ in sort]
+
+        spec = objects.spec
+        after = self.get_after()
+        if after:
+            condition = keyset_condition(sort, decode_token(after, keys))
+            spec = {'$and': [spec, condition]} if spec else condition
+
+        projection = objects.projection
+        if projection is not None:
+            # The next token is read from the last document
+            projection = dict(projection)
+            for key in keys:
+                projection[key] = 1
+
+        # One more than the page, to know whether there is a next page
+        documents = list(MongoCursorList(objects.collection, spec, sort,
+                                         limit=limit + 1 if limit else 0,
+                                         projection=projection))
+
+        next_token = None
+        if limit and len(documents) > limit:
+            documents = documents[:limit]
+            last = documents[-1]
+            next_token = encode_token(keys, [_value(last, key) for key in keys])
+
+        return {
+            getattr(self, 'collection_name', 'objects'): documents,
+            'meta': {
+                'limit': limit,
+                'after': after,
+                'next_token': next_token,
+                'next': self._next_uri(limit, next_token) if next_token else None,
+            },
+        }
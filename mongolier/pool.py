@@ -0,0 +1,283 @@
+"""
+pool.py
+
+A process-wide registry of pymongo clients, shared by every
+:class:`Connection <mongolier.db.Connection>`.
+
+Building a pymongo client is expensive: it opens a TCP connection, discovers
+the servers and starts a socket pool of its own.  The registry keeps a single
+client per ``(host, port, options, credentials)`` and hands that same client
+(and its socket pool) to every Connection that asks for it.
+
+Clients are not fork-safe: a child process must not reuse the sockets it
+inherited from its parent.  Pools, and anything else registered with
+:func:`register_after_fork <register_after_fork>`, are reset in the child
+after a fork, either by an at-fork hook (Python 3.7+) or as soon as a pid
+change is noticed.
+"""
+import os
+import threading
+import time
+import weakref
+
+import pymongo
+
+try:
+    _CLIENT_CLASS = pymongo.MongoClient
+except AttributeError:
+    _CLIENT_CLASS = pymongo.Connection
+
+
+_pid = os.getpid()
+_after_fork = weakref.WeakSet()
+
+
+def register_after_fork(obj):
+    """
+    Call ``obj._after_fork()`` in the child process after every fork.
+    Only a weak reference to ``obj`` is kept.
+    """
+    _after_fork.add(obj)
+
+
+def _reset_after_fork():
+    global _pid
+    _pid = os.getpid()
+    for obj in list(_after_fork):
+        obj._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+    def current_pid():
+        """
+        The pid of the current process, kept up to date by the at-fork hook.
+        """
+        return _pid
+else:
+    current_pid = os.getpid
+
+
+def check_fork():
+    """
+    Reset everything registered with :func:`register_after_fork
+    <register_after_fork>` if this process is a fork that has not been
+    reset yet.
+    """
+    if os.getpid() != _pid:
+        _reset_after_fork()
+
+
+class PooledClient(object):
+    """
+    A registry entry: a pymongo client plus the bookkeeping the pool needs
+    to evict it and report on it.
+    """
+    def __init__(self, key, client):
+        #: The registry key this client was created for
+        self.key = key
+
+        #: The pymongo client itself
+        self.client = client
+
+        #: The names of the databases this client has authenticated against
+        self.authenticated = set()
+        self._auth_lock = threading.Lock()
+
+        #: When the client was created and last handed out
+        self.created = time.time()
+        self.last_used = self.created
+
+        #: The number of times the client was handed out
+        self.checkouts = 0
+
+        #: False once the client has been discarded, evicted or cleared.
+        #: Anything cached against this client must then be rebuilt.
+        self.alive = True
+
+        #: The process the client was created in
+        self.pid = os.getpid()
+
+    def touch(self):
+        self.last_used = time.time()
+        self.checkouts += 1
+
+
+class ClientPool(object):
+    """
+    A thread-safe registry of pymongo clients.
+
+    ::
+
+        from mongolier.pool import pool
+
+        pool.max_pool_size = 50
+        pool.idle_timeout = 600
+        pool.stats()
+
+    ``max_pool_size`` is passed to each new client as ``maxPoolSize`` unless
+    the Connection sets it itself.  Clients that have not been handed out for
+    ``idle_timeout`` seconds are closed and dropped from the registry.
+    """
+    def __init__(self, max_pool_size=100, idle_timeout=None, client_class=None):
+        #: The maximum number of sockets each client may keep open
+        self.max_pool_size = max_pool_size
+
+        #: Seconds after which an unused client is evicted, ``None`` to disable
+        self.idle_timeout = idle_timeout
+
+        #: The pymongo client class to instantiate
+        self.client_class = client_class or _CLIENT_CLASS
+
+        self._clients = {}
+        self._lock = threading.RLock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+        register_after_fork(self)
+
+    def _after_fork(self):
+        """
+        Forget, without closing, every client inherited from the parent
+        process. Closing them would talk to the server over sockets the
+        parent still uses.
+        """
+        self._lock = threading.RLock()
+        for entry in self._clients.values():
+            entry.alive = False
+        self._clients = {}
+
+    @staticmethod
+    def make_key(host, port, options, username=None, password=None):
+        """
+        Build the registry key.  Options are sorted so that the same keyword
+        arguments always produce the same key, whatever order they came in.
+        """
+        return (host, port, tuple(sorted((key, repr(value))
+                                         for key, value in options.items())),
+                username, password)
+
+    def get(self, host='localhost', port=27017, username=None, password=None,
+            **options):
+        """
+        Return the :class:`PooledClient <PooledClient>` for these connection
+        arguments, creating it on first use.
+        """
+        key = self.make_key(host, port, options, username, password)
+
+        check_fork()
+
+        with self._lock:
+            if self.idle_timeout is not None:
+                self.evict_idle()
+
+            entry = self._clients.get(key)
+
+            if entry is None:
+                self._misses += 1
+                if self.max_pool_size is not None \
+                    and 'maxPoolSize' not in options \
+                    and 'max_pool_size' not in options:
+                    options['maxPoolSize'] = self.max_pool_size
+                entry = PooledClient(key, self.client_class(host, port, **options))
+                self._clients[key] = entry
+            else:
+                self._hits += 1
+
+            entry.touch()
+
+        return entry
+
+    def authenticate(self, entry, database, username, password):
+        """
+        Authenticate ``database`` once per client.  pymongo caches the
+        credentials on the client and applies them to every socket it opens,
+        so subsequent checkouts skip the auth round-trip.
+        """
+        if database.name in entry.authenticated:
+            return
+
+        # Not the registry lock: other clients are handed out meanwhile
+        with entry._auth_lock:
+            if database.name not in entry.authenticated:
+                database.authenticate(username, password)
+                entry.authenticated.add(database.name)
+
+    def discard(self, entry):
+        """
+        Close a client and drop it from the registry, e.g. after it failed.
+        The next :meth:`get <get>` with the same arguments builds a new one.
+        """
+        with self._lock:
+            if self._clients.get(entry.key) is entry:
+                del self._clients[entry.key]
+            entry.alive = False
+        entry.client.close()
+
+    def evict_idle(self, idle_timeout=None):
+        """
+        Close every client that has not been handed out for ``idle_timeout``
+        seconds (defaults to the pool's ``idle_timeout``).  Returns the number
+        of clients that were evicted.
+        """
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        if idle_timeout is None:
+            return 0
+
+        cutoff = time.time() - idle_timeout
+        with self._lock:
+            stale = [entry for entry in self._clients.values()
+                     if entry.last_used < cutoff]
+            for entry in stale:
+                del self._clients[entry.key]
+                entry.alive = False
+            self._evictions += len(stale)
+
+        for entry in stale:
+            entry.client.close()
+
+        return len(stale)
+
+    def clear(self):
+        """
+        Close and forget every client in the registry.
+        """
+        with self._lock:
+            entries = list(self._clients.values())
+            self._clients.clear()
+            for entry in entries:
+                entry.alive = False
+
+        for entry in entries:
+            entry.client.close()
+
+    def stats(self):
+        """
+        Return a dictionary describing the registry and each of its clients.
+        Credentials are never included.
+        """
+        now = time.time()
+        with self._lock:
+            return {
+                'clients': len(self._clients),
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'max_pool_size': self.max_pool_size,
+                'idle_timeout': self.idle_timeout,
+                'entries': [{
+                    'host': entry.key[0],
+                    'port': entry.key[1],
+                    'username': entry.key[3],
+                    'checkouts': entry.checkouts,
+                    'age': now - entry.created,
+                    'idle': now - entry.last_used,
+                    'authenticated': sorted(entry.authenticated),
+                } for entry in self._clients.values()],
+            }
+
+
+#: The default, process-wide registry used by every Connection
+pool = ClientPool()
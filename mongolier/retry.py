@@ -0,0 +1,177 @@
+"""
+retry.py
+
+A reusable retry policy for MongoDB operations: exponential backoff with
+jitter, a total time budget per operation and a list of the operations that
+are safe to retry.
+"""
+import random
+import threading
+import time
+
+from pymongo.errors import AutoReconnect
+
+#: Operations that can be run twice without changing the outcome
+DEFAULT_RETRYABLE_OPERATIONS = frozenset([
+    'connect',
+    'find',
+    'find_one',
+    'count',
+    'count_documents',
+    'estimated_document_count',
+    'distinct',
+    'aggregate',
+    'group',
+    'inline_map_reduce',
+    'index_information',
+    'list_indexes',
+    'options',
+    'ensure_index',
+    'create_index',
+    'create_indexes',
+    'explain',
+])
+
+
+class RetryPolicy(object):
+    """
+    Decides whether, and how long to wait before, an operation is retried.
+
+    ::
+
+        policy = RetryPolicy(max_retries=5, backoff=0.1, deadline=10)
+        connection = Connection(db='my_db', retry_policy=policy)
+
+        policy.stats()
+        # {'calls': 1204, 'retries': 3, 'failures': 0,
+        #  'operations': {'find_one': 3}}
+
+    The delay before retry ``n`` (counting from zero) is
+    ``backoff * multiplier ** n``, capped at ``max_backoff``. With ``jitter``
+    on, a random delay between zero and that value is used instead, so that
+    workers which failed together do not all retry at the same moment.
+
+    No retry is attempted if it would be made after ``deadline`` seconds have
+    passed since the first attempt.
+    """
+    def __init__(self,
+                max_retries=2,
+                backoff=0.1,
+                max_backoff=5.0,
+                multiplier=2.0,
+                jitter=True,
+                deadline=30.0,
+                retry_on=(AutoReconnect,),
+                operations=DEFAULT_RETRYABLE_OPERATIONS,
+                sleep=time.sleep):
+        #: The maximum number of retries after the first attempt
+        self.max_retries = max_retries
+
+        #: The delay before the first retry, in seconds
+        self.backoff = backoff
+
+        #: The longest delay between two attempts, in seconds
+        self.max_backoff = max_backoff
+
+        #: The factor the delay grows by after each retry
+        self.multiplier = multiplier
+
+        #: Whether to randomize the delay
+        self.jitter = jitter
+
+        #: The total time budget for an operation, in seconds. ``None`` for
+        #: no budget.
+        self.deadline = deadline
+
+        #: The exception types that trigger a retry
+        self.retry_on = tuple(retry_on)
+
+        #: The names of the operations that are safe to retry
+        self.operations = frozenset(operations)
+
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def should_retry(self, operation):
+        """
+        Whether ``operation`` may be retried under this policy.
+        """
+        return operation in self.operations
+
+    def delay(self, attempt):
+        """
+        The number of seconds to wait before retry number ``attempt``.
+        """
+        delay = min(self.max_backoff, self.backoff * (self.multiplier ** attempt))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def call(self, operation, func, args=(), kwargs=None, retry_on=None,
+             on_retry=None):
+        """
+        Run ``func(*args, **kwargs)``, retrying it on failure according to
+        the policy. ``on_retry(error)`` is called before each retry.
+
+        The last error is raised once the retries or the deadline run out.
+        """
+        kwargs = kwargs or {}
+        retry_on = retry_on or self.retry_on
+        # The time spent in the attempts plus the delays slept between them,
+        # rather than the wall clock, which knows nothing of a custom sleep
+        elapsed = 0.0
+        attempt = 0
+
+        self._count(operation, 'calls')
+        while True:
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            except retry_on as error:
+                elapsed += time.time() - started
+                if attempt >= self.max_retries:
+                    self._count(operation, 'failures')
+                    raise
+
+                delay = self.delay(attempt)
+                if self.deadline is not None and elapsed + delay > self.deadline:
+                    self._count(operation, 'failures')
+                    raise
+
+                self._count(operation, 'retries')
+                if on_retry is not None:
+                    on_retry(error)
+
+                self._sleep(delay)
+                elapsed += delay
+                attempt += 1
+
+    def _count(self, operation, counter):
+        with self._lock:
+            self._stats[counter] += 1
+            if counter == 'retries':
+                operations = self._stats['operations']
+                operations[operation] = operations.get(operation, 0) + 1
+
+    def stats(self):
+        """
+        Return the call, retry and failure counters, with the retries broken
+        down by operation.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['operations'] = dict(self._stats['operations'])
+        return stats
+
+    def reset_stats(self):
+        """
+        Set every counter back to zero.
+        """
+        with self._lock:
+            self._stats = {
+                'calls': 0,
+                'retries': 0,
+                'failures': 0,
+                'operations': {},
+            }
@@ -0,0 +1,500 @@
+"""
+sharding.py
+
+Application-level sharding of a dataset across several independent MongoDB
+clusters.
+
+Writes and keyed reads are routed to a single cluster by a shard key.
+Unkeyed reads run on every cluster in parallel, and their results are merged
+respecting ``sort``, ``skip`` and ``limit``.
+
+::
+
+    from mongolier.sharding import ShardedConnection
+
+    articles = ShardedConnection([
+        Connection(host='cluster-a', db='news', collection='articles'),
+        Connection(host='cluster-b', db='news', collection='articles'),
+    ], shard_key='site_id')
+
+    articles.api.insert({'site_id': 12, 'headline': 'Palm, meet face'})
+    articles.api.find_one({'site_id': 12, 'slug': 'palm'})  # one cluster
+    articles.api.find({'tags': 'palm'}).sort('date', -1).limit(20)  # all
+
+Because the surface matches a :class:`Connection <mongolier.db.Connection>`'s
+``api``, a ShardedConnection can be used as a ``MongoResource`` connection
+or a view's connection.
+"""
+import datetime
+import heapq
+import numbers
+import threading
+import zlib
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2 without the ``futures`` backport
+    ThreadPoolExecutor = None
+
+from bson.objectid import ObjectId
+from bson.timestamp import Timestamp
+from pymongo import ASCENDING
+
+from mongolier.exceptions import IncorrectParameters
+from mongolier.pool import check_fork, register_after_fork
+
+_text_type = type(u'')
+
+
+def default_shard_hash(key):
+    """
+    A stable hash of a shard key value, the same in every process.
+    """
+    if isinstance(key, _text_type):
+        key = key.encode('utf-8')
+    elif not isinstance(key, bytes):
+        key = str(key).encode('utf-8')
+    return zlib.crc32(key) & 0xffffffff
+
+
+# The order MongoDB sorts values of different types in
+_TYPE_ORDER = (
+    (type(None), 1),
+    (numbers.Number, 2),
+    ((_text_type, str), 3),
+    (dict, 4),
+    ((list, tuple), 5),
+    (bytes, 6),
+    (ObjectId, 7),
+    (bool, 8),
+    (datetime.datetime, 9),
+    (Timestamp, 10),
+)
+
+
+def _bson_order(value):
+    """
+    A sort key for any BSON value, which never compares values of different
+    types with each other (a TypeError under Python 3).
+    """
+    if isinstance(value, bool):
+        return (8, value)
+    for types, rank in _TYPE_ORDER:
+        if isinstance(value, types):
+            break
+    else:
+        # Anything else (regular expressions, codes, ...) sorts last
+        return (11, type(value).__name__, repr(value))
+
+    if rank == 1:
+        return (rank,)
+    if rank == 4:
+        # Embedded documents compare field by field
+        return (rank, tuple((key, _bson_order(item)) for key, item in value.items()))
+    if rank == 5:
+        return (rank, tuple(_bson_order(item) for item in value))
+    return (rank, value)
+
+
+def _get_path(document, path):
+    for part in path.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(part)
+    return document
+
+
+class _SortKey(object):
+    """
+    Orders documents by a pymongo sort specification, with mixed directions.
+    """
+    __slots__ = ('values', 'directions')
+
+    def __init__(self, document, sort):
+        self.values = [_bson_order(_get_path(document, field)) for field, _ in sort]
+        self.directions = [direction for _, direction in sort]
+
+    def __eq__(self, other):
+        return self.values == other.values
+
+    def __ne__(self, other):
+        return self.values != other.values
+
+    def __lt__(self, other):
+        for mine, theirs, direction in zip(self.values, other.values, self.directions):
+            if mine == theirs:
+                continue
+            if direction == ASCENDING:
+                return mine < theirs
+            return mine > theirs
+        return False
+
+
+def _normalize_sort(key_or_list, direction=None):
+    if isinstance(key_or_list, (list, tuple)):
+        return list(key_or_list)
+    return [(key_or_list, ASCENDING if direction is None else direction)]
+
+
+class ShardedCursor(object):
+    """
+    The result of an unkeyed ``find``: the same query run on every cluster.
+
+    Supports the chained ``sort``, ``skip`` and ``limit`` of a pymongo cursor,
+    ``count`` and iteration. Each cluster fetches its first batch in
+    parallel; the results are then merged lazily.
+    """
+    def __init__(self, collections, spec=None, args=(), kwargs=None):
+        kwargs = dict(kwargs or {})
+        self._collections = collections
+        self._spec = spec
+        self._skip = kwargs.pop('skip', 0) or 0
+        self._limit = kwargs.pop('limit', 0) or 0
+        sort = kwargs.pop('sort', None)
+        self._sort = _normalize_sort(sort) if sort else None
+        self._args = args
+        self._kwargs = kwargs
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _normalize_sort(key_or_list, direction)
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start = index.start or 0
+            self._skip += start
+            if index.stop is not None:
+                self._limit = index.stop - start
+            return self
+        for document in ShardedCursor(self._collections, self._spec, self._args,
+                                      dict(self._kwargs, sort=self._sort,
+                                           skip=self._skip + index, limit=1)):
+            return document
+        raise IndexError('no such item for Cursor instance')
+
+    def count(self, with_limit_and_skip=False):
+        counts = _parallel([lambda collection=collection: collection.find(self._spec).count()
+                            for collection in self._collections])
+        total = sum(counts)
+        if with_limit_and_skip:
+            total = max(total - self._skip, 0)
+            if self._limit:
+                total = min(total, self._limit)
+        return total
+
+    def _open(self, collection):
+        cursor = collection.find(self._spec, *self._args, **self._kwargs)
+        if self._sort:
+            cursor = cursor.sort(self._sort)
+        if self._limit:
+            # Every cluster may hold all of the documents of the page
+            cursor = cursor.limit(self._skip + self._limit)
+        for document in cursor:
+            yield document
+
+    def _merge(self):
+        streams = [self._open(collection) for collection in self._collections]
+
+        # Fetch the first document (and batch) of every cluster in parallel
+        firsts = _parallel([lambda stream=stream: next(stream, None) for stream in streams])
+
+        if not self._sort:
+            for first, stream in zip(firsts, streams):
+                if first is not None:
+                    yield first
+                    for document in stream:
+                        yield document
+            return
+
+        heap = []
+        for index, (first, stream) in enumerate(zip(firsts, streams)):
+            if first is not None:
+                heap.append((_SortKey(first, self._sort), index, first, stream))
+        heapq.heapify(heap)
+
+        while heap:
+            _, index, document, stream = heap[0]
+            yield document
+            following = next(stream, None)
+            if following is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (_SortKey(following, self._sort), index,
+                                         following, stream))
+
+    def __iter__(self):
+        returned = 0
+        for position, document in enumerate(self._merge()):
+            if position < self._skip:
+                continue
+            if self._limit and returned >= self._limit:
+                return
+            returned += 1
+            yield document
+
+
+class _Executor(object):
+    """
+    The threads that query the clusters in parallel, shared by every
+    ShardedConnection, instead of new threads for each query.
+    """
+    def __init__(self, max_workers=32):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        register_after_fork(self)
+
+    def _after_fork(self):
+        # The parent's threads are gone in the child
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def map(self, functions):
+        check_fork()
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.max_workers)
+        futures = [self._executor.submit(function) for function in functions]
+        return [future.result() for future in futures]
+
+
+_executor = _Executor()
+
+
+def _parallel(functions):
+    """
+    Call every function in parallel, and return their results in order.
+    """
+    if len(functions) == 1:
+        return [functions[0]()]
+    if ThreadPoolExecutor is not None:
+        return _executor.map(functions)
+
+    results = [None] * len(functions)
+    errors = []
+
+    def run(index, function):
+        try:
+            results[index] = function()
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=run, args=(index, function))
+               for index, function in enumerate(functions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
+
+
+class ShardedCollection(object):
+    """
+    A collection spread over the clusters of a :class:`ShardedConnection
+    <ShardedConnection>`.
+    """
+    def __init__(self, sharded_connection, name, read=False):
+        self._sharded = sharded_connection
+        self.name = name
+        self._read = read
+
+    def _collection(self, connection):
+        if self._read:
+            return connection.read[self.name]
+        return connection[self.name]
+
+    def _all(self):
+        return [self._collection(connection)
+                for connection in self._sharded.connections]
+
+    def _for(self, spec_or_document):
+        """
+        The collection on the cluster that owns ``spec_or_document``, or
+        ``None`` if it does not carry a shard key.
+        """
+        key = self._sharded.get_key(spec_or_document)
+        if key is None:
+            return None
+        return self._collection(self._sharded.shard_for(key))
+
+    def for_shard(self, key):
+        """
+        The collection on the cluster that owns shard key ``key``.
+        """
+        return self._collection(self._sharded.shard_for(key))
+
+    def find(self, spec=None, *args, **kwargs):
+        collection = self._for(spec)
+        if collection is not None:
+            return collection.find(spec, *args, **kwargs)
+        return ShardedCursor(self._all(), spec, args, kwargs)
+
+    def find_one(self, spec_or_id=None, *args, **kwargs):
+        collection = self._for(spec_or_id)
+        if collection is not None:
+            return collection.find_one(spec_or_id, *args, **kwargs)
+
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        for document in self.find(spec_or_id, *args, **dict(kwargs, limit=1)):
+            return document
+        return None
+
+    def count(self, spec=None, **kwargs):
+        """
+        The number of documents matching ``spec``, on the cluster that owns
+        it if it carries a shard key, on every cluster otherwise.
+        ``skip`` and ``limit`` apply to the total.
+        """
+        collection = self._for(spec)
+        if collection is not None:
+            return collection.find(spec, **kwargs).count(with_limit_and_skip=True)
+        return ShardedCursor(self._all(), spec, kwargs=kwargs).count(with_limit_and_skip=True)
+
+    def insert(self, doc_or_docs, *args, **kwargs):
+        if isinstance(doc_or_docs, dict):
+            return self._owner(doc_or_docs).insert(doc_or_docs, *args, **kwargs)
+
+        # Group the documents by cluster, so each one gets a single insert
+        by_shard = {}
+        for position, document in enumerate(doc_or_docs):
+            index = self._sharded.shard_index(self._require_key(document))
+            by_shard.setdefault(index, []).append((position, document))
+
+        ids = [None] * len(doc_or_docs)
+        for index, documents in by_shard.items():
+            collection = self._collection(self._sharded.connections[index])
+            inserted = collection.insert([document for _, document in documents],
+                                         *args, **kwargs)
+            for (position, _), _id in zip(documents, inserted):
+                ids[position] = _id
+        return ids
+
+    def save(self, to_save, *args, **kwargs):
+        return self._owner(to_save).save(to_save, *args, **kwargs)
+
+    def update(self, spec, document, *args, **kwargs):
+        collection = self._for(spec)
+        if collection is not None:
+            return collection.update(spec, document, *args, **kwargs)
+        if kwargs.get('upsert'):
+            raise IncorrectParameters('An upsert must include the shard key in its spec.')
+        if kwargs.get('multi'):
+            return [collection.update(spec, document, *args, **kwargs)
+                    for collection in self._all()]
+
+        # A single document update: stop at the first cluster that has one
+        # to update. Unacknowledged writes report nothing, and go everywhere.
+        results = []
+        for collection in self._all():
+            result = collection.update(spec, document, *args, **kwargs)
+            results.append(result)
+            if result and result.get('n'):
+                break
+        return results
+
+    def remove(self, spec_or_id=None, *args, **kwargs):
+        collection = self._for(spec_or_id)
+        if collection is not None:
+            return collection.remove(spec_or_id, *args, **kwargs)
+        return [collection.remove(spec_or_id, *args, **kwargs)
+                for collection in self._all()]
+
+    def drop(self):
+        for collection in self._all():
+            collection.drop()
+
+    def _require_key(self, document):
+        key = self._sharded.get_key(document)
+        if key is None:
+            raise IncorrectParameters('Document has no shard key: %r' % (document,))
+        return key
+
+    def _owner(self, document):
+        return self._collection(self._sharded.shard_for(self._require_key(document)))
+
+    def __repr__(self):
+        return 'ShardedCollection(%r)' % self.name
+
+
+class ShardedConnection(object):
+    """
+    Spreads a dataset across several :class:`Connection
+    <mongolier.db.Connection>` objects, one per cluster.
+
+    ``shard_key`` is either the name of a document field, or a function that
+    takes a document or query and returns its shard key (``None`` if it has
+    none). ``shard_hash`` maps a key to an integer; the default is a stable
+    CRC32. The order of ``connections`` decides which cluster owns a key, so
+    it must not change once data has been written.
+    """
+    def __init__(self, connections, shard_key='_id', collection=None,
+                 shard_hash=default_shard_hash):
+        if not connections:
+            raise IncorrectParameters('ShardedConnection needs at least one connection.')
+
+        #: One connection per cluster
+        self.connections = list(connections)
+
+        #: The default collection, for ``api`` and ``read_api``
+        self.collection = collection or self.connections[0].collection
+
+        self.shard_key = shard_key
+        self.shard_hash = shard_hash
+
+    def get_key(self, spec_or_document):
+        """
+        Return the shard key of a document or query, or ``None``.
+        """
+        if callable(self.shard_key):
+            return self.shard_key(spec_or_document)
+
+        if not isinstance(spec_or_document, dict):
+            # A bare ``_id``, as accepted by ``find_one``
+            if spec_or_document is not None and self.shard_key == '_id':
+                return spec_or_document
+            return None
+
+        key = _get_path(spec_or_document, self.shard_key)
+        # Operators such as {'$in': [...]} do not pin a single cluster
+        if isinstance(key, dict):
+            return None
+        return key
+
+    def shard_index(self, key):
+        return self.shard_hash(key) % len(self.connections)
+
+    def shard_for(self, key):
+        """
+        The connection of the cluster that owns shard key ``key``.
+        """
+        return self.connections[self.shard_index(key)]
+
+    @property
+    def api(self):
+        return ShardedCollection(self, self.collection)
+
+    @property
+    def read_api(self):
+        return ShardedCollection(self, self.collection, read=True)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return ShardedCollection(self, name)
+
+    def __getitem__(self, name):
+        return ShardedCollection(self, name)
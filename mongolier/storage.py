@@ -0,0 +1,353 @@
+"""
+storage.py
+
+Deduplicated, parallel uploads to GridFS.
+
+:class:`DedupStorage <DedupStorage>` stores each distinct content once. Files
+are identified by the sha256 of their bytes: uploading bytes that are already
+stored only adds a reference to the existing file, and :meth:`release
+<DedupStorage.release>` deletes the file once its last reference is gone.
+
+::
+
+    storage = my_connection.storage(bucket='media', chunk_size=1024 * 1024)
+    file_id = storage.put(request.FILES['image'], filename='palm.jpg',
+                          content_type='image/jpeg')
+
+    my_connection.bucket('media').get(file_id).read()
+    storage.release(file_id)
+
+Files are written in the standard GridFS layout, so they can be read with
+GridFS and served with :class:`GridFSFileView <mongolier.views.GridFSFileView>`.
+Chunks are inserted in batches, by several threads at once.
+"""
+import datetime
+import hashlib
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+try:
+    from pymongo import ReturnDocument
+except ImportError:
+    # pymongo < 3.0
+    ReturnDocument = None
+
+from mongolier.exceptions import IncorrectParameters
+
+DEFAULT_CHUNK_SIZE = 255 * 1024
+
+_STOP = object()
+
+
+def _find_and_modify(collection, spec, document):
+    """
+    Apply ``document`` to the first document matching ``spec`` and return
+    it as updated, or ``None``.
+    """
+    if ReturnDocument is not None:
+        return collection.find_one_and_update(spec, document,
+                                              return_document=ReturnDocument.AFTER)
+    return collection.find_and_modify(spec, document, new=True)
+
+
+def _insert(collection, documents):
+    if hasattr(type(collection), 'insert_many'):
+        collection.insert_many(documents, ordered=False)
+    else:
+        collection.insert(documents)
+
+
+def _remove(collection, spec):
+    if hasattr(type(collection), 'delete_many'):
+        return collection.delete_many(spec).deleted_count
+    return collection.remove(spec)['n']
+
+
+class _ChunkWriter(object):
+    """
+    Inserts batches of chunks from ``workers`` threads, with at most two
+    batches per thread waiting, so memory stays bounded.
+    """
+    def __init__(self, collection, workers):
+        self.collection = collection
+        self.errors = []
+        self._queue = Queue(workers * 2)
+        self._threads = [threading.Thread(target=self._run, name='mongolier-chunk-writer')
+                         for _ in range(workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is _STOP:
+                return
+            if self.errors:
+                # Give up on the rest, the upload is rolled back
+                continue
+            try:
+                _insert(self.collection, batch)
+            except Exception as error:
+                self.errors.append(error)
+
+    def write(self, batch):
+        if self.errors:
+            raise self.errors[0]
+        self._queue.put(batch)
+
+    def close(self):
+        """
+        Wait for every batch to be written, and raise the first error.
+        """
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+
+class DedupStorage(object):
+    """
+    Stores files in the GridFS ``bucket`` of ``connection`` (the connection's
+    collection by default), in chunks of ``chunk_size`` bytes, inserted
+    ``batch_size`` chunks at a time from ``workers`` threads. Files of fewer
+    than two batches are inserted inline, without starting threads.
+
+    The files documents get two extra fields: ``sha256``, unique across the
+    bucket, and ``refcount``, the number of :meth:`put <put>` calls made for
+    that content and not yet released.
+    """
+    def __init__(self,
+                connection,
+                bucket=None,
+                chunk_size=DEFAULT_CHUNK_SIZE,
+                batch_size=16,
+                workers=4):
+        if chunk_size <= 0 or batch_size <= 0 or workers <= 0:
+            raise IncorrectParameters('chunk_size, batch_size and workers must be positive')
+
+        self.connection = connection
+        self.bucket = bucket or connection.collection
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.workers = workers
+
+        # Claim the bucket, so that its collections are kept off the API
+        connection.bucket(self.bucket)
+        self._indexed = False
+
+    @property
+    def files(self):
+        return self.connection.get_database()[self.bucket + '.files']
+
+    @property
+    def chunks(self):
+        return self.connection.get_database()[self.bucket + '.chunks']
+
+    def _ensure_indexes(self):
+        if self._indexed:
+            return
+        files, chunks = self.files, self.chunks
+        create_index = 'create_index' if hasattr(type(chunks), 'create_index') \
+            else 'ensure_index'
+        getattr(chunks, create_index)([('files_id', ASCENDING), ('n', ASCENDING)],
+                                      unique=True)
+        getattr(files, create_index)([('filename', ASCENDING), ('uploadDate', ASCENDING)])
+        getattr(files, create_index)('sha256', unique=True, sparse=True)
+        self._indexed = True
+
+    def _blocks(self, data):
+        """
+        Yield ``data`` in blocks of exactly ``chunk_size`` bytes (but the
+        last), however much each ``read`` returns.
+        """
+        if isinstance(data, bytes):
+            for start in range(0, len(data), self.chunk_size):
+                yield data[start:start + self.chunk_size]
+            return
+
+        buffered = b''
+        while True:
+            block = data.read(self.chunk_size - len(buffered))
+            if not block:
+                break
+            if not isinstance(block, bytes):
+                block = block.encode('utf-8')
+            buffered += block
+            # Encoded text may come out longer than what was asked for
+            while len(buffered) >= self.chunk_size:
+                yield buffered[:self.chunk_size]
+                buffered = buffered[self.chunk_size:]
+        if buffered:
+            yield buffered
+
+    def _seekable(self, data):
+        if isinstance(data, bytes):
+            return True
+        try:
+            position = data.tell()
+            data.seek(position)
+        except (AttributeError, IOError, OSError, ValueError):
+            return False
+        return True
+
+    def _reference(self, sha256):
+        """
+        Add a reference to the file holding the content ``sha256``, and
+        return its ``_id``, or ``None`` if there is none.
+        """
+        document = _find_and_modify(self.files, {'sha256': sha256},
+                                    {'$inc': {'refcount': 1}})
+        return document['_id'] if document else None
+
+    def find(self, sha256):
+        """
+        Return the files document holding the content ``sha256``, or ``None``.
+        """
+        return self.files.find_one({'sha256': sha256})
+
+    def put(self, data, **kwargs):
+        """
+        Store ``data`` (bytes, text or a file-like object) and return the
+        ``_id`` of the file holding it, an existing one if that content is
+        already stored. ``filename``, ``content_type`` and other keyword
+        arguments are stored on the files document, as with GridFS, when a
+        new file is created.
+
+        Seekable inputs are hashed before anything is uploaded. Other
+        inputs are hashed while they are uploaded, and the chunks are
+        deleted again if the content turns out to be stored already.
+        """
+        if not isinstance(data, bytes) and isinstance(data, type(u'')):
+            data = data.encode(kwargs.pop('encoding', 'utf-8'))
+        self._ensure_indexes()
+
+        sha256 = None
+        if self._seekable(data):
+            start = 0 if isinstance(data, bytes) else data.tell()
+            hashed = hashlib.sha256()
+            for block in self._blocks(data):
+                hashed.update(block)
+            sha256 = hashed.hexdigest()
+
+            file_id = self._reference(sha256)
+            if file_id is not None:
+                return file_id
+            if not isinstance(data, bytes):
+                data.seek(start)
+
+        file_id = kwargs.pop('_id', None) or ObjectId()
+        try:
+            length, md5, uploaded = self._upload(file_id, data)
+        except Exception:
+            self._rollback(file_id)
+            raise
+
+        if uploaded != sha256:
+            # Not hashed beforehand (or changed since): it may be stored already
+            sha256 = uploaded
+            existing = self._reference(sha256)
+            if existing is not None:
+                self._rollback(file_id)
+                return existing
+
+        document = {
+            '_id': file_id,
+            'length': length,
+            'chunkSize': self.chunk_size,
+            'uploadDate': datetime.datetime.utcnow(),
+            'md5': md5,
+            'sha256': sha256,
+            'refcount': 1,
+        }
+        if 'content_type' in kwargs:
+            kwargs['contentType'] = kwargs.pop('content_type')
+        for key, value in kwargs.items():
+            document.setdefault(key, value)
+
+        try:
+            _insert(self.files, [document])
+        except DuplicateKeyError:
+            # The same content was stored concurrently: keep that copy
+            self._rollback(file_id)
+            existing = self._reference(sha256)
+            if existing is None:
+                raise
+            return existing
+        except Exception:
+            self._rollback(file_id)
+            raise
+
+        return file_id
+
+    def _upload(self, file_id, data):
+        """
+        Write the chunks of ``data`` and return its length, md5 and sha256.
+        """
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        length = 0
+        batch = []
+        # Small files are inserted inline: the first full batch is held back,
+        # and writer threads are only started once a second one comes
+        first = None
+        writer = None
+
+        try:
+            for n, block in enumerate(self._blocks(data)):
+                md5.update(block)
+                sha256.update(block)
+                length += len(block)
+                batch.append({'files_id': file_id, 'n': n, 'data': Binary(block)})
+                if len(batch) == self.batch_size:
+                    if first is None:
+                        first = batch
+                    else:
+                        if writer is None:
+                            writer = _ChunkWriter(self.chunks, self.workers)
+                            writer.write(first)
+                        writer.write(batch)
+                    batch = []
+
+            if writer is not None:
+                if batch:
+                    writer.write(batch)
+            else:
+                for documents in (first, batch):
+                    if documents:
+                        _insert(self.chunks, documents)
+        finally:
+            if writer is not None:
+                writer.close()
+
+        return length, md5.hexdigest(), sha256.hexdigest()
+
+    def _rollback(self, file_id):
+        _remove(self.chunks, {'files_id': file_id})
+
+    def release(self, file_id):
+        """
+        Drop a reference to the file ``file_id``, and delete the file when it
+        was the last one. Returns True if the file was deleted.
+        """
+        document = _find_and_modify(self.files, {'_id': file_id},
+                                    {'$inc': {'refcount': -1}})
+        if document is None or document.get('refcount', 0) > 0:
+            return False
+
+        # Only delete it if no put() took a new reference in the meantime
+        if not _remove(self.files, {'_id': file_id, 'refcount': {'$lte': 0}}):
+            return False
+        self._rollback(file_id)
+        return True
@@ -9,9 +9,25 @@ try:
 except ImportError:
     DEFAULT_PAGINATION = 25
 
+import calendar
+import mimetypes
+import re
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from gridfs.errors import NoFile
 from django.views.generic.base import View
-from django.http import Http404, HttpResponseRedirect
+from django.http import (Http404, HttpResponse, HttpResponseNotModified,
+                         HttpResponseRedirect, StreamingHttpResponse)
+try:
+    from django.http import FileResponse
+except ImportError:
+    # Django < 1.8
+    FileResponse = StreamingHttpResponse
 from django.template.response import TemplateResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+RANGE_RE = re.compile(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$', re.I)
 
 
 class BaseMongoMixin(object):
@@ -22,6 +38,16 @@ class BaseMongoMixin(object):
     context_object_name = None
     template_name = None
     class_type = None
+    read_from_secondary = False
+
+    def get_read_collection(self):
+        """
+        The collection to send find and count traffic to: the connection's
+        ``read_api`` if ``read_from_secondary`` is set, its ``api`` otherwise.
+        """
+        if self.read_from_secondary:
+            return self.connection.read_api
+        return self.connection.api
 
     def get_context_data(self, *args, **kwargs):
         context = {'object_list': self.results}
@@ -67,7 +93,7 @@ class DetailView(BaseMongoMixin, View):
         if self.query:
             kwargs.update(self.query)
 
-        obj_query = self.connection.api.find_one(kwargs, sort=self.sort)
+        obj_query = self.get_read_collection().find_one(kwargs, sort=self.sort)
 
         if obj_query == None:
             raise Http404(u"List is empty.")
@@ -117,7 +143,7 @@ class PagelessListView(BaseMongoMixin, View):
         if self.query:
             kwargs.update(self.query)
         # Get the total count and the number of pages.
-        obj_query = self.connection.api.find(kwargs, sort=self.sort)
+        obj_query = self.get_read_collection().find(kwargs, sort=self.sort)
 
         query_list = []
 
@@ -179,7 +205,7 @@ class ListView(BasePaginatedMongoMixin, View):
         if self.query:
             kwargs.update(self.query)
         # Get the total count and the number of pages.
-        total_count = self.connection.api.find(kwargs, sort=self.sort).count()
+        total_count = self.get_read_collection().find(kwargs, sort=self.sort).count()
 
         if (total_count % self.pagination_limit) > 0:
             self.pages = (total_count / self.pagination_limit) + 1
@@ -237,7 +263,7 @@ class ListView(BasePaginatedMongoMixin, View):
             return redirect_url, 'redirect'
 
         # Send along the connection query with the sort attached.
-        obj_query = self.connection.api.find(kwargs, limit=self.pagination_limit, skip=self.offset, sort=self.sort)
+        obj_query = self.get_read_collection().find(kwargs, limit=self.pagination_limit, skip=self.offset, sort=self.sort)
 
         # Set up a query list.
         query_list = []
@@ -284,3 +310,192 @@ class ListView(BasePaginatedMongoMixin, View):
 
             #... execute the redirect.
             return HttpResponseRedirect(self.get_list()[0])
+
+
+class GridFSFileView(View):
+    """
+    Serves files stored in GridFS, reading them one chunk at a time so that
+    large files go out in constant memory.
+
+    The file is looked up by the ``pk`` URL keyword argument (an ObjectId),
+    or by the last version of ``filename``:
+
+    ::
+
+        url(r'^media/(?P<pk>[0-9a-f]{24})$',
+            GridFSFileView.as_view(connection=Connection(db='media', collection='fs'))),
+
+    Responses carry an ``ETag`` (the file's md5) and a ``Last-Modified``
+    date (its upload date), and conditional requests are answered with a
+    304. A single ``Range`` of bytes is answered with a 206 holding just
+    that range; the file is read from the chunk the range starts in.
+
+    With a :class:`GridFSFileCache <mongolier.filecache.GridFSFileCache>` as
+    ``file_cache``, files are served from their local copy instead, whole
+    files as a ``FileResponse`` (which the server may send with sendfile).
+    Only requests for the whole file download it: ranges of files not cached
+    yet are read from GridFS.
+    """
+    connection = None
+    file_cache = None
+    content_type = None
+    as_attachment = False
+    cache_control = None
+    #: The number of bytes read at a time, the file's chunk size by default
+    block_size = None
+
+    def get_file(self, *args, **kwargs):
+        """
+        Return the ``GridOut`` to serve, or raise ``Http404``.
+        """
+        fs = self.connection.fs
+        try:
+            if 'pk' in kwargs:
+                return fs.get(ObjectId(kwargs['pk']))
+            if 'filename' in kwargs:
+                return fs.get_last_version(kwargs['filename'])
+        except (InvalidId, NoFile):
+            pass
+        raise Http404(u"File does not exist.")
+
+    def get_etag(self, grid_file):
+        md5 = getattr(grid_file, 'md5', None)
+        if md5 is None:
+            # md5 may be disabled in pymongo 3.7+
+            md5 = '%s-%s' % (grid_file._id, grid_file.length)
+        return '"%s"' % md5
+
+    def get_last_modified(self, grid_file):
+        return calendar.timegm(grid_file.upload_date.utctimetuple())
+
+    def get_content_type(self, grid_file):
+        if self.content_type:
+            return self.content_type
+        content_type = getattr(grid_file, 'content_type', None)
+        if not content_type and grid_file.filename:
+            content_type = mimetypes.guess_type(grid_file.filename)[0]
+        return content_type or 'application/octet-stream'
+
+    def not_modified(self, request, etag, last_modified):
+        """
+        Whether the client's copy is current. ``If-None-Match`` wins over
+        ``If-Modified-Since``.
+        """
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+
+        if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since is not None:
+            since = parse_http_date_safe(if_modified_since.split(';')[0])
+            return since is not None and last_modified <= since
+
+        return False
+
+    def get_range(self, request, length, etag, last_modified):
+        """
+        Return the ``(start, end)`` (inclusive) byte range requested, ``None``
+        to send the whole file, or ``False`` if the range can't be satisfied.
+        """
+        header = request.META.get('HTTP_RANGE')
+        if not header:
+            return None
+
+        # If-Range: only send a range of the version the client has
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if if_range is not None and if_range != etag \
+                and parse_http_date_safe(if_range) != last_modified:
+            return None
+
+        match = RANGE_RE.match(header)
+        if match is None:
+            # Several ranges, or a syntax we don't handle: send everything
+            return None
+
+        start, end = match.groups()
+        if not start and not end:
+            return None
+        if not start:
+            # The last ``end`` bytes
+            suffix = int(end)
+            if not suffix:
+                return False
+            return max(length - suffix, 0), length - 1
+
+        start = int(start)
+        end = min(int(end), length - 1) if end else length - 1
+        if start >= length or start > end:
+            return False
+        return start, end
+
+    def stream(self, grid_file, start, length, source=None):
+        """
+        Yield ``length`` bytes of ``grid_file`` from ``start``, read from
+        ``source`` (its local copy) if given.
+        """
+        block_size = self.block_size or grid_file.chunk_size
+        source = source or grid_file
+        try:
+            if start:
+                source.seek(start)
+            remaining = length
+            while remaining > 0:
+                data = source.read(min(block_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        finally:
+            if source is not grid_file:
+                source.close()
+
+    def get(self, request, *args, **kwargs):
+        grid_file = self.get_file(*args, **kwargs)
+        etag = self.get_etag(grid_file)
+        last_modified = self.get_last_modified(grid_file)
+
+        if self.not_modified(request, etag, last_modified):
+            response = HttpResponseNotModified()
+        else:
+            length = grid_file.length
+            requested = self.get_range(request, length, etag, last_modified)
+
+            if requested is False:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%s' % length
+            else:
+                local_file = None
+                if self.file_cache is not None:
+                    # Don't download a large file to send a few bytes of it
+                    local_file = self.file_cache.open(grid_file,
+                                                      download=requested is None)
+
+                if requested is None and local_file is not None:
+                    response = FileResponse(local_file,
+                                            content_type=self.get_content_type(grid_file))
+                    response['Content-Length'] = str(length)
+                elif requested is None:
+                    response = StreamingHttpResponse(self.stream(grid_file, 0, length),
+                                                     content_type=self.get_content_type(grid_file))
+                    response['Content-Length'] = str(length)
+                else:
+                    start, end = requested
+                    response = StreamingHttpResponse(self.stream(grid_file, start,
+                                                                 end - start + 1,
+                                                                 local_file),
+                                                     content_type=self.get_content_type(grid_file),
+                                                     status=206)
+                    response['Content-Length'] = str(end - start + 1)
+                    response['Content-Range'] = 'bytes %s-%s/%s' % (start, end, length)
+
+            response['Accept-Ranges'] = 'bytes'
+            if self.as_attachment and grid_file.filename:
+                response['Content-Disposition'] = 'attachment; filename="%s"' \
+                    % grid_file.filename.replace('"', '')
+
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        if self.cache_control:
+            response['Cache-Control'] = self.cache_control
+        return response
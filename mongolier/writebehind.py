@@ -0,0 +1,257 @@
+"""
+writebehind.py
+
+Fire-and-forget writes: operations are queued in memory and written in
+batches by a background thread, so that a request does not wait on the
+database to write analytics or page-view documents.
+
+::
+
+    queue = my_connection.write_behind(max_size=10000, when_full='drop')
+    queue.insert('page_views', {'path': request.path, 'at': now})
+
+    queue.stats()
+    # {'depth': 12, 'enqueued': 40210, 'written': 40198, 'dropped': 0, ...}
+
+Queued writes are flushed when the process exits. Writes that are still
+queued when a process crashes are lost, so only use this for data that can
+afford it.
+"""
+import atexit
+import logging
+import threading
+import time
+import weakref
+
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
+
+from mongolier.exceptions import IncorrectParameters
+from mongolier.pool import check_fork, register_after_fork
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def _shutdown_at_exit(reference):
+    queue = reference()
+    if queue is not None:
+        queue.shutdown()
+
+
+class WriteBehindQueue(object):
+    """
+    A bounded queue of writes, drained by a worker thread into unordered
+    bulk writes of up to ``batch_size`` operations per collection. Batches
+    are also flushed every ``flush_interval`` seconds.
+
+    When the queue holds ``max_size`` operations, new writes either wait
+    for room (``when_full='block'``, for at most ``block_timeout`` seconds,
+    then are dropped) or are dropped straight away (``when_full='drop'``).
+    ``block_timeout=None`` waits for as long as the database is down.
+    """
+    def __init__(self,
+                connection,
+                max_size=10000,
+                when_full='block',
+                block_timeout=5,
+                batch_size=500,
+                flush_interval=1.0,
+                shutdown_timeout=10):
+        if when_full not in ('block', 'drop'):
+            raise IncorrectParameters("when_full must be 'block' or 'drop'")
+
+        self.connection = connection
+        self.max_size = max_size
+        self.when_full = when_full
+        self.block_timeout = block_timeout
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.shutdown_timeout = shutdown_timeout
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'enqueued': 0,
+            'dropped': 0,
+            'written': 0,
+            'failed': 0,
+            'batches': 0,
+            'last_error': None,
+        }
+        self._closed = False
+        self._start()
+
+        register_after_fork(self)
+        # Only a weak reference, so the queue can be collected before exit
+        atexit.register(_shutdown_at_exit, weakref.ref(self))
+
+    def _start(self):
+        self._queue = Queue(self.max_size)
+        self._thread = threading.Thread(target=self._run, name='mongolier-write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _after_fork(self):
+        """
+        The worker thread does not survive a fork, and the writes queued in
+        the parent are the parent's to write: start over with an empty queue.
+        """
+        self._stats_lock = threading.Lock()
+        if not self._closed:
+            self._start()
+
+    def insert(self, collection, document):
+        """
+        Queue an insert into ``collection``. Returns False if it was dropped.
+        """
+        return self._put(collection, 'insert', (document,))
+
+    def update(self, collection, spec, document, upsert=False, multi=False):
+        """
+        Queue an update of ``collection``. Returns False if it was dropped.
+        """
+        return self._put(collection, 'update', (spec, document, upsert, multi))
+
+    def upsert(self, collection, spec, document, multi=False):
+        """
+        Queue an upsert into ``collection``. Returns False if it was dropped.
+        """
+        return self.update(collection, spec, document, upsert=True, multi=multi)
+
+    def remove(self, collection, spec, multi=True):
+        """
+        Queue a removal from ``collection``. Returns False if it was dropped.
+        """
+        return self._put(collection, 'remove', (spec, multi))
+
+    def _put(self, collection, method, args):
+        check_fork()
+        if self._closed:
+            raise IncorrectParameters('This write-behind queue has been shut down.')
+
+        item = (collection, method, args)
+        try:
+            if self.when_full == 'drop':
+                self._queue.put_nowait(item)
+            else:
+                self._queue.put(item, timeout=self.block_timeout)
+        except Full:
+            self._count('dropped')
+            return False
+
+        self._count('enqueued')
+        return True
+
+    def _count(self, counter, amount=1):
+        with self._stats_lock:
+            self._stats[counter] += amount
+
+    def _run(self):
+        writers = {}
+        last_flush = time.time()
+
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except Empty:
+                item = None
+
+            if item is _STOP:
+                self._flush_all(writers)
+                self._queue.task_done()
+                return
+
+            if item is not None:
+                collection, method, args = item
+                writer = writers.get(collection)
+                if writer is None:
+                    try:
+                        writer = writers[collection] = self.connection.bulk(
+                            collection=collection, ordered=False,
+                            batch_size=float('inf'))
+                    except Exception as error:
+                        self._failed(1, error)
+                        self._queue.task_done()
+                        continue
+
+                try:
+                    getattr(writer, method)(*args)
+                except Exception as error:
+                    self._failed(1, error)
+                    self._queue.task_done()
+                    continue
+                if len(writer) >= self.batch_size:
+                    self._flush(writer)
+
+            if item is None or time.time() - last_flush >= self.flush_interval:
+                self._flush_all(writers)
+                last_flush = time.time()
+
+    def _flush_all(self, writers):
+        for writer in writers.values():
+            self._flush(writer)
+
+    def _flush(self, writer):
+        count = len(writer)
+        if not count:
+            return
+
+        try:
+            result = writer.flush()
+        except Exception as error:
+            self._failed(count, error)
+        else:
+            errors = len(result['write_errors'])
+            with self._stats_lock:
+                self._stats['batches'] += 1
+                self._stats['written'] += count - errors
+                self._stats['failed'] += errors
+        finally:
+            for _ in range(count):
+                self._queue.task_done()
+
+    def _failed(self, count, error):
+        logger.error('Write-behind batch of %s operations failed: %s', count, error)
+        with self._stats_lock:
+            self._stats['failed'] += count
+            self._stats['last_error'] = str(error)
+
+    def flush(self):
+        """
+        Block until every write queued so far has been written (or has failed).
+        """
+        self._queue.join()
+
+    def shutdown(self, timeout=None):
+        """
+        Stop accepting writes, write what is queued and stop the worker.
+        Waits for at most ``timeout`` seconds (``shutdown_timeout`` by
+        default). Called automatically when the process exits.
+        """
+        if self._closed:
+            return
+        self._closed = True
+
+        timeout = self.shutdown_timeout if timeout is None else timeout
+        if self._thread.is_alive():
+            try:
+                self._queue.put(_STOP, timeout=timeout)
+            except Full:
+                logger.error('Write-behind queue still full at shutdown, %s writes lost',
+                             self._queue.qsize())
+                return
+            self._thread.join(timeout)
+
+    def stats(self):
+        """
+        Return the queue depth and the enqueued, dropped, written and failed
+        counters.
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['depth'] = self._queue.qsize()
+        stats['max_size'] = self.max_size
+        return stats
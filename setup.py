@@ -1,11 +1,29 @@
 #!/usr/bin/env python
+import sys
+
 try:
     from setuptools import setup
+    from setuptools.command.build_py import build_py
 except ImportError:
     from distutils.core import setup
+    from distutils.command.build_py import build_py
 
 import mongolier
 
+
+class BuildPy(build_py):
+    """
+    Leaves out the modules written in Python 3 only syntax on older Pythons,
+    where byte-compiling them would fail.
+    """
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info < (3, 5):
+            modules = [module for module in modules
+                       if (module[0], module[1]) != ('mongolier', 'asyncdb')]
+        return modules
+
+
 setup(name='django-mongolier',
         version=mongolier.__version__,
         description='A lightweight wrapper for using django with MongoDB (pymongo)',
@@ -15,6 +33,7 @@ setup(name='django-mongolier',
         packages=['mongolier','mongolier.utils'],
         install_requires=['pymongo',],
         license=mongolier.__license__,
+        cmdclass={'build_py': BuildPy},
         classifiers=[
             'Environment :: Web Environment',
             'Framework :: Django',
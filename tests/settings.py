@@ -32,5 +32,8 @@ TEMPLATE_DEBUG = DEBUG
 
 INSTALLED_APPS = (
     'django.contrib.auth',
+    # For its management commands; nothing is pre-warmed without
+    # MONGOLIER_PREWARM_CONNECTIONS
+    'mongolier',
     'tests.testapp',
 )
@@ -0,0 +1,45 @@
+import unittest
+
+from mongolier import Connection
+
+
+class TestQueryCache(unittest.TestCase):
+    """
+    Test caching query results in the Django cache
+    """
+
+    def setUp(self):
+        self.connection = Connection(db='test', collection='mongolier_test')
+        self.connection.api.insert({'mongolier-cache-test': 1, 'value': 'original'})
+        self.cached = self.connection.cached(ttl=60)
+
+    def test(self):
+        """
+        Results are served from the cache until a write through the
+        connection invalidates them.
+        """
+        query = {'mongolier-cache-test': 1}
+        self.assertEqual(self.cached.find_one(query)['value'], 'original')
+        self.assertEqual(self.cached.count(query), 1)
+
+        # Writes made behind the connection's back are not seen...
+        self.connection.pool.get(self.connection.host, self.connection.port)\
+            .client[self.connection.db][self.connection.collection]\
+            .update(query, {'$set': {'value': 'behind'}})
+        self.assertEqual(self.cached.find_one(query)['value'], 'original')
+
+        # ...writes through the connection are.
+        self.connection.api.update(query, {'$set': {'value': 'changed'}})
+        self.assertEqual(self.cached.find_one(query)['value'], 'changed')
+        self.assertEqual(self.cached.find(query, limit=1)[0]['value'], 'changed')
+
+    def test_none(self):
+        """
+        Missing documents are cached too.
+        """
+        self.assertEqual(self.cached.find_one({'mongolier-cache-test': 2}), None)
+        self.connection.api.insert({'mongolier-cache-test': 2})
+        self.assertNotEqual(self.cached.find_one({'mongolier-cache-test': 2}), None)
+
+    def tearDown(self):
+        self.connection.api.drop()
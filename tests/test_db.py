@@ -1,7 +1,25 @@
+import io
+import sys
+import time
 import unittest
 
+from pymongo.database import Database
+from pymongo.errors import AutoReconnect, BulkWriteError
+
 from mongolier import Connection
+from mongolier.counters import IncrementAggregator
 from mongolier.exceptions import InvalidMode
+from mongolier.monitor import HealthMonitor, warm
+from mongolier.pool import ClientPool
+
+
+def client_of(handle):
+    """
+    The client behind a collection handle. Checked on the class: databases
+    return a collection for any attribute they don't have.
+    """
+    database = handle.database
+    return database.client if hasattr(Database, 'client') else database.connection
 
 
 class TestConnection(unittest.TestCase):
@@ -30,12 +48,278 @@ class TestConnection(unittest.TestCase):
         data_from_db_2 = self.connection['mongolier_test2'].find_one({'mongolier-test': 2})
         self.assertEqual(data_from_db_2['mongolier-test'], 2)
 
+    def test_read_api(self):
+        """
+        Reads through ``read_api`` and ``read`` prefer secondaries, ``api``
+        keeps the client's read preference.
+        """
+        from pymongo import ReadPreference
+
+        def mode(read_preference):
+            # Read preferences are plain ints in pymongo 2
+            return getattr(read_preference, 'mode', read_preference)
+
+        self.assertEqual(mode(self.connection.read_api.read_preference),
+                         mode(ReadPreference.SECONDARY_PREFERRED))
+        self.assertEqual(mode(self.connection.api.read_preference),
+                         mode(ReadPreference.PRIMARY))
+        self.assertIs(self.connection.read.mongolier_test2,
+                      self.connection.read['mongolier_test2'])
+
+    def test_bulk(self):
+        """
+        Test batching writes with the bulk writer.
+        """
+        with self.connection.bulk(batch_size=4, ordered=False) as bulk:
+            for number in range(6):
+                bulk.insert({'mongolier-bulk-test': number})
+            bulk.upsert({'mongolier-bulk-test': 6}, {'$set': {'upserted': True}})
+            bulk.update({'mongolier-bulk-test': 0}, {'$set': {'updated': True}})
+            bulk.remove({'mongolier-bulk-test': 1})
+
+        self.assertEqual([result['operations'] for result in bulk.results], [4, 4, 1])
+        self.assertEqual(sum(result['inserted'] for result in bulk.results), 6)
+        self.assertEqual(bulk.results[1]['upserted'], 1)
+        self.assertEqual(bulk.results[2]['removed'], 1)
+        self.assertEqual(bulk.errors, [])
+        self.assertEqual(self.connection.api.find({'mongolier-bulk-test': {'$exists': True}}).count(), 6)
+        self.assertTrue(self.connection.api.find_one({'mongolier-bulk-test': 0})['updated'])
+
+        # Time-driven flushes happen on flush_if_due(), not by themselves
+        bulk = self.connection.bulk(flush_interval=0)
+        self.assertEqual(bulk.flush_if_due(), None)
+        bulk.insert({'mongolier-bulk-test': 7})
+        self.assertEqual(len(bulk), 0)
+        bulk = self.connection.bulk(flush_interval=3600)
+        bulk.insert({'mongolier-bulk-test': 8})
+        self.assertEqual(bulk.flush_if_due(), None)
+        self.assertEqual(len(bulk), 1)
+
+        # An error in the block discards what is queued
+        try:
+            with self.connection.bulk() as bulk:
+                bulk.insert({'mongolier-bulk-test': 9})
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(len(bulk), 0)
+        self.assertEqual(self.connection.api.find_one({'mongolier-bulk-test': 9}), None)
+
+    def test_write_behind(self):
+        """
+        Queued writes are written by the background worker.
+        """
+        queue = self.connection.write_behind(batch_size=3, flush_interval=0.1)
+        self.assertIs(queue, self.connection.write_behind())
+
+        for number in range(5):
+            self.assertTrue(queue.insert('mongolier_test2', {'mongolier-queue-test': number}))
+        queue.flush()
+
+        stats = queue.stats()
+        self.assertEqual(stats['enqueued'], 5)
+        self.assertEqual(stats['written'], 5)
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(self.connection.mongolier_test2.find(
+            {'mongolier-queue-test': {'$exists': True}}).count(), 5)
+        queue.shutdown()
+
+    def test_increments(self):
+        """
+        Increments are summed in memory and written in one update per document.
+        """
+        counters = self.connection.increments(flush_interval=None)
+        for _ in range(10):
+            counters.incr('mongolier_test2', 'article', 'views')
+        counters.incr('mongolier_test2', 'article', 'votes', 3)
+        self.assertEqual(counters.pending('mongolier_test2', 'article', 'views'), 10)
+
+        self.assertEqual(counters.flush(), 1)
+        document = self.connection.mongolier_test2.find_one('article')
+        self.assertEqual(document['views'], 10)
+        self.assertEqual(document['votes'], 3)
+        self.assertEqual(counters.stats()['pending_documents'], 0)
+
+    def test_increments_restart(self):
+        """
+        Increments made after stop() are flushed by a new thread.
+        """
+        counters = self.connection.increments(flush_interval=0.05)
+        counters.incr('mongolier_test2', 'article', 'views')
+        counters.stop()
+        counters.incr('mongolier_test2', 'article', 'views')
+        time.sleep(0.5)
+        self.assertEqual(counters.pending('mongolier_test2', 'article', 'views'), 0)
+        self.assertEqual(self.connection.mongolier_test2.find_one('article')['views'], 2)
+        counters.stop()
+
+    def test_increments_failures(self):
+        """
+        Only the increments that were certainly not written are retried.
+        """
+        self.connection.mongolier_test2.save({'_id': 'broken', 'views': 'many'})
+        counters = self.connection.increments(flush_interval=None)
+        counters.incr('mongolier_test2', 'article', 'views')
+        counters.incr('mongolier_test2', 'broken', 'views')
+
+        self.assertRaises(BulkWriteError, counters.flush)
+        self.assertEqual(self.connection.mongolier_test2.find_one('article')['views'], 1)
+        self.assertEqual(counters.pending('mongolier_test2', 'article', 'views'), 0)
+        self.assertEqual(counters.pending('mongolier_test2', 'broken', 'views'), 1)
+
+        # Whether anything was applied is unknown: nothing is put back
+        def unreachable(**kwargs):
+            raise AutoReconnect('connection closed')
+
+        counters = IncrementAggregator(self.connection, flush_interval=None)
+        self.connection.bulk = unreachable
+        counters.incr('mongolier_test2', 'article', 'views')
+        self.assertRaises(AutoReconnect, counters.flush)
+        self.assertEqual(counters.pending('mongolier_test2', 'article', 'views'), 0)
+        self.assertEqual(counters.stats()['failed_updates'], 1)
+        del self.connection.bulk
+
+    def test_cached_handles(self):
+        """
+        Collection handles are reused until the connection is invalidated.
+        """
+        self.assertIs(self.connection.api, self.connection.api)
+        self.assertIs(self.connection.mongolier_test2,
+                      self.connection['mongolier_test2'])
+
+        handle = self.connection.api
+        self.connection.invalidate()
+        self.assertIsNot(handle, self.connection.api)
+
     def tearDown(self):
         # Destroy test data
         self.connection.api.drop()
         self.connection.mongolier_test2.drop()
 
 
+class TestPool(unittest.TestCase):
+    """
+    Test that connections share pooled clients
+    """
+
+    def setUp(self):
+        self.pool = ClientPool(max_pool_size=10)
+
+    def test(self):
+        """
+        Two connections with the same arguments use the same client, a
+        connection with different arguments gets its own.
+        """
+        first = Connection(db='test', collection='mongolier_test', pool=self.pool)
+        second = Connection(db='test', collection='mongolier_test2', pool=self.pool)
+        third = Connection(db='test', collection='mongolier_test',
+                           pool=self.pool, connectTimeoutMS=1000)
+
+        self.assertIs(client_of(first.api), client_of(second.api))
+        self.assertIsNot(client_of(first.api), client_of(third.api))
+
+        stats = self.pool.stats()
+        self.assertEqual(stats['clients'], 2)
+        self.assertEqual(stats['misses'], 2)
+
+        # Nothing has been used for less than a negative timeout
+        self.assertEqual(self.pool.evict_idle(idle_timeout=-1), 2)
+        self.assertEqual(self.pool.stats()['clients'], 0)
+
+    def test_after_fork(self):
+        """
+        Clients inherited from a parent process are dropped, and the handles
+        built on them rebuilt.
+        """
+        connection = Connection(db='test', collection='mongolier_test', pool=self.pool)
+        handle = connection.api
+        client = client_of(handle)
+
+        # What the at-fork hook runs in the child
+        self.pool._after_fork()
+
+        self.assertEqual(self.pool.stats()['clients'], 0)
+        self.assertIsNot(connection.api, handle)
+        self.assertIsNot(client_of(connection.api), client)
+
+    def test_warm(self):
+        """
+        Pre-warming connects and pings, the health monitor reports the result.
+        """
+        connection = Connection(db='test', collection='mongolier_test', pool=self.pool)
+        self.assertEqual(warm(connection, min_sockets=3), 3)
+
+        status = HealthMonitor({'test': connection}).check()
+        self.assertTrue(status['test']['healthy'])
+        self.assertEqual(status['test']['failures'], 0)
+
+    def test_monitor_failures(self):
+        """
+        The pooled client is only discarded after several failed pings in a row.
+        """
+        connection = Connection(port=1, db='test', collection='mongolier_test', pool=self.pool)
+        discards = []
+        connection.invalidate = lambda discard=False: discards.append(discard)
+        monitor = HealthMonitor({'down': connection}, failure_threshold=2, timeout=0.2,
+                                discard=True)
+
+        status = monitor.check()['down']
+        self.assertFalse(status['healthy'])
+        self.assertEqual(discards, [])
+
+        status = monitor.check()['down']
+        self.assertEqual(status['consecutive_failures'], 2)
+        self.assertEqual(discards, [True])
+        monitor.stop()
+
+    def tearDown(self):
+        self.pool.clear()
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'AsyncConnection requires Python 3.5')
+class TestAsyncConnection(unittest.TestCase):
+    """
+    Test the asyncio connection object
+    """
+
+    def setUp(self):
+        import asyncio
+        from mongolier.asyncdb import AsyncConnection
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.connection = AsyncConnection(db='test', collection='mongolier_test')
+
+    def test(self):
+        """
+        Test awaiting collection methods and cursors.
+        """
+        run = self.loop.run_until_complete
+
+        run(self.connection.api.insert({'mongolier-async-test': 1}))
+        data = run(self.connection.api.find_one({'mongolier-async-test': 1}))
+        self.assertEqual(data['mongolier-async-test'], 1)
+
+        documents = run(self.connection['mongolier_test'].find(
+            {'mongolier-async-test': 1}).to_list(10))
+        self.assertEqual(len(documents), 1)
+        self.assertEqual(run(self.connection.api.find().count()), 1)
+        cursor = self.connection.api.find().sort('mongolier-async-test', -1).limit(5)
+        self.assertEqual(run(cursor.distinct('mongolier-async-test')), [1])
+
+        # Everything handed out is awaitable, blocking helpers are refused
+        from mongolier.asyncdb import AsyncCollection
+        self.assertTrue(isinstance(self.connection.read_api, AsyncCollection))
+        self.assertTrue(isinstance(self.connection.read.mongolier_test, AsyncCollection))
+        self.assertEqual(self.connection.db, 'test')
+        self.assertRaises(AttributeError, getattr, self.connection, 'bulk')
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.connection.api.drop())
+        self.connection.close()
+        self.loop.close()
+
+
 class TestGrid(unittest.TestCase):
     """
     Test a gridfs connection
@@ -71,8 +355,63 @@ class TestGrid(unittest.TestCase):
         with self.assertRaises(InvalidMode):
             self.connection.api.find()
 
+    def test_mixed(self):
+        """
+        Other collections can be used through the API next to a bucket, on
+        the same client.
+        """
+        self.connection.fs.put(self.data, **{'mongolier-grid-test': 1})
+        self.connection.bucket('gridtest_thumbnails').put(self.data)
+
+        self.connection['mongolier_test'].find_one()
+        self.assertTrue(self.connection.get_database() is
+                        self.connection.bucket('gridtest_thumbnails')._GridFS__database)
+
+        for collection in ('gridtest.files', 'gridtest_thumbnails.chunks'):
+            with self.assertRaises(InvalidMode):
+                self.connection[collection].find_one()
+        with self.assertRaises(InvalidMode):
+            self.connection.bucket('mongolier_test')
+
+    def test_storage(self):
+        """
+        Identical content is stored once, whether or not it can be hashed
+        before uploading.
+        """
+        class Stream(object):
+            # A file-like object that can't seek
+            def __init__(self, data):
+                self.data = data
+
+            def read(self, size):
+                data, self.data = self.data[:size], self.data[size:]
+                return data
+
+        data = b'0123456789' * 1000
+        storage = self.connection.storage(bucket='gridtest_storage', chunk_size=64,
+                                          batch_size=8)
+
+        file_id = storage.put(data, filename='digits.txt')
+        self.assertEqual(storage.put(io.BytesIO(data)), file_id)
+        self.assertEqual(storage.put(Stream(data)), file_id)
+        self.assertEqual(storage.files.find_one(file_id)['refcount'], 3)
+        self.assertEqual(storage.chunks.find({'files_id': file_id}).count(), 157)
+        self.assertEqual(storage.chunks.count(), 157)
+
+        self.assertEqual(self.connection.bucket('gridtest_storage').get(file_id).read(), data)
+        self.assertNotEqual(storage.put(Stream(data[1:])), file_id)
+
+        self.assertFalse(storage.release(file_id))
+        self.assertFalse(storage.release(file_id))
+        self.assertTrue(storage.release(file_id))
+        self.assertEqual(storage.chunks.find({'files_id': file_id}).count(), 0)
+
     def tearDown(self):
         # Destroy test data
         connection = Connection(**self.connection_info)
         connection['gridtest.chunks'].drop()
         connection['gridtest.files'].drop()
+        connection['gridtest_thumbnails.chunks'].drop()
+        connection['gridtest_thumbnails.files'].drop()
+        connection['gridtest_storage.chunks'].drop()
+        connection['gridtest_storage.files'].drop()
@@ -0,0 +1,106 @@
+import unittest
+
+from mongolier.collection import get_document_id
+from mongolier.documents import DocumentCache
+
+
+class TestDocumentCache(unittest.TestCase):
+    """
+    Test the document cache, without a database
+    """
+
+    def setUp(self):
+        self.cache = DocumentCache(max_entries=2)
+
+    def test_copies(self):
+        """
+        Every hit hands out a fresh copy of the document.
+        """
+        self.cache.set('articles', 1, {'_id': 1, 'tags': ['a']})
+        self.cache.get('articles', 1)['tags'].append('b')
+        self.assertEqual(self.cache.get('articles', 1), {'_id': 1, 'tags': ['a']})
+        self.assertEqual(self.cache.get('articles', 2), None)
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_lru(self):
+        """
+        The least recently used document is evicted first.
+        """
+        self.cache.set('articles', 1, {'_id': 1})
+        self.cache.set('articles', 2, {'_id': 2})
+        self.cache.get('articles', 1)
+        self.cache.set('articles', 3, {'_id': 3})
+
+        self.assertEqual(self.cache.get('articles', 2), None)
+        self.assertNotEqual(self.cache.get('articles', 1), None)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_max_bytes(self):
+        cache = DocumentCache(max_bytes=100)
+        cache.set('articles', 1, {'_id': 1, 'body': 'x' * 60})
+        cache.set('articles', 2, {'_id': 2, 'body': 'x' * 60})
+        self.assertEqual(len(cache), 1)
+        self.assertTrue(cache.stats()['bytes'] <= 100)
+
+        cache.set('articles', 3, {'_id': 3, 'body': 'x' * 200})
+        self.assertEqual(cache.get('articles', 3), None)
+
+    def test_ttl(self):
+        cache = DocumentCache(ttl=-1)
+        cache.set('articles', 1, {'_id': 1})
+        self.assertEqual(cache.get('articles', 1), None)
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_invalidate(self):
+        self.cache.set('articles', 1, {'_id': 1})
+        self.cache.set('authors', 1, {'_id': 1})
+
+        self.cache.invalidate('articles', [1, {'unhashable': True}])
+        self.assertEqual(self.cache.get('articles', 1), None)
+        self.assertNotEqual(self.cache.get('authors', 1), None)
+
+        self.cache.invalidate('authors')
+        self.assertEqual(len(self.cache), 0)
+
+    def test_invalidate_database(self):
+        self.cache.set('test.articles', 1, {'_id': 1})
+        self.cache.set('other.articles', 1, {'_id': 1})
+        generation = self.cache.generation('test.authors')
+
+        self.cache.invalidate_database('test')
+        self.assertEqual(self.cache.get('test.articles', 1), None)
+        self.assertNotEqual(self.cache.get('other.articles', 1), None)
+
+        self.cache.set('test.authors', 1, {'_id': 1}, generation)
+        self.assertEqual(self.cache.get('test.authors', 1), None)
+
+    def test_generation(self):
+        """
+        A document fetched before an invalidation is not cached.
+        """
+        generation = self.cache.generation('articles')
+        self.cache.invalidate('articles', [1])
+        self.cache.set('articles', 1, {'_id': 1}, generation)
+        self.assertEqual(self.cache.get('articles', 1), None)
+
+        # Writes to other collections do not get in the way
+        generation = self.cache.generation('articles')
+        self.cache.invalidate('authors', [1])
+        self.cache.set('articles', 1, {'_id': 1}, generation)
+        self.assertNotEqual(self.cache.get('articles', 1), None)
+
+        generation = self.cache.generation('articles')
+        self.cache.clear()
+        self.cache.set('articles', 1, {'_id': 1}, generation)
+        self.assertEqual(self.cache.get('articles', 1), None)
+
+    def test_get_document_id(self):
+        self.assertEqual(get_document_id((1,), {}), 1)
+        self.assertEqual(get_document_id(({'_id': 1},), {'sort': None}), 1)
+        self.assertEqual(get_document_id(({'_id': {'$in': [1]}},), {}), None)
+        self.assertEqual(get_document_id(({'_id': 1, 'a': 2},), {}), None)
+        self.assertEqual(get_document_id(({'_id': 1}, ['a']), {}), None)
+        self.assertEqual(get_document_id(({'_id': 1},), {'skip': 1}), None)
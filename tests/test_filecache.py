@@ -0,0 +1,76 @@
+import datetime
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from mongolier.filecache import GridFSFileCache
+
+
+class GridOut(io.BytesIO):
+    """
+    Enough of a GridOut for the file cache
+    """
+    chunk_size = 4
+
+    def __init__(self, _id, data):
+        io.BytesIO.__init__(self, data)
+        self._id = _id
+        self.length = len(data)
+        self.md5 = 'md5-%s' % hash(data)
+        self.upload_date = datetime.datetime(2012, 1, 1)
+
+
+class TestGridFSFileCache(unittest.TestCase):
+    """
+    Test the local GridFS file cache, without a database
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = GridFSFileCache(self.directory, max_bytes=25)
+
+    def test(self):
+        grid_file = GridOut(1, b'0123456789')
+        with self.cache.open(grid_file) as local_file:
+            self.assertEqual(local_file.read(), b'0123456789')
+        self.assertEqual(self.cache.mmap(grid_file)[2:5], b'234')
+
+        stats = self.cache.stats()
+        self.assertEqual((stats['misses'], stats['hits'], stats['bytes']), (1, 1, 10))
+        # No temporary file left behind
+        self.assertEqual(os.listdir(self.directory), [GridFSFileCache.key(grid_file)])
+
+    def test_no_download(self):
+        grid_file = GridOut(1, b'0123456789')
+        self.assertEqual(self.cache.open(grid_file, download=False), None)
+        self.assertEqual(os.listdir(self.directory), [])
+
+        self.cache.path(grid_file)
+        with self.cache.open(grid_file, download=False) as local_file:
+            self.assertEqual(local_file.read(), b'0123456789')
+
+    def test_unsafe_id(self):
+        grid_file = GridOut('../../escaped/name', b'0123456789')
+        with self.cache.open(grid_file) as local_file:
+            self.assertEqual(local_file.read(), b'0123456789')
+        self.assertEqual(os.listdir(self.directory), [GridFSFileCache.key(grid_file)])
+        self.assertFalse(os.sep in GridFSFileCache.key(grid_file))
+
+    def test_lru(self):
+        first, second, third = [GridOut(_id, b'x' * 10) for _id in (1, 2, 3)]
+        self.cache.path(first)
+        self.cache.path(second)
+        self.cache.path(first)
+        self.cache.path(third)
+
+        self.assertFalse(os.path.exists(os.path.join(self.directory, GridFSFileCache.key(second))))
+        self.assertTrue(os.path.exists(self.cache.path(first)))
+        self.assertEqual(self.cache.path(GridOut(4, b'x' * 30)), None)
+
+        # Another cache on the same directory picks the files up
+        self.assertEqual(GridFSFileCache(self.directory, max_bytes=25).stats()['files'], 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
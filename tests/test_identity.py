@@ -0,0 +1,52 @@
+import unittest
+
+from mongolier import identity
+from mongolier.middleware import IdentityMapMiddleware
+
+
+class TestIdentityMap(unittest.TestCase):
+    """
+    Test the request-scoped identity map, without a database
+    """
+
+    def test(self):
+        with identity.identity_map() as current:
+            key = current.key('test.articles', 'find_one', ({'slug': 'palm'},), {})
+            self.assertTrue(current.get('articles', key) is identity.MISSING)
+
+            current.set('articles', key, {'tags': ['a']})
+            current.get('articles', key)['tags'].append('b')
+            self.assertEqual(current.get('articles', key), {'tags': ['a']})
+
+            identity.invalidate('authors')
+            self.assertEqual(len(current), 1)
+            identity.invalidate('articles')
+            self.assertEqual(len(current), 0)
+
+        self.assertEqual(identity.get_identity_map(), None)
+
+    def test_key(self):
+        current = identity.IdentityMap()
+        self.assertEqual(current.key('test.articles', 'find_one', ({'a': 1, 'b': 2},), {}),
+                         current.key('test.articles', 'find_one', ({'b': 2, 'a': 1},), {}))
+        self.assertNotEqual(current.key('test.articles', 'find_one', ({'a': 1},), {}),
+                            current.key('test.articles', 'count', ({'a': 1},), {}))
+        self.assertEqual(current.key('test.articles', 'find_one', (object(),), {}), None)
+
+    def test_middleware(self):
+        maps = []
+
+        def view(request):
+            maps.append(identity.get_identity_map())
+            return 'response'
+
+        middleware = IdentityMapMiddleware(view)
+        self.assertEqual(middleware(None), 'response')
+        self.assertNotEqual(maps[0], None)
+        self.assertEqual(identity.get_identity_map(), None)
+
+        middleware = IdentityMapMiddleware()
+        middleware.process_request(None)
+        self.assertNotEqual(identity.get_identity_map(), None)
+        self.assertEqual(middleware.process_response(None, 'response'), 'response')
+        self.assertEqual(identity.get_identity_map(), None)
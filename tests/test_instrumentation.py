@@ -0,0 +1,68 @@
+import unittest
+
+from mongolier.instrumentation import Instrumentation, query_shape
+
+
+class TestInstrumentation(unittest.TestCase):
+    """
+    Test the operation timings, without a database
+    """
+
+    def setUp(self):
+        self.instrumentation = Instrumentation(slow_threshold=0.5,
+                                               explain_threshold=1,
+                                               buckets=(0.1, 1))
+
+    def test_query_shape(self):
+        """
+        Queries that only differ by their values share a shape.
+        """
+        self.assertEqual(query_shape({'a': 1, 'b': {'$in': [1, 2]}}),
+                         query_shape({'b': {'$in': [3]}, 'a': 2}))
+        self.assertEqual(query_shape({'$or': [{'a': 1}, {'b': 2}]}),
+                         '{"$or": [{"a": "?"}, {"b": "?"}]}')
+        self.assertNotEqual(query_shape({'a': 1}), query_shape({'a': {'$gt': 1}}))
+
+    def test_histograms(self):
+        """
+        Durations are counted per collection and operation.
+        """
+        self.instrumentation.record('articles', 'find', 0.05)
+        self.instrumentation.record('articles', 'find', 0.5)
+        self.instrumentation.record('articles', 'find', 2, error=True)
+        self.instrumentation.record('authors', 'find_one', 0.01)
+
+        stats = self.instrumentation.stats()
+        self.assertEqual(stats['authors']['find_one']['count'], 1)
+
+        find = stats['articles']['find']
+        self.assertEqual(find['count'], 3)
+        self.assertEqual(find['errors'], 1)
+        self.assertEqual(find['max'], 2)
+        self.assertEqual(find['buckets'], [(0.1, 1), (1, 2), (float('inf'), 3)])
+
+    def test_slow_queries(self):
+        """
+        Slow queries are logged by shape, with their explain output above
+        the explain threshold.
+        """
+        explained = []
+
+        def explain():
+            explained.append(1)
+            return {'cursor': 'BtreeCursor a_1'}
+
+        self.instrumentation.record('articles', 'find', 0.1, query={'a': 1}, explain=explain)
+        self.instrumentation.record('articles', 'find', 0.6, query={'a': 1}, explain=explain)
+        self.instrumentation.record('articles', 'find', 1.2, query={'a': 2}, explain=explain)
+
+        slow = self.instrumentation.slow_queries()
+        self.assertEqual(len(slow), 2)
+        self.assertEqual(slow[0]['shape'], '{"a": "?"}')
+        self.assertEqual(slow[0]['explain'], None)
+        self.assertEqual(slow[1]['explain'], {'cursor': 'BtreeCursor a_1'})
+        self.assertEqual(len(explained), 1)
+
+        self.instrumentation.reset()
+        self.assertEqual(self.instrumentation.slow_queries(), [])
+        self.assertEqual(self.instrumentation.stats(), {})
@@ -0,0 +1,198 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from pymongo import MongoClient
+
+from mongolier import Connection
+from mongolier.invalidation import FileTokenStore, InvalidationWorker
+
+# e.g. MONGOLIER_TEST_REPLSET=localhost:27017 for a node started with
+# ``mongod --replSet rs0`` and ``rs.initiate()``
+REPLSET = os.environ.get('MONGOLIER_TEST_REPLSET')
+
+
+class _OplogCursor(object):
+    def __init__(self, entries, on_exhausted):
+        self.entries = entries
+        self.on_exhausted = on_exhausted
+        self.alive = True
+
+    def __iter__(self):
+        for entry in self.entries:
+            yield entry
+        self.alive = False
+        self.on_exhausted()
+
+
+class _Oplog(object):
+    def __init__(self, entries, on_exhausted):
+        self.entries = entries
+        self.on_exhausted = on_exhausted
+        self.queries = []
+
+    def find(self, *args, **kwargs):
+        self.queries.append((args, kwargs))
+        return _OplogCursor(self.entries, self.on_exhausted)
+
+
+class _Client(object):
+    def __init__(self, oplog):
+        self.local = {'oplog.rs': oplog}
+
+
+class _Database(object):
+    name = 'test'
+
+    def __init__(self, oplog):
+        self.client = self.connection = _Client(oplog)
+
+
+class _Stream(object):
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.alive = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def try_next(self):
+        return self.changes.pop(0) if self.changes else None
+
+
+class _StreamDatabase(object):
+    def __init__(self, changes):
+        self.changes = changes
+
+    def watch(self, pipeline, **options):
+        return _Stream(self.changes)
+
+
+class _TokenStore(object):
+    def __init__(self, token):
+        self.token = token
+
+    def load(self):
+        return self.token
+
+    def save(self, token):
+        self.token = token
+
+
+class TestChangeStreamFollower(unittest.TestCase):
+    """
+    Test following a change stream, without a replica set
+    """
+
+    def test_invalidate(self):
+        """
+        Dropping the database invalidates every collection, and the saved
+        token is forgotten, as resuming from it would replay the invalidate.
+        """
+        changes = []
+        store = _TokenStore({'_data': 'before'})
+        worker = InvalidationWorker(Connection(db='test', collection='mongolier_test'),
+                                    collections=['mongolier_test'],
+                                    token_store=store,
+                                    listeners=[lambda *change: changes.append(change)])
+
+        worker._follow_change_stream(_StreamDatabase([
+            {'_id': {'_data': 'drop'}, 'operationType': 'dropDatabase'},
+            {'_id': {'_data': 'invalidate'}, 'operationType': 'invalidate'},
+        ]))
+
+        self.assertEqual(changes, [(None, None), (None, None)])
+        self.assertEqual(worker.token, None)
+        self.assertEqual(store.token, None)
+
+
+class TestOplogFollower(unittest.TestCase):
+    """
+    Test tailing the oplog, without a replica set
+    """
+
+    def test_oplog(self):
+        changes = []
+        worker = InvalidationWorker(Connection(db='test', collection='mongolier_test'),
+                                    collections=['mongolier_test'],
+                                    listeners=[lambda *change: changes.append(change)],
+                                    use_oplog=True)
+        worker._token = {'ts': 5}
+        oplog = _Oplog([{'ts': 6, 'op': 'i', 'ns': 'test.mongolier_test', 'o': {'_id': 1}},
+                        {'ts': 7, 'op': 'u', 'ns': 'test.mongolier_test',
+                         'o': {'$set': {'a': 1}}, 'o2': {'_id': 2}},
+                        {'ts': 8, 'op': 'i', 'ns': 'test.other', 'o': {'_id': 3}},
+                        {'ts': 9, 'op': 'c', 'ns': 'test.$cmd', 'o': {'dropDatabase': 1}}],
+                       worker._stop.set)
+
+        worker._follow_oplog(_Database(oplog))
+
+        self.assertEqual(changes, [('mongolier_test', [1]), ('mongolier_test', [2]),
+                                   (None, None)])
+        self.assertEqual(worker.token, {'ts': 9})
+        args, kwargs = oplog.queries[0]
+        self.assertEqual(args[0]['ts'], {'$gt': 5})
+        self.assertTrue(kwargs['oplog_replay'])
+
+
+@unittest.skipUnless(REPLSET, 'Set MONGOLIER_TEST_REPLSET to a replica set member')
+class TestInvalidationWorker(unittest.TestCase):
+    """
+    Test following changes made behind mongolier's back
+    """
+
+    def setUp(self):
+        host, _, port = REPLSET.partition(':')
+        self.connection = Connection(host=host, port=int(port or 27017),
+                                     db='test', collection='mongolier_test')
+        self.client = MongoClient(host, int(port or 27017))
+        self.collection = self.client.test.mongolier_test
+        self.directory = tempfile.mkdtemp()
+        self.store = FileTokenStore(os.path.join(self.directory, 'token'))
+        self.changes = []
+
+    def worker(self, **kwargs):
+        worker = InvalidationWorker(self.connection,
+                                    collections=['mongolier_test'],
+                                    token_store=self.store,
+                                    listeners=[lambda *change: self.changes.append(change)],
+                                    max_await_time=0.2,
+                                    **kwargs)
+        worker.start()
+        # Let it open its stream before writing
+        time.sleep(1)
+        return worker
+
+    def wait_for(self, change):
+        deadline = time.time() + 10
+        while change not in self.changes and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertTrue(change in self.changes)
+
+    def check(self, **kwargs):
+        worker = self.worker(**kwargs)
+        _id = self.collection.insert({'mongolier-invalidation-test': 1})
+        self.wait_for(('mongolier_test', [_id]))
+        worker.stop()
+
+        # Changes made while no worker runs are picked up after a restart
+        self.collection.update({'_id': _id}, {'$set': {'changed': True}})
+        del self.changes[:]
+        worker = self.worker(**kwargs)
+        self.wait_for(('mongolier_test', [_id]))
+        worker.stop()
+
+    def test_change_stream(self):
+        self.check()
+
+    def test_oplog(self):
+        self.check(use_oplog=True)
+
+    def tearDown(self):
+        self.collection.drop()
+        shutil.rmtree(self.directory)
@@ -0,0 +1,78 @@
+import unittest
+
+from pymongo.errors import AutoReconnect, OperationFailure
+
+from mongolier.retry import RetryPolicy
+
+
+class TestRetryPolicy(unittest.TestCase):
+    """
+    Test the retry policy without a database
+    """
+
+    def setUp(self):
+        self.sleeps = []
+        self.policy = RetryPolicy(max_retries=3, backoff=1, max_backoff=3,
+                                  jitter=False, sleep=self.sleeps.append)
+
+    def flaky(self, failures):
+        """
+        Return a function that raises AutoReconnect ``failures`` times.
+        """
+        calls = []
+
+        def operation():
+            calls.append(1)
+            if len(calls) <= failures:
+                raise AutoReconnect('primary stepped down')
+            return len(calls)
+
+        return operation
+
+    def test_backoff(self):
+        """
+        Delays grow exponentially and are capped at ``max_backoff``.
+        """
+        self.assertEqual(self.policy.call('find_one', self.flaky(3)), 4)
+        self.assertEqual(self.sleeps, [1, 2, 3])
+
+        stats = self.policy.stats()
+        self.assertEqual(stats['retries'], 3)
+        self.assertEqual(stats['operations'], {'find_one': 3})
+
+    def test_exhausted(self):
+        """
+        The last error is raised once the retries run out.
+        """
+        with self.assertRaises(AutoReconnect):
+            self.policy.call('find_one', self.flaky(4))
+        self.assertEqual(self.policy.stats()['failures'], 1)
+
+    def test_deadline(self):
+        """
+        No retry is attempted past the deadline.
+        """
+        self.policy.deadline = 2.5
+        with self.assertRaises(AutoReconnect):
+            self.policy.call('find_one', self.flaky(3))
+        self.assertEqual(self.sleeps, [1])
+
+    def test_jitter(self):
+        """
+        Jittered delays never exceed the exponential delay.
+        """
+        self.policy.jitter = True
+        for attempt in range(5):
+            self.assertTrue(0 <= self.policy.delay(attempt) <= 3)
+
+    def test_retry_on(self):
+        """
+        Errors the policy does not retry on are raised immediately.
+        """
+        def operation():
+            raise OperationFailure('bad query')
+
+        with self.assertRaises(OperationFailure):
+            self.policy.call('find_one', operation)
+        self.assertEqual(self.sleeps, [])
+        self.assertFalse(self.policy.should_retry('insert'))
@@ -0,0 +1,76 @@
+import datetime
+import unittest
+
+from bson.objectid import ObjectId
+
+from mongolier import Connection
+from mongolier.sharding import ShardedConnection, _SortKey
+
+
+class TestShardedConnection(unittest.TestCase):
+    """
+    Test sharding a collection, using one database per shard on the test
+    server.
+    """
+
+    def setUp(self):
+        self.shards = [Connection(db='mongolier_shard_%s' % index,
+                                  collection='mongolier_test')
+                       for index in range(3)]
+        self.connection = ShardedConnection(self.shards, shard_key='site')
+        self.connection.api.insert([{'site': site, 'rank': rank}
+                                    for site in range(6)
+                                    for rank in range(5)])
+
+    def test_routing(self):
+        """
+        Keyed reads and writes land on a single shard.
+        """
+        owner = self.connection.shard_for(4)
+        self.assertEqual(owner.api.find({'site': 4}).count(), 5)
+        for shard in self.shards:
+            if shard is not owner:
+                self.assertEqual(shard.api.find({'site': 4}).count(), 0)
+
+        self.assertEqual(self.connection.api.find_one({'site': 4, 'rank': 3})['rank'], 3)
+
+    def test_scatter_gather(self):
+        """
+        Unkeyed reads are merged across shards respecting sort, skip and limit.
+        """
+        self.assertEqual(self.connection.api.find().count(), 30)
+        self.assertEqual(self.connection.api.count({'rank': 1}), 6)
+        self.assertEqual(self.connection.api.count({'site': 4, 'rank': {'$lt': 2}}), 2)
+        self.assertEqual(self.connection.api.count({'rank': 1}, skip=4), 2)
+
+        documents = list(self.connection.api.find({'rank': {'$gte': 1}})
+                         .sort([('rank', -1), ('site', 1)]).skip(2).limit(10))
+        self.assertEqual([(document['rank'], document['site']) for document in documents],
+                         [(4, 2), (4, 3), (4, 4), (4, 5),
+                          (3, 0), (3, 1), (3, 2), (3, 3), (3, 4), (3, 5)])
+
+    def test_unkeyed_update(self):
+        """
+        An unkeyed update changes one document, unless it is a multi update.
+        """
+        holders = [shard for shard in self.shards if shard.api.find({'rank': 1}).count()]
+        self.assertTrue(len(holders) >= 2)
+
+        self.connection.api.update({'rank': 1}, {'$set': {'touched': 1}})
+        self.assertEqual(self.connection.api.count({'touched': 1}), 1)
+
+        self.connection.api.update({'rank': 2}, {'$set': {'touched': 2}}, multi=True)
+        self.assertEqual(self.connection.api.count({'touched': 2}), 6)
+
+    def test_mixed_types(self):
+        """
+        Values of different types sort in MongoDB's type order.
+        """
+        values = [True, {'a': 1}, 'text', None, [1, 'x'], datetime.datetime(2012, 1, 1),
+                  ObjectId('5' * 24), 2.5, {'a': 'b'}, 1, [1, 2]]
+        ordered = sorted(values, key=lambda value: _SortKey({'v': value}, [('v', 1)]))
+        self.assertEqual(ordered, [None, 1, 2.5, 'text', {'a': 1}, {'a': 'b'}, [1, 2], [1, 'x'],
+                                   ObjectId('5' * 24), True, datetime.datetime(2012, 1, 1)])
+
+    def tearDown(self):
+        self.connection.api.drop()
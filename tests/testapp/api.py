@@ -1,6 +1,8 @@
 from tastypie import fields
 from tastypie.authorization import Authorization
 from mongolier import api
+from mongolier.indexes import Index
+from mongolier.paginator import KeysetPaginator
 from django.db import settings
 
 
@@ -32,3 +34,32 @@ class MongoClientTestResource(api.MongoResource):
 
     def dehydrate_my_field(self, bundle_or_obj):
         return(bundle_or_obj.obj)
+
+
+class MongolierProjectionTestResource(api.MongoResource):
+
+    title = fields.CharField(attribute='title', null=True)
+    views = fields.IntegerField(attribute='views', null=True)
+
+    class Meta:
+
+        connection = settings.MONGO_TEST_CONN
+        resource_name = "projection"
+        authorization = Authorization()
+        allowed_methods = ['get']
+        indexes = ['mongolier_projection_test']
+
+
+class MongolierKeysetTestResource(api.MongoResource):
+
+    rank = fields.IntegerField(attribute='rank', null=True)
+
+    class Meta:
+
+        connection = settings.MONGO_TEST_CONN
+        resource_name = "keyset"
+        authorization = Authorization()
+        allowed_methods = ['get']
+        paginator_class = KeysetPaginator
+        indexes = [('mongolier_keyset_test', '-rank', '-_id'),
+                   Index('mongolier_keyset_expires', expire_after_seconds=3600)]
@@ -9,6 +9,10 @@ from django.test import TestCase
 from warnings import warn
 from urlparse import urlparse
 from django.db import settings
+from django.test.client import RequestFactory
+from mongolier.api import MongoCursorList, _project
+from mongolier.paginator import encode_token
+from tests.testapp.api import MongolierTestResource, MongolierProjectionTestResource
 
 
 class TestClient(Client):
@@ -87,3 +91,122 @@ class TestAPI(TestCase):
         """
         Test creating an object in Mongo
         """
+
+    def test_pagination(self):
+        """
+        Test that pages are fetched with a server-side skip and limit
+        """
+        settings.MONGO_TEST_CONN.api.insert([{'mongolier_page_test': number}
+                                             for number in range(30)])
+        try:
+            response = self.client.get('/api/test/mongo/?format=json&limit=5&offset=10'
+                                       '&mongolier_page_test__exists=true&sort=mongolier_page_test')
+            response_json = json.loads(response.content)
+            self.assertEqual(response_json['meta']['total_count'], 30)
+            self.assertEqual([value['my_field']['mongolier_page_test']
+                              for value in response_json['objects']],
+                             [10, 11, 12, 13, 14])
+
+            documents = MongoCursorList(settings.MONGO_TEST_CONN.api,
+                                        {'mongolier_page_test': {'$gte': 0}},
+                                        sort=[('mongolier_page_test', 1)])
+            page = documents[10:20][5:]
+            self.assertEqual((page.skip, page.limit), (15, 5))
+            self.assertEqual(page.count(), 5)
+            self.assertEqual(page[-1]['mongolier_page_test'], 19)
+            self.assertEqual([document['mongolier_page_test'] for document in page],
+                             [15, 16, 17, 18, 19])
+            self.assertEqual(documents[25:40].count(), 5)
+            self.assertEqual(documents[5:5], [])
+        finally:
+            settings.MONGO_TEST_CONN.api.remove({'mongolier_page_test': {'$exists': True}})
+
+    def test_projection(self):
+        """
+        Test that only the fields a resource exposes are fetched
+        """
+        settings.MONGO_TEST_CONN.api.insert({'mongolier_projection_test': 1,
+                                             'title': 'Palm',
+                                             'views': 3,
+                                             'body': 'x' * 1000})
+        try:
+            response = self.client.get('/api/test/projection/?format=json'
+                                       '&mongolier_projection_test=1')
+            objects = json.loads(response.content)['objects']
+            self.assertEqual((objects[0]['title'], objects[0]['views']), ('Palm', 3))
+
+            response = self.client.get('/api/test/projection/?format=json'
+                                       '&mongolier_projection_test=1&fields=title')
+            objects = json.loads(response.content)['objects']
+            self.assertEqual(sorted(objects[0].keys()), ['resource_uri', 'title'])
+
+            response = self.client.get(objects[0]['resource_uri'] + '?format=json&fields=views')
+            self.assertEqual(json.loads(response.content)['views'], 3)
+
+            resource = MongolierProjectionTestResource()
+            request = RequestFactory().get('/', {'fields': 'views'})
+            self.assertEqual(resource.get_projection(request), {'views': 1})
+            self.assertEqual(resource.get_projection(RequestFactory().get('/')),
+                             {'title': 1, 'views': 1})
+            self.assertEqual(resource.get_projection(RequestFactory().put('/')), None)
+            self.assertEqual(MongolierTestResource().get_projection(RequestFactory().get('/')),
+                             None)
+            self.assertEqual(_project({'_id': 1, 'title': 'Palm', 'body': 'x', 'stats': {'v': 1}},
+                                      {'title': 1, 'stats.v': 1}),
+                             {'_id': 1, 'title': 'Palm', 'stats': {'v': 1}})
+        finally:
+            settings.MONGO_TEST_CONN.api.remove({'mongolier_projection_test': 1})
+
+    def test_keyset_pagination(self):
+        """
+        Test walking a list page by page with ``after`` tokens
+        """
+        ranks = [3, 1, 2, 2, 5, 2, 4]
+        settings.MONGO_TEST_CONN.api.insert([{'mongolier_keyset_test': 1, 'rank': rank}
+                                             for rank in ranks])
+        try:
+            url = '/api/test/keyset/?format=json&mongolier_keyset_test=1&sort=-rank&limit=3'
+            seen = []
+            while url:
+                response_json = json.loads(self.client.get(url).content)
+                self.assertTrue(len(response_json['objects']) <= 3)
+                seen.extend((value['rank'], value['resource_uri'])
+                            for value in response_json['objects'])
+                url = response_json['meta']['next']
+
+            self.assertEqual([rank for rank, _ in seen], sorted(ranks, reverse=True))
+            self.assertEqual(len(set(uri for _, uri in seen)), len(ranks))
+
+            response = self.client.get('/api/test/keyset/?format=json&after=garbage')
+            self.assertEqual(response.status_code, 400)
+
+            tampered = encode_token(['rank', '_id'], [1, {'$oid': 'zz'}])
+            response = self.client.get('/api/test/keyset/?format=json&sort=-rank&after=' + tampered)
+            self.assertEqual(response.status_code, 400)
+        finally:
+            settings.MONGO_TEST_CONN.api.remove({'mongolier_keyset_test': 1})
+
+    def test_filter_plans(self):
+        """
+        Test that query strings of the same shape share a compiled filter plan
+        """
+        resource = MongolierTestResource()
+        resource.filter_plans.max_size = 2
+
+        def build(params):
+            return resource.build_filters(RequestFactory().get('/', params).GET.copy())
+
+        self.assertEqual(build({'name': 'palm', 'rank__gt': '2', 'limit': '5'}),
+                         {'name': 'palm', 'rank': {'$gt': '2'}})
+        self.assertEqual(build({'name': 'oak', 'rank__gt': '7', 'limit': '1'}),
+                         {'name': 'oak', 'rank': {'$gt': '7'}})
+        self.assertEqual(resource.filter_plans.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+        # JSON objects are still read per request, under the same plan
+        self.assertEqual(build({'name': 'oak', 'rank__gt': '7', 'limit': '{"x": 1}'}),
+                         {'name': 'oak', 'rank': {'$gt': '7'}})
+        self.assertEqual(build({'name': '{"ne": "oak"}', 'rank__gt': 'true', 'limit': '1'}),
+                         {'name': {'$ne': 'oak'}, 'rank': {'$gt': True}})
+        self.assertEqual(build({'tags__in': 'a,b'}), {'tags': {'$in': ['a', 'b']}})
+        self.assertEqual(build({'active': 'false'}), {'active': False})
+        self.assertEqual(len(resource.filter_plans), 2)
@@ -4,3 +4,91 @@ test_mgmt.py
 A utility for testing the management commands included with mongolier.
 """
 
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.db import settings
+from django.test import TestCase
+
+from mongolier.exceptions import IncorrectParameters
+from mongolier.indexes import Index, TEXT, normalize_keys, sync_indexes
+from tests.testapp.api import MongolierKeysetTestResource
+
+
+class TestSyncIndexes(TestCase):
+    """
+    Test building the indexes declared by resources
+    """
+
+    def setUp(self):
+        self.collection = settings.TEST_PYMONGO_CLIENT_OBJ.database.mongolier_index_test
+        self.collection.drop()
+
+    def tearDown(self):
+        self.collection.drop()
+
+    def test_declarations(self):
+        self.assertEqual(normalize_keys('-date'), [('date', -1)])
+        self.assertEqual(normalize_keys(('site_id', '-date')), [('site_id', 1), ('date', -1)])
+        self.assertEqual(normalize_keys([('title', TEXT)]), [('title', 'text')])
+        self.assertRaises(IncorrectParameters, normalize_keys, [])
+
+        index = Index.coerce({'keys': 'created', 'expire_after_seconds': 60})
+        self.assertEqual((index.name, index.options), ('created_1', {'expireAfterSeconds': 60}))
+        self.assertEqual([index.name for index in MongolierKeysetTestResource().get_indexes()],
+                         ['mongolier_keyset_test_1_rank_-1__id_-1', 'mongolier_keyset_expires_1'])
+
+    def test_sync(self):
+        indexes = ['slug',
+                   ('site_id', '-date'),
+                   Index('created', expire_after_seconds=3600),
+                   Index([('title', TEXT), ('body', TEXT)]),
+                   Index('-date', partial={'published': True})]
+        names = ['slug_1', 'site_id_1_date_-1', 'created_1', 'title_text_body_text', 'date_-1']
+
+        self.assertEqual(sync_indexes(self.collection, indexes, dry_run=True),
+                         [('create', name) for name in names])
+        self.assertEqual(self.collection.index_information().keys(), [])
+
+        sync_indexes(self.collection, indexes, background=True)
+        self.assertEqual(sorted(self.collection.index_information()), sorted(names + ['_id_']))
+        self.assertEqual(sync_indexes(self.collection, indexes), [])
+
+        # A changed declaration is only rebuilt with drop, which also drops
+        # what is no longer declared
+        indexes = ['slug', Index('created', expire_after_seconds=60)]
+        self.assertEqual(sync_indexes(self.collection, indexes), [('conflict', 'created_1')])
+        self.assertEqual(sync_indexes(self.collection, indexes, drop=True),
+                         [('drop', 'date_-1'), ('drop', 'site_id_1_date_-1'),
+                          ('drop', 'title_text_body_text'), ('drop', 'created_1'),
+                          ('create', 'created_1')])
+        information = self.collection.index_information()
+        self.assertEqual(sorted(information), ['_id_', 'created_1', 'slug_1'])
+        self.assertEqual(information['created_1']['expireAfterSeconds'], 60)
+
+    def test_command(self):
+        collection = settings.MONGO_TEST_CONN.get_database().mongolier_test
+        name = 'mongolier_keyset_test_1_rank_-1__id_-1'
+        try:
+            output = StringIO()
+            call_command('mongolier_syncindexes', 'keyset', dry_run=True, stdout=output)
+            self.assertTrue('would create %s' % name in output.getvalue())
+            self.assertFalse(name in collection.index_information())
+
+            output = StringIO()
+            call_command('mongolier_syncindexes', 'keyset', background=True, stdout=output)
+            self.assertTrue('created %s' % name in output.getvalue())
+            self.assertTrue(name in collection.index_information())
+
+            # The indexes the other resources on the collection declare are
+            # kept when syncing one resource with --drop
+            collection.create_index('mongolier_projection_test')
+            output = StringIO()
+            call_command('mongolier_syncindexes', 'keyset', drop=True, dry_run=True,
+                         stdout=output)
+            self.assertFalse('mongolier_projection_test_1' in output.getvalue())
+        finally:
+            for index_name in (name, 'mongolier_keyset_expires_1',
+                               'mongolier_projection_test_1'):
+                if index_name in collection.index_information():
+                    collection.drop_index(index_name)
@@ -0,0 +1,82 @@
+"""
+test_views.py
+
+A harness for testing the GridFS file view
+"""
+import shutil
+import tempfile
+
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from mongolier import Connection
+from mongolier.filecache import GridFSFileCache
+from mongolier.views import GridFSFileView
+
+
+class TestGridFSFileView(TestCase):
+    """
+    Make sure files are streamed, in ranges and conditionally.
+    """
+
+    data = b'0123456789' * 10
+
+    def setUp(self):
+        self.connection = Connection(db='test', collection='mongolier_view_test')
+        self.file_id = self.connection.fs.put(self.data, filename='test.txt', chunkSize=16)
+        self.view = GridFSFileView.as_view(connection=self.connection)
+        self.factory = RequestFactory()
+
+    def get(self, pk=None, **headers):
+        return self.view(self.factory.get('/', **headers), pk=pk or str(self.file_id))
+
+    def test(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+        self.assertEqual(response['Content-Length'], str(len(self.data)))
+        self.assertEqual(response['Content-Type'], 'text/plain')
+
+    def test_range(self):
+        response = self.get(HTTP_RANGE='bytes=15-34')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.data[15:35])
+        self.assertEqual(response['Content-Range'], 'bytes 15-34/100')
+
+        response = self.get(HTTP_RANGE='bytes=-5')
+        self.assertEqual(b''.join(response.streaming_content), self.data[-5:])
+
+        response = self.get(HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.status_code, 416)
+
+    def test_not_modified(self):
+        response = self.get()
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_missing(self):
+        from django.http import Http404
+        self.assertRaises(Http404, self.get, pk='0' * 24)
+        self.assertRaises(Http404, self.get, pk='not-an-id')
+
+    def test_file_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            file_cache = GridFSFileCache(directory)
+            self.view = GridFSFileView.as_view(connection=self.connection, file_cache=file_cache)
+
+            for _ in range(2):
+                response = self.get()
+                self.assertEqual(b''.join(response.streaming_content), self.data)
+                response.close()
+            response = self.get(HTTP_RANGE='bytes=90-')
+            self.assertEqual(b''.join(response.streaming_content), self.data[90:])
+
+            stats = file_cache.stats()
+            self.assertEqual((stats['misses'], stats['hits']), (1, 2))
+        finally:
+            shutil.rmtree(directory)
+
+    def tearDown(self):
+        self.connection.fs.delete(self.file_id)
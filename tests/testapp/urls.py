@@ -1,11 +1,14 @@
 from django.conf.urls import *
 from tastypie.api import Api
-from api import MongolierTestResource, MongoClientTestResource
+from api import MongolierTestResource, MongoClientTestResource, MongolierProjectionTestResource, \
+    MongolierKeysetTestResource
 
 api = Api('test')
 
 api.register(MongolierTestResource())
 api.register(MongoClientTestResource())
+api.register(MongolierProjectionTestResource())
+api.register(MongolierKeysetTestResource())
 
 
 urlpatterns = patterns('',